@@ -0,0 +1,120 @@
+"""
+Dedicated thread pool for ChromaDB calls.
+
+`chromadb.PersistentClient` is synchronous: a query or upsert run inline in an
+async handler blocks the event loop, stalling every other request on the worker
+(including SSE token streams). `ChromaPool.run` executes those calls on a small
+bounded pool of its own, so they neither block the loop nor compete with the
+default executor, and records how long calls wait for a free thread.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+# --- Configuration ---
+CHROMA_MAX_WORKERS = int(os.environ.get("CHROMA_MAX_WORKERS", 4))
+# Calls waiting for a thread beyond this many are rejected instead of queueing without bound
+CHROMA_MAX_QUEUE = int(os.environ.get("CHROMA_MAX_QUEUE", 256))
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ChromaPoolFull(RuntimeError):
+    """Raised when too many Chroma calls are already waiting for the pool."""
+
+
+class ChromaPool:
+    """Bounded executor for blocking Chroma calls, with queue-wait metrics."""
+
+    def __init__(self, max_workers: int = CHROMA_MAX_WORKERS, max_queue: int = CHROMA_MAX_QUEUE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # asyncio.Semaphore is bound to one loop; keep one per running loop
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._waits_ms: deque = deque(maxlen=1000)
+        self.calls = 0
+        self.rejected = 0
+        self.waiting = 0
+        self.running = 0
+        self.max_wait_ms = 0.0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="chroma")
+            return self._executor
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_workers)
+        return semaphore
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Run `fn(*args, **kwargs)` on the Chroma pool without blocking the event loop.
+
+        Raises:
+            ChromaPoolFull: If CHROMA_MAX_QUEUE calls are already waiting.
+        """
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise ChromaPoolFull(f"Chroma pool queue is full ({self.waiting} waiting)")
+
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore().acquire()
+        finally:
+            self.waiting -= 1
+        self._record_wait((time.perf_counter() - queued_at) * 1000)
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), lambda: fn(*args, **kwargs))
+        finally:
+            self.running -= 1
+            self._semaphore().release()
+
+    def _record_wait(self, wait_ms: float) -> None:
+        with self._lock:
+            self.calls += 1
+            self._waits_ms.append(wait_ms)
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def shutdown(self) -> None:
+        """Wait for running calls and release the threads (recreated on next use)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits_ms)
+        return {
+            "max_workers": self.max_workers,
+            "calls": self.calls,
+            "running": self.running,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "queue_wait_p50_ms": waits[len(waits) // 2] if waits else 0.0,
+            "queue_wait_p95_ms": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+            "queue_wait_max_ms": self.max_wait_ms,
+        }
+
+
+# Process-wide pool used by the retriever
+chroma_pool = ChromaPool()
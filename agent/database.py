@@ -15,28 +15,43 @@ This script defines the data models and database setup logic.
 """
 
 import os
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Text, DateTime, Integer, Uuid, func
+from sqlalchemy import String, Text, DateTime, Integer, Uuid, Index, func
+from agent.db_config import create_engine_from_settings
+from agent.cache import LRUCache
+from agent.tokens import CHARS_PER_TOKEN, count_tokens
+from dataclasses import dataclass
 import uuid
-from typing import AsyncGenerator, Optional, List
-from datetime import datetime
+import base64
+from typing import AsyncGenerator, Optional, List, Tuple
+from datetime import datetime, timezone
 
 # --- Configuration ---
 DATABASE_URL = os.environ.get(
     "DATABASE_URL", "sqlite+aiosqlite:///./database/sqlite.db"
 )
 
+# Conversation metadata cache (id -> user_id, metadata); ids never change owner
+CONVERSATION_CACHE_SIZE = int(os.environ.get("CONVERSATION_CACHE_SIZE", 10000))
+CONVERSATION_CACHE_TTL = float(os.environ.get("CONVERSATION_CACHE_TTL", 300))
+# Unknown ids are rejected from cache for this many seconds (0 disables the negative cache)
+CONVERSATION_NEGATIVE_TTL = float(os.environ.get("CONVERSATION_NEGATIVE_TTL", 5))
+
 # --- Database Setup ---
-# Create async engine
-engine = create_async_engine(DATABASE_URL, echo=True)  # Set echo=False in production
+# Create async engine (pool, pragmas and echo come from agent.db_config settings)
+engine = create_engine_from_settings(DATABASE_URL)
 
 # Create async session factory
 async_session = async_sessionmaker(
     engine, expire_on_commit=False, class_=AsyncSession
 )
 
+def utcnow() -> datetime:
+    """Naive UTC timestamp with microseconds (SQLite's CURRENT_TIMESTAMP only has seconds)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 # --- Base Class for Models ---
 class Base(DeclarativeBase):
     pass
@@ -49,6 +64,8 @@ class Conversation(Base):
     user_id: Mapped[str] = mapped_column(String(255), index=True) # Opaque user identifier
     created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
     last_active_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    # Running sum of the conversation's messages.tokens_estimate
+    tokens_total: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
     # JSON column for extensible metadata
     metadata_: Mapped[Optional[dict]] = mapped_column("metadata", type_=String) 
     
@@ -58,13 +75,19 @@ class Conversation(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset pagination: newest messages of a conversation, ties broken by id
+        Index("ix_messages_conversation_created", "conversation_id", "created_at", "id"),
+    )
     
     id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
     conversation_id: Mapped[uuid.UUID] = mapped_column(Uuid, index=True)
     sender: Mapped[str] = mapped_column(String(50)) # 'user' or 'assistant'
     text: Mapped[str] = mapped_column(Text)
+    # Tokens of `text` (agent.tokens.count_tokens), computed once at write time
     tokens_estimate: Mapped[Optional[int]] = mapped_column(Integer)
-    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    # Set in Python so messages written in the same second still have a stable order
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow, server_default=func.now())
     # JSON column for extensible metadata (e.g., embedding status)
     metadata_: Mapped[Optional[dict]] = mapped_column("metadata", type_=String)
     
@@ -75,8 +98,49 @@ class Message(Base):
 # --- Database Initialization ---
 async def init_db():
     """Create all tables defined in the models."""
+    import agent.jobs  # noqa: F401  (registers the job queue tables)
+    import agent.summaries  # noqa: F401  (registers the conversation summary table)
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        added = await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
+        if "conversations.tokens_total" in added:
+            # Start the running totals from the messages already stored
+            from sqlalchemy import select, update
+            await conn.execute(
+                update(Conversation).values(
+                    tokens_total=select(func.coalesce(func.sum(stored_tokens()), 0))
+                    .where(Message.conversation_id == Conversation.id)
+                    .scalar_subquery()
+                )
+            )
+
+def _add_missing_columns(sync_conn) -> List[str]:
+    """create_all only creates new tables; add columns introduced since an existing table was created."""
+    from sqlalchemy import inspect, text
+    from sqlalchemy.schema import CreateColumn
+    inspector = inspect(sync_conn)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            table_name = sync_conn.dialect.identifier_preparer.format_table(table)
+            column_spec = CreateColumn(column).compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_spec}"))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+def _create_missing_indexes(sync_conn) -> None:
+    """create_all only indexes new tables; add indexes introduced since an existing table was created."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+def stored_tokens():
+    """SQL expression for a message's token count; rows written before it was stored are estimated from length."""
+    return func.coalesce(Message.tokens_estimate, func.length(Message.text) / CHARS_PER_TOKEN + 1)
         
 async def get_db_session() -> AsyncGenerator[AsyncSession, None]:
     """Dependency for FastAPI to get a database session."""
@@ -91,6 +155,8 @@ async def create_conversation(user_id: str, metadata: Optional[dict] = None) ->
         session.add(conversation)
         await session.commit()
         await session.refresh(conversation)
+        # Replaces a negative entry if the id was probed before
+        _conversation_cache.set(conversation.id, ConversationInfo.from_row(conversation))
         return conversation
 
 async def get_conversation(conversation_id: uuid.UUID) -> Optional[Conversation]:
@@ -98,6 +164,124 @@ async def get_conversation(conversation_id: uuid.UUID) -> Optional[Conversation]
     async with async_session() as session:
         return await session.get(Conversation, conversation_id)
 
+# --- Conversation metadata cache ---
+@dataclass(frozen=True)
+class ConversationInfo:
+    """Immutable snapshot of a conversation's identity (no last_active_at, which changes every turn)."""
+    id: uuid.UUID
+    user_id: str
+    metadata_: Optional[dict]
+    created_at: Optional[datetime]
+
+    @classmethod
+    def from_row(cls, conversation: Conversation) -> "ConversationInfo":
+        return cls(conversation.id, conversation.user_id, conversation.metadata_, conversation.created_at)
+
+_NOT_FOUND = object()
+_conversation_cache = LRUCache(CONVERSATION_CACHE_SIZE, ttl=CONVERSATION_CACHE_TTL)
+
+async def get_conversation_info(conversation_id: uuid.UUID) -> Optional[ConversationInfo]:
+    """
+    Conversation metadata from the per-process cache, loading it on a miss.
+
+    Unknown ids are remembered for CONVERSATION_NEGATIVE_TTL seconds, so repeated
+    requests for them are rejected without a query.
+
+    Returns:
+        Optional[ConversationInfo]: None if the conversation does not exist.
+    """
+    cached = _conversation_cache.get(conversation_id)
+    if cached is _NOT_FOUND:
+        return None
+    if cached is not None:
+        return cached
+    conversation = await get_conversation(conversation_id)
+    if conversation is None:
+        if CONVERSATION_NEGATIVE_TTL > 0:
+            _conversation_cache.set(conversation_id, _NOT_FOUND, ttl=CONVERSATION_NEGATIVE_TTL)
+        return None
+    info = ConversationInfo.from_row(conversation)
+    _conversation_cache.set(conversation_id, info)
+    return info
+
+def invalidate_conversation(conversation_id: uuid.UUID) -> None:
+    """Drop a cached conversation (call after updating or deleting it)."""
+    _conversation_cache.pop(conversation_id)
+
+def clear_conversation_cache() -> None:
+    _conversation_cache.clear()
+
+def conversation_cache_stats() -> dict:
+    return _conversation_cache.stats()
+
+async def add_message(
+    conversation_id: uuid.UUID,
+    sender: str,
+    text: str,
+    tokens_estimate: Optional[int] = None,
+    metadata: Optional[dict] = None,
+    conversation: Optional[Conversation] = None,
+    session: Optional[AsyncSession] = None,
+) -> Message:
+    """
+    Insert a message and bump the conversation's last_active_at and tokens_total in one transaction.
+
+    Uses INSERT ... RETURNING and UPDATE ... RETURNING, so the whole write is
+    BEGIN + two statements + COMMIT (no refresh, no re-fetch of the conversation).
+
+    Args:
+        conversation_id (uuid.UUID): The conversation the message belongs to.
+        sender (str): 'user' or 'assistant'.
+        text (str): Message text.
+        tokens_estimate (Optional[int]): Tokens of `text`; computed with `count_tokens` if omitted.
+        metadata (Optional[dict]): Extensible message metadata.
+        conversation (Optional[Conversation]): The conversation if the caller already
+            loaded it; its last_active_at is updated in place.
+        session (Optional[AsyncSession]): Write in this session's transaction (committed
+            by the caller, e.g. together with the message's jobs) instead of a new one.
+
+    Returns:
+        Message: The stored message, including server-generated columns.
+    """
+    from sqlalchemy import insert, update
+    if tokens_estimate is None:
+        tokens_estimate = count_tokens(text)
+
+    async def write(session: AsyncSession):
+        message = await session.scalar(
+            insert(Message)
+            .values(
+                id=uuid.uuid4(),
+                conversation_id=conversation_id,
+                sender=sender,
+                text=text,
+                tokens_estimate=tokens_estimate,
+                metadata_=metadata,
+            )
+            .returning(Message)
+        )
+        last_active_at = await session.scalar(
+            update(Conversation)
+            .where(Conversation.id == conversation_id)
+            .values(last_active_at=func.now(), tokens_total=Conversation.tokens_total + tokens_estimate)
+            .returning(Conversation.last_active_at)
+            .execution_options(synchronize_session=False)
+        )
+        return message, last_active_at
+
+    if session is not None:
+        message, last_active_at = await write(session)
+    else:
+        async with async_session() as session:
+            async with session.begin():
+                message, last_active_at = await write(session)
+    if last_active_at is None:
+        # The conversation is gone; do not keep serving it from the cache
+        invalidate_conversation(conversation_id)
+    elif conversation is not None:
+        conversation.last_active_at = last_active_at
+    return message
+
 async def create_message(
     conversation_id: uuid.UUID, 
     sender: str, 
@@ -105,24 +289,8 @@ async def create_message(
     tokens_estimate: Optional[int] = None,
     metadata: Optional[dict] = None
 ) -> Message:
-    """Create a new message in a conversation."""
-    async with async_session() as session:
-        message = Message(
-            conversation_id=conversation_id,
-            sender=sender,
-            text=text,
-            tokens_estimate=tokens_estimate,
-            metadata_=metadata
-        )
-        session.add(message)
-        await session.commit()
-        await session.refresh(message)
-        # Update conversation's last_active_at
-        conversation = await session.get(Conversation, conversation_id)
-        if conversation:
-            conversation.last_active_at = func.now()
-            await session.commit()
-        return message
+    """Create a new message in a conversation (see `add_message`)."""
+    return await add_message(conversation_id, sender, text, tokens_estimate=tokens_estimate, metadata=metadata)
 
 async def get_messages_history(conversation_id: uuid.UUID) -> List[Message]:
     """Retrieve message history for a conversation, ordered by creation time."""
@@ -130,4 +298,112 @@ async def get_messages_history(conversation_id: uuid.UUID) -> List[Message]:
         from sqlalchemy import select, asc
         stmt = select(Message).where(Message.conversation_id == conversation_id).order_by(asc(Message.created_at))
         result = await session.execute(stmt)
-        return list(result.scalars().all())
\ No newline at end of file
+        return list(result.scalars().all())
+
+def encode_cursor(message: Message) -> str:
+    """Opaque pagination cursor pointing at `message` (pages continue with older messages)."""
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    """
+    Decode a cursor from `encode_cursor`.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, message_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), uuid.UUID(message_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+async def get_recent_messages(
+    conversation_id: uuid.UUID,
+    limit: int,
+    before: Optional[str] = None,
+) -> List[Message]:
+    """
+    The `limit` most recent messages of a conversation, in chronological order.
+
+    Keyset pagination on (created_at, id) served by ix_messages_conversation_created:
+    the cost depends on `limit`, not on the length of the conversation.
+
+    Args:
+        conversation_id (uuid.UUID): The conversation.
+        limit (int): Maximum number of messages.
+        before (Optional[str]): Cursor from `encode_cursor`; only older messages are returned.
+
+    Returns:
+        List[Message]: Oldest first.
+
+    Raises:
+        ValueError: If `before` is not a valid cursor.
+    """
+    from sqlalchemy import select, desc, tuple_
+    stmt = select(Message).where(Message.conversation_id == conversation_id)
+    if before is not None:
+        created_at, message_id = decode_cursor(before)
+        stmt = stmt.where(tuple_(Message.created_at, Message.id) < (created_at, message_id))
+    stmt = stmt.order_by(desc(Message.created_at), desc(Message.id)).limit(limit)
+    async with async_session() as session:
+        result = await session.execute(stmt)
+        messages = list(result.scalars().all())
+    messages.reverse()
+    return messages
+
+async def get_context_window(
+    conversation_id: uuid.UUID,
+    token_budget: int,
+    max_messages: int,
+) -> List[Message]:
+    """
+    The most recent messages whose prompt lines fit `token_budget`, in chronological order.
+
+    The newest `max_messages` rows are read through ix_messages_conversation_created
+    and a running SUM() OVER their stored token counts (newest first) selects the
+    window in SQL, so no message text is tokenized on the read path. The newest
+    message is always included.
+
+    Args:
+        conversation_id (uuid.UUID): The conversation.
+        token_budget (int): Tokens available for history lines ("role: text").
+        max_messages (int): Upper bound on the number of messages considered.
+
+    Returns:
+        List[Message]: Oldest first.
+    """
+    from sqlalchemy import select, desc, case
+    recent = (
+        select(
+            Message.id,
+            Message.created_at,
+            (
+                stored_tokens()
+                + case(
+                    (Message.sender == "user", count_tokens("user:")),
+                    else_=count_tokens("assistant:"),
+                )
+            ).label("line_tokens"),
+        )
+        .where(Message.conversation_id == conversation_id)
+        .order_by(desc(Message.created_at), desc(Message.id))
+        .limit(max_messages)
+        .subquery()
+    )
+    newest_first = (desc(recent.c.created_at), desc(recent.c.id))
+    window = select(
+        recent.c.id,
+        func.sum(recent.c.line_tokens).over(order_by=newest_first).label("running_tokens"),
+        func.row_number().over(order_by=newest_first).label("position"),
+    ).subquery()
+    stmt = (
+        select(Message)
+        .join(window, Message.id == window.c.id)
+        .where((window.c.running_tokens <= token_budget) | (window.c.position == 1))
+        .order_by(Message.created_at, Message.id)
+    )
+    async with async_session() as session:
+        result = await session.execute(stmt)
+        return list(result.scalars().all())
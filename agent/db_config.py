@@ -0,0 +1,162 @@
+"""
+Database engine configuration for the Mai-Sale chat application.
+
+Builds the async SQLAlchemy engine from settings instead of hard-coded
+arguments:
+
+- SQL echo only with DB_ECHO=true (statement logging is synchronous and costly)
+- Connection pool sizing, timeout, recycle and pre-ping
+- asyncpg: statement cache size (set to 0 behind pgbouncer in transaction mode)
+- SQLite: WAL journal, synchronous=NORMAL and busy_timeout pragmas on every
+  connection, so concurrent writers wait for the lock instead of failing with
+  "database is locked" and readers never block writers
+
+Pool checkouts are timed; `pool_stats()` reports how long requests wait for a
+connection (exposed on /metrics).
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# --- Configuration ---
+DB_ECHO = os.environ.get("DB_ECHO", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# asyncpg prepared statement caches (asyncpg's own and SQLAlchemy's adapter cache)
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 100))
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+class PoolMetrics:
+    """Connection checkout wait times (ms) of one engine's pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waits_ms: deque = deque(maxlen=1000)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.max_wait_ms = 0.0
+
+    def record(self, wait_ms: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self._waits_ms.append(wait_ms)
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits_ms)
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "checkout_wait_p50_ms": waits[len(waits) // 2] if waits else 0.0,
+            "checkout_wait_p95_ms": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+            "checkout_wait_max_ms": self.max_wait_ms,
+        }
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waits (including opening new connections)."""
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self) -> "TimedQueuePool":
+        # engine.dispose() swaps in a new pool; keep counting into the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        self.metrics.record((time.perf_counter() - started) * 1000)
+        return connection
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    finally:
+        cursor.close()
+
+
+def engine_options(database_url: str) -> Dict[str, Any]:
+    """
+    Keyword arguments for `create_async_engine` for this backend.
+
+    Args:
+        database_url (str): SQLAlchemy URL, e.g. sqlite+aiosqlite:///./database/sqlite.db.
+
+    Returns:
+        Dict[str, Any]: Engine options built from the DB_* / SQLITE_* settings.
+    """
+    url = make_url(database_url)
+    options: Dict[str, Any] = {"echo": DB_ECHO, "pool_pre_ping": DB_POOL_PRE_PING}
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory SQLite keeps its default single-connection pool
+        return options
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {
+            "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        }
+    return options
+
+
+def create_engine_from_settings(database_url: str) -> AsyncEngine:
+    """Create the async engine for `database_url` with pooling, pragmas and checkout metrics."""
+    engine = create_async_engine(database_url, **engine_options(database_url))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+    logger.info(
+        f"Database engine: {engine.dialect.name}/{engine.dialect.driver}, "
+        f"pool={type(engine.sync_engine.pool).__name__}, echo={DB_ECHO}"
+    )
+    return engine
+
+
+def pool_stats(engine: AsyncEngine) -> Dict[str, Any]:
+    """Pool occupancy and checkout wait times for `engine`."""
+    pool = engine.sync_engine.pool
+    stats: Dict[str, Any] = {"pool": type(pool).__name__}
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            **pool.metrics.stats(),
+        )
+    return stats
@@ -0,0 +1,235 @@
+"""
+Content-addressed embedding cache for the Mai-Sale chat application.
+
+Embeddings are deterministic for a given (model, text), so repeated questions,
+greetings and re-indexing runs can skip the Ollama call entirely.
+
+- Key: (model, sha256(normalized text)) — switching models never reuses entries
+- Memory tier: bounded LRU (EMBEDDING_CACHE_SIZE entries) of immutable tuples;
+  lookups return a fresh list, so callers may modify what they get
+- Disk tier (optional): SQLite file at EMBEDDING_CACHE_PATH, survives restarts.
+  The async path (`aget_many` / `aput_many`, used by `aget_embeddings`) runs
+  disk lookups and writes in a worker thread, with one query per lookup batch
+  and one transaction per write batch, so the event loop never waits on SQLite.
+"""
+
+import os
+import array
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from agent.cache import LRUCache
+
+# --- Configuration ---
+EMBEDDING_CACHE_ENABLED = os.environ.get("EMBEDDING_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+# Empty disables the disk tier, e.g. set to ./database/embedding_cache.sqlite
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "")
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text before hashing: NFC unicode form and collapsed whitespace."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model: str, text: str) -> Tuple[str, str]:
+    """Cache key for an embedding: (model, sha256 of the normalized text)."""
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return model, digest
+
+
+class _SQLiteTier:
+    """Persistent tier storing vectors as float32 blobs."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL,"
+                " created_at REAL NOT NULL, PRIMARY KEY (model, text_hash))"
+            )
+            self._conn.commit()
+
+    def get(self, key: Tuple[str, str]) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE model = ? AND text_hash = ?", key
+            ).fetchone()
+        if row is None:
+            return None
+        return array.array("f", row[0]).tolist()
+
+    def get_many(self, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], List[float]]:
+        """Vectors found for `keys`, with one query per model and 500 keys."""
+        by_model: Dict[str, List[str]] = {}
+        for model, text_hash in keys:
+            by_model.setdefault(model, []).append(text_hash)
+        found: Dict[Tuple[str, str], List[float]] = {}
+        with self._lock:
+            for model, hashes in by_model.items():
+                for start in range(0, len(hashes), 500):
+                    chunk = hashes[start:start + 500]
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                        f"AND text_hash IN ({','.join('?' for _ in chunk)})",
+                        (model, *chunk),
+                    ).fetchall()
+                    for text_hash, blob in rows:
+                        found[(model, text_hash)] = array.array("f", blob).tolist()
+        return found
+
+    def put(self, key: Tuple[str, str], embedding: Iterable[float]) -> None:
+        self.put_many([(key, embedding)])
+
+    def put_many(self, items: List[Tuple[Tuple[str, str], Iterable[float]]]) -> None:
+        """Write all `items` in one transaction."""
+        now = time.time()
+        rows = [(key[0], key[1], array.array("f", embedding).tobytes(), now) for key, embedding in items]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, created_at) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class EmbeddingCache:
+    """Two-tier (memory LRU + optional SQLite) embedding cache with hit/miss counters."""
+
+    def __init__(self, maxsize: int = EMBEDDING_CACHE_SIZE, path: str = "", enabled: bool = True):
+        self.enabled = enabled
+        self._memory = LRUCache(maxsize)
+        self._disk: Optional[_SQLiteTier] = None
+        if enabled and path:
+            try:
+                self._disk = _SQLiteTier(path)
+                logger.info(f"Embedding cache disk tier at {os.path.abspath(path)}")
+            except Exception as e:
+                logger.error(f"Could not open embedding cache at {path}, using memory only: {e}")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Return a copy of the cached embedding for (model, text), or None (blocking disk lookup)."""
+        if not self.enabled:
+            return None
+        key = cache_key(model, text)
+        embedding = self._memory.get(key)
+        if embedding is not None:
+            self.memory_hits += 1
+            return list(embedding)
+        if self._disk is not None:
+            try:
+                embedding = self._disk.get(key)
+            except Exception as e:
+                logger.warning(f"Embedding cache disk lookup failed: {e}")
+                embedding = None
+            if embedding is not None:
+                self.disk_hits += 1
+                self._memory.set(key, tuple(embedding))
+                return embedding
+        self.misses += 1
+        return None
+
+    async def aget_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Copies of the cached embeddings for `texts` (None for misses); the disk tier is read in a thread."""
+        if not self.enabled:
+            return [None] * len(texts)
+        results: List[Optional[List[float]]] = []
+        missing: Dict[Tuple[str, str], List[int]] = {}
+        for i, text in enumerate(texts):
+            key = cache_key(model, text)
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self.memory_hits += 1
+                results.append(list(embedding))
+            else:
+                results.append(None)
+                missing.setdefault(key, []).append(i)
+        if missing and self._disk is not None:
+            try:
+                found = await asyncio.to_thread(self._disk.get_many, list(missing))
+            except Exception as e:
+                logger.warning(f"Embedding cache disk lookup failed: {e}")
+                found = {}
+            for key, embedding in found.items():
+                self._memory.set(key, tuple(embedding))
+                for i in missing.pop(key):
+                    self.disk_hits += 1
+                    results[i] = list(embedding)
+        self.misses += sum(len(positions) for positions in missing.values())
+        return results
+
+    def put(self, model: str, text: str, embedding: List[float]) -> None:
+        """Store an embedding in both tiers (blocking disk write)."""
+        if not self.enabled:
+            return
+        key = cache_key(model, text)
+        self._memory.set(key, tuple(embedding))
+        if self._disk is not None:
+            try:
+                self._disk.put(key, embedding)
+            except Exception as e:
+                logger.warning(f"Embedding cache disk write failed: {e}")
+
+    async def aput_many(self, model: str, embeddings: Dict[str, List[float]]) -> None:
+        """Store text -> embedding pairs in both tiers; the disk write is one transaction in a thread."""
+        if not self.enabled or not embeddings:
+            return
+        items = [(cache_key(model, text), tuple(embedding)) for text, embedding in embeddings.items()]
+        for key, embedding in items:
+            self._memory.set(key, embedding)
+        if self._disk is not None:
+            try:
+                await asyncio.to_thread(self._disk.put_many, items)
+            except Exception as e:
+                logger.warning(f"Embedding cache disk write failed: {e}")
+
+    def clear(self, disk: bool = False) -> None:
+        """Drop the memory tier (and the disk tier if `disk` is True); counters are reset."""
+        self._memory.clear()
+        if disk and self._disk is not None:
+            self._disk.clear()
+        self.memory_hits = self.disk_hits = self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "memory_size": len(self._memory),
+            "memory_maxsize": self._memory.maxsize,
+            "disk_enabled": self._disk is not None,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+# Process-wide instance used by agent.ollama_client
+embedding_cache = EmbeddingCache(
+    maxsize=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH, enabled=EMBEDDING_CACHE_ENABLED
+)
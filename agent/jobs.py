@@ -0,0 +1,504 @@
+"""
+Durable background job queue for the Mai-Sale chat application.
+
+Jobs are rows in the application database (SQLite in dev, Postgres in prod), so
+they survive restarts and can be processed by worker processes that scale
+independently of the API (`python -m agent.worker`).
+
+- `enqueue` is idempotent: a job whose `idempotency_key` already exists is not
+  added again (e.g. `embed:{message_id}`).
+- Workers claim jobs with a conditional UPDATE (pending -> running), so a job is
+  only run by one worker even with several worker processes.
+- Failed jobs are retried with exponential backoff; after `max_attempts` they
+  are moved to the `dead_letter_jobs` table.
+- Jobs left `running` by a crashed worker are re-queued after JOB_LOCK_TIMEOUT
+  (checked by every worker at least every JOB_LOCK_TIMEOUT / 2); the lost run
+  counts as an attempt, so a job that crashes its worker is dead-lettered too.
+
+Handlers are registered per job kind with `@register_handler("kind")` and
+receive the decoded JSON payload. A kind registered with its own
+`concurrency` runs in dedicated slots next to the worker's `concurrency`
+(e.g. `embed_message`, whose jobs are micro-batched and need many in flight
+at once to fill a batch).
+"""
+
+import os
+import json
+import uuid
+import time
+import socket
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from sqlalchemy import String, Text, DateTime, Integer, Index, Uuid, event, select, update, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, mapped_column
+
+from agent.database import Base, async_session, utcnow
+
+# --- Configuration ---
+JOB_WORKER_CONCURRENCY = int(os.environ.get("JOB_WORKER_CONCURRENCY", 2))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 0.5))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_BACKOFF_BASE = float(os.environ.get("JOB_BACKOFF_BASE", 2.0))  # seconds; doubles per attempt
+JOB_BACKOFF_MAX = float(os.environ.get("JOB_BACKOFF_MAX", 300.0))
+JOB_LOCK_TIMEOUT = float(os.environ.get("JOB_LOCK_TIMEOUT", 600.0))  # seconds before a 'running' job is re-queued
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+# --- Data Models ---
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_status_available_at", "status", "available_at"),)
+
+    id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
+    kind: Mapped[str] = mapped_column(String(50))
+    idempotency_key: Mapped[str] = mapped_column(String(255), unique=True)
+    payload: Mapped[str] = mapped_column(Text)  # JSON
+    status: Mapped[str] = mapped_column(String(20), default=PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer, default=JOB_MAX_ATTEMPTS)
+    available_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+    locked_by: Mapped[Optional[str]] = mapped_column(String(255))
+    locked_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    last_error: Mapped[Optional[str]] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow, onupdate=utcnow)
+
+    def __repr__(self) -> str:
+        return f"<Job(id={self.id}, kind='{self.kind}', status='{self.status}', attempts={self.attempts})>"
+
+
+class DeadLetter(Base):
+    __tablename__ = "dead_letter_jobs"
+
+    id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
+    job_id: Mapped[uuid.UUID] = mapped_column(Uuid, index=True)
+    kind: Mapped[str] = mapped_column(String(50))
+    idempotency_key: Mapped[str] = mapped_column(String(255))
+    payload: Mapped[str] = mapped_column(Text)
+    attempts: Mapped[int] = mapped_column(Integer)
+    error: Mapped[Optional[str]] = mapped_column(Text)
+    failed_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+
+    def __repr__(self) -> str:
+        return f"<DeadLetter(job_id={self.job_id}, kind='{self.kind}')>"
+
+
+# --- Handlers ---
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+HANDLERS: Dict[str, JobHandler] = {}
+# Kinds with dedicated slots: kind -> jobs of that kind a worker runs at once
+HANDLER_CONCURRENCY: Dict[str, int] = {}
+
+
+def register_handler(kind: str, concurrency: Optional[int] = None) -> Callable[[JobHandler], JobHandler]:
+    """
+    Decorator registering the coroutine that processes jobs of `kind`.
+
+    Args:
+        kind (str): Job kind.
+        concurrency (Optional[int]): Run up to this many jobs of `kind` at once in their
+            own slots, not counted against the worker's `concurrency`.
+    """
+    def decorator(fn: JobHandler) -> JobHandler:
+        HANDLERS[kind] = fn
+        if concurrency is not None:
+            HANDLER_CONCURRENCY[kind] = concurrency
+        else:
+            HANDLER_CONCURRENCY.pop(kind, None)
+        return fn
+    return decorator
+
+
+def backoff_delay(attempts: int) -> float:
+    """Seconds to wait before retry number `attempts` (1-based)."""
+    return min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+
+
+# Workers running in this process, woken up on enqueue instead of waiting for the next poll
+_local_workers: Set["JobWorker"] = set()
+
+
+# --- Queue Operations ---
+async def enqueue(
+    kind: str,
+    payload: Dict[str, Any],
+    idempotency_key: Optional[str] = None,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+    session: Optional[AsyncSession] = None,
+) -> bool:
+    """
+    Add a job to the queue.
+
+    Args:
+        kind (str): Job kind; must have a registered handler in the worker.
+        payload (Dict[str, Any]): JSON-serializable arguments for the handler.
+        idempotency_key (Optional[str]): Jobs with an existing key are not added again.
+            Defaults to a random key.
+        max_attempts (int): Attempts before the job is dead-lettered.
+        session (Optional[AsyncSession]): Add the job to this session (committed by the
+            caller, e.g. together with the message it belongs to) instead of committing
+            in a new one.
+
+    Returns:
+        bool: True if the job was added, False if the key already existed.
+    """
+    key = idempotency_key or f"{kind}:{uuid.uuid4()}"
+    job = Job(kind=kind, idempotency_key=key, payload=json.dumps(payload), max_attempts=max_attempts)
+
+    if session is not None:
+        exists = await session.scalar(select(Job.id).where(Job.idempotency_key == key))
+        if exists:
+            return False
+        session.add(job)
+        # The job is only visible to workers once the caller commits
+        if not session.info.get("wake_job_workers"):
+            session.info["wake_job_workers"] = True
+            event.listen(session.sync_session, "after_commit", _wake_after_commit, once=True)
+        return True
+
+    async with async_session() as own_session:
+        own_session.add(job)
+        try:
+            await own_session.commit()
+        except IntegrityError:
+            logger.info(f"Job '{key}' already enqueued, skipping")
+            return False
+    _wake_local_workers()
+    return True
+
+
+def _wake_after_commit(session) -> None:
+    session.info.pop("wake_job_workers", None)
+    _wake_local_workers()
+
+
+def _wake_local_workers() -> None:
+    for worker in list(_local_workers):
+        worker.wake()
+
+
+async def claim_jobs(
+    worker_id: str, limit: int, kinds: Optional[List[str]] = None, exclude_kinds: Optional[List[str]] = None
+) -> List[Job]:
+    """Atomically move up to `limit` due pending jobs (of `kinds`, not of `exclude_kinds`) to running for `worker_id`."""
+    now = utcnow()
+    async with async_session() as session:
+        stmt = (
+            select(Job.id)
+            .where(Job.status == PENDING, Job.available_at <= now)
+            .order_by(Job.available_at)
+            .limit(limit)
+        )
+        if kinds:
+            stmt = stmt.where(Job.kind.in_(kinds))
+        if exclude_kinds:
+            stmt = stmt.where(Job.kind.not_in(exclude_kinds))
+        candidates = list((await session.execute(stmt)).scalars().all())
+
+        claimed_ids = []
+        for job_id in candidates:
+            # Conditional update: only one worker wins each job
+            result = await session.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == PENDING)
+                .values(status=RUNNING, locked_by=worker_id, locked_at=now, updated_at=now)
+            )
+            if result.rowcount == 1:
+                claimed_ids.append(job_id)
+        await session.commit()
+
+        if not claimed_ids:
+            return []
+        result = await session.execute(select(Job).where(Job.id.in_(claimed_ids)))
+        return list(result.scalars().all())
+
+
+async def complete_job(job: Job) -> None:
+    """Mark a job as done (the row is kept so its idempotency key stays taken)."""
+    async with async_session() as session:
+        await session.execute(
+            update(Job)
+            .where(Job.id == job.id)
+            .values(status=DONE, attempts=job.attempts + 1, locked_by=None, locked_at=None, last_error=None)
+        )
+        await session.commit()
+
+
+async def fail_job(job: Job, error: str) -> bool:
+    """
+    Record a failed attempt: schedule a retry with backoff, or dead-letter the job.
+
+    Returns:
+        bool: True if the job will be retried, False if it was dead-lettered.
+    """
+    attempts = job.attempts + 1
+    now = utcnow()
+    async with async_session() as session:
+        if attempts < job.max_attempts:
+            delay = backoff_delay(attempts)
+            await session.execute(
+                update(Job)
+                .where(Job.id == job.id)
+                .values(
+                    status=PENDING,
+                    attempts=attempts,
+                    available_at=now + timedelta(seconds=delay),
+                    locked_by=None,
+                    locked_at=None,
+                    last_error=error,
+                )
+            )
+            await session.commit()
+            logger.warning(f"Job {job.kind} '{job.idempotency_key}' failed (attempt {attempts}), retrying in {delay:.1f}s: {error}")
+            return True
+
+        await session.execute(
+            update(Job)
+            .where(Job.id == job.id)
+            .values(status=DEAD, attempts=attempts, locked_by=None, locked_at=None, last_error=error)
+        )
+        session.add(DeadLetter(
+            job_id=job.id,
+            kind=job.kind,
+            idempotency_key=job.idempotency_key,
+            payload=job.payload,
+            attempts=attempts,
+            error=error,
+        ))
+        await session.commit()
+    logger.error(f"Job {job.kind} '{job.idempotency_key}' moved to dead-letter after {attempts} attempts: {error}")
+    return False
+
+
+async def release_job(job: Job) -> None:
+    """Put a claimed job back to pending without counting an attempt (e.g. on shutdown)."""
+    async with async_session() as session:
+        await session.execute(
+            update(Job).where(Job.id == job.id, Job.status == RUNNING).values(status=PENDING, locked_by=None, locked_at=None)
+        )
+        await session.commit()
+
+
+async def requeue_stale_jobs(lock_timeout: float = JOB_LOCK_TIMEOUT) -> int:
+    """
+    Re-queue jobs left running by a worker that died, counting the lost run as an attempt.
+
+    A job that keeps taking its worker down (so it never reaches `fail_job`) is
+    dead-lettered once its attempts reach `max_attempts`, like any failing job.
+
+    Returns:
+        int: Number of stale jobs re-queued or dead-lettered.
+    """
+    now = utcnow()
+    cutoff = now - timedelta(seconds=lock_timeout)
+    error = f"Lock expired after {lock_timeout:.0f}s (worker died or hung)"
+    requeued, dead = 0, []
+    async with async_session() as session:
+        stale = list((await session.scalars(select(Job).where(Job.status == RUNNING, Job.locked_at < cutoff))).all())
+        for job in stale:
+            attempts = job.attempts + 1
+            exhausted = attempts >= job.max_attempts
+            # Conditional update: another worker may handle the same stale job concurrently
+            result = await session.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.status == RUNNING, Job.locked_at == job.locked_at)
+                .values(
+                    status=DEAD if exhausted else PENDING,
+                    attempts=attempts,
+                    available_at=now,
+                    locked_by=None,
+                    locked_at=None,
+                    last_error=error,
+                    updated_at=now,
+                )
+            )
+            if result.rowcount != 1:
+                continue
+            if not exhausted:
+                requeued += 1
+                continue
+            session.add(DeadLetter(
+                job_id=job.id,
+                kind=job.kind,
+                idempotency_key=job.idempotency_key,
+                payload=job.payload,
+                attempts=attempts,
+                error=error,
+            ))
+            dead.append(job)
+        await session.commit()
+    if requeued:
+        logger.warning(f"Re-queued {requeued} stale running jobs")
+    for job in dead:
+        logger.error(f"Job {job.kind} '{job.idempotency_key}' moved to dead-letter after {job.attempts + 1} attempts: {error}")
+    return requeued + len(dead)
+
+
+async def queue_stats() -> Dict[str, Any]:
+    """Queue length per status, dead-letter count and age of the oldest due job."""
+    async with async_session() as session:
+        rows = await session.execute(select(Job.status, func.count()).group_by(Job.status))
+        counts = {status: count for status, count in rows.all()}
+        dead_letters = await session.scalar(select(func.count()).select_from(DeadLetter))
+        oldest = await session.scalar(
+            select(func.min(Job.available_at)).where(Job.status == PENDING, Job.available_at <= utcnow())
+        )
+    return {
+        "pending": counts.get(PENDING, 0),
+        "running": counts.get(RUNNING, 0),
+        "done": counts.get(DONE, 0),
+        "dead": counts.get(DEAD, 0),
+        "dead_letters": dead_letters or 0,
+        "oldest_pending_seconds": (utcnow() - oldest).total_seconds() if oldest else 0.0,
+    }
+
+
+# --- Worker ---
+class JobWorker:
+    """
+    Polls the job table and runs up to `concurrency` jobs at a time.
+
+    Run with `await worker.run()` and stop with `await worker.stop()`, which
+    waits for in-flight jobs (up to a timeout) and releases the rest.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = JOB_WORKER_CONCURRENCY,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        kinds: Optional[List[str]] = None,
+        worker_id: Optional[str] = None,
+        lock_timeout: float = JOB_LOCK_TIMEOUT,
+    ):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self.kinds = kinds
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._in_flight: Dict[asyncio.Task, Job] = {}
+        self._stopping: Optional[asyncio.Event] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._next_requeue = 0.0
+        self.processed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_once(self) -> int:
+        """Claim jobs for the free slots and start them; returns how many were started."""
+        running = Counter(job.kind for job in self._in_flight.values())
+        dedicated = {
+            kind: limit for kind, limit in HANDLER_CONCURRENCY.items()
+            if self.kinds is None or kind in self.kinds
+        }
+        started = 0
+        for kind, limit in dedicated.items():
+            free = limit - running[kind]
+            if free > 0:
+                started += self._start(await claim_jobs(self.worker_id, free, [kind]))
+        if self.kinds is not None and all(kind in dedicated for kind in self.kinds):
+            return started
+        free = self.concurrency - sum(n for kind, n in running.items() if kind not in dedicated)
+        if free > 0:
+            started += self._start(await claim_jobs(self.worker_id, free, self.kinds, exclude_kinds=list(dedicated)))
+        return started
+
+    def _start(self, jobs: List[Job]) -> int:
+        for job in jobs:
+            task = asyncio.create_task(self._execute(job))
+            self._in_flight[task] = job
+            task.add_done_callback(self._on_done)
+        return len(jobs)
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        self._in_flight.pop(task, None)
+        self.wake()  # a slot is free
+
+    async def _execute(self, job: Job) -> None:
+        handler = HANDLERS.get(job.kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{job.kind}'")
+            await handler(json.loads(job.payload))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if await fail_job(job, f"{type(e).__name__}: {e}"):
+                self.retried += 1
+            else:
+                self.dead_lettered += 1
+            return
+        await complete_job(job)
+        self.processed += 1
+
+    async def run(self) -> None:
+        """Process jobs until `stop()` is called."""
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        _local_workers.add(self)
+        logger.info(f"Job worker {self.worker_id} started (concurrency={self.concurrency})")
+        try:
+            while not self._stopping.is_set():
+                self._wakeup.clear()
+                try:
+                    await self._requeue_stale_jobs()
+                    await self.run_once()
+                except Exception as e:
+                    logger.error(f"Job worker {self.worker_id}: polling failed: {e}", exc_info=True)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            _local_workers.discard(self)
+
+    async def _requeue_stale_jobs(self) -> None:
+        # On start and then every lock_timeout / 2, so jobs of a crashed worker do not wait for a restart
+        now = time.monotonic()
+        if now < self._next_requeue:
+            return
+        self._next_requeue = now + self.lock_timeout / 2
+        await requeue_stale_jobs(self.lock_timeout)
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Stop polling, wait for in-flight jobs, and release those still running."""
+        if self._stopping is not None:
+            self._stopping.set()
+            self.wake()
+        pending = list(self._in_flight.items())
+        if not pending:
+            return
+        done, not_done = await asyncio.wait([task for task, _ in pending], timeout=timeout)
+        for task in not_done:
+            task.cancel()
+        for task, job in pending:
+            if task in not_done:
+                await release_job(job)
+        logger.info(f"Job worker {self.worker_id} stopped ({len(done)} drained, {len(not_done)} released)")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "concurrency": self.concurrency,
+            "dedicated_concurrency": dict(HANDLER_CONCURRENCY),
+            "in_flight": len(self._in_flight),
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+        }
@@ -0,0 +1,160 @@
+"""
+Per-conversation Ollama continuation state for the Mai-Sale chat application.
+
+Ollama's /api/generate returns a `context` token array covering the prompt and
+the reply. Sending it back with the next request lets the server continue from
+there, so only the new user message has to be prefilled instead of the whole
+conversation.
+
+Entries live in an LRU keyed by conversation_id. Contexts are stored as
+`array('i')` (4 bytes per token instead of a boxed int each) and the cache is
+bounded by the total number of tokens held, OLLAMA_CONTEXT_CACHE_TOKENS, so
+memory stays bounded however long the contexts are. An entry is only used
+when it still matches the conversation: same model, and the history ends with
+[covered user message, the reply we generated, new user message]. Anything
+else (eviction, model switch, edited/extra messages, context too long) falls
+back to a full prompt.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from agent.prompting import message_key
+
+# --- Configuration ---
+OLLAMA_CONTEXT_REUSE = os.environ.get("OLLAMA_CONTEXT_REUSE", "true").lower() in ("1", "true", "yes")
+# Total context tokens kept across all conversations (4 bytes each)
+OLLAMA_CONTEXT_CACHE_TOKENS = int(os.environ.get("OLLAMA_CONTEXT_CACHE_TOKENS", 2_000_000))
+# Contexts longer than this are dropped so the next turn re-prefills a budgeted prompt
+OLLAMA_CONTEXT_MAX_TOKENS = int(os.environ.get("OLLAMA_CONTEXT_MAX_TOKENS", 8192))
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ConversationContext:
+    model: str
+    tokens: array  # array('i') of context token ids
+    user_message_key: str  # the user message this context ends with
+    response_hash: str     # hash of the reply generated from it
+
+
+def _hash_text(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _fields(msg: Any) -> Dict[str, Any]:
+    if isinstance(msg, dict):
+        return msg
+    return {"role": getattr(msg, "role", None), "content": getattr(msg, "content", ""), "id": getattr(msg, "id", None)}
+
+
+class ContextCache:
+    """LRU of Ollama continuation contexts keyed by conversation_id, bounded by total tokens."""
+
+    def __init__(self, max_total_tokens: int = OLLAMA_CONTEXT_CACHE_TOKENS, max_tokens: int = OLLAMA_CONTEXT_MAX_TOKENS):
+        self._entries: "OrderedDict[str, ConversationContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_total_tokens = max_total_tokens
+        self.max_tokens = max_tokens
+        self.total_tokens = 0
+        self.evictions = 0
+        self.reused = 0
+        self.stale = 0
+        self.too_long = 0
+
+    def get_continuation(self, conversation_id: Optional[str], model: str, chat_history: List[Any]) -> Optional[List[int]]:
+        """
+        Return the context to continue from, or None if a full prompt must be sent.
+
+        Stale entries (model switch, history no longer ending with our reply +
+        one new user message) are dropped.
+        """
+        if not conversation_id or len(chat_history) < 3:
+            return None
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                self._entries.move_to_end(conversation_id)
+        if entry is None:
+            return None
+
+        covered, reply, latest = (_fields(m) for m in chat_history[-3:])
+        valid = (
+            entry.model == model
+            and latest.get("role") == "user"
+            and reply.get("role") == "assistant"
+            and _hash_text(reply.get("content") or "") == entry.response_hash
+            and covered.get("role") == "user"
+            and message_key(covered.get("role") or "user", covered.get("content") or "", covered.get("id")) == entry.user_message_key
+        )
+        if not valid:
+            self.stale += 1
+            self.invalidate(conversation_id)
+            logger.info(f"Dropping stale Ollama context for conversation {conversation_id}")
+            return None
+        self.reused += 1
+        return entry.tokens.tolist()
+
+    def store(self, conversation_id: Optional[str], model: str, chat_history: List[Any], response: str, tokens: List[int]) -> None:
+        """Remember the context returned for the reply to the latest user message."""
+        if not conversation_id or not chat_history or not response or not tokens:
+            return
+        latest = _fields(chat_history[-1])
+        if latest.get("role") != "user":
+            return
+        if len(tokens) > min(self.max_tokens, self.max_total_tokens):
+            self.too_long += 1
+            self.invalidate(conversation_id)
+            return
+        entry = ConversationContext(
+            model=model,
+            tokens=array("i", tokens),
+            user_message_key=message_key("user", latest.get("content") or "", latest.get("id")),
+            response_hash=_hash_text(response),
+        )
+        with self._lock:
+            self._discard(conversation_id)
+            self._entries[conversation_id] = entry
+            self.total_tokens += len(entry.tokens)
+            # Evict least recently used contexts until the token total fits
+            while self.total_tokens > self.max_total_tokens:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _discard(self, conversation_id: str) -> None:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.total_tokens -= len(entry.tokens)
+
+    def invalidate(self, conversation_id: str) -> None:
+        with self._lock:
+            self._discard(conversation_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.total_tokens = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": OLLAMA_CONTEXT_REUSE,
+            "conversations": len(self._entries),
+            "tokens": self.total_tokens,
+            "max_tokens": self.max_total_tokens,
+            "reused": self.reused,
+            "stale": self.stale,
+            "too_long": self.too_long,
+            "evictions": self.evictions,
+        }
+
+
+# Process-wide instance used by the respond nodes
+context_cache = ContextCache()
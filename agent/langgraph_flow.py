@@ -5,32 +5,70 @@ This module defines the basic LangGraph flow with three nodes:
 - classify: Determine if retrieval is needed
 - retrieve: Query ChromaDB for context
 - respond: Build prompt and generate response using LLM
+
+Flows are compiled once per process and looked up with `get_flow(name)`;
+`init_flows()` is called from the FastAPI startup hook.
 """
 
-from typing import Annotated, List, Dict, Any, Optional, Generator, AsyncGenerator
+from typing import List, Dict, Any, Optional, Callable, Tuple
 from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, END
-from langgraph.graph.message import add_messages
-from langchain_core.messages import HumanMessage, AIMessage
+from langgraph.config import get_stream_writer
+from langchain_core.runnables import RunnableConfig
+from langchain_core.messages import HumanMessage
 from pydantic import BaseModel, Field
-import uuid
+import os
+import re
+import asyncio
 import logging
 from agent.database import get_messages_history
-from agent.retriever import query_vectors, simple_rerank
-from agent.ollama_client import generate_text, generate_text_stream
+from agent.retriever import (
+    aquery_vectors,
+    alexical_query,
+    rerank_select,
+    knowledge_collection_name,
+    MEMORY_COLLECTION_NAME,
+    DEFAULT_TENANT,
+    RETRIEVAL_CANDIDATES,
+    RERANK_MMR_LAMBDA,
+)
+from agent.lexical import lexical_index, LEXICAL_ENABLED, LEXICAL_EXACT_SHORTCUT
+from agent.ollama_client import agenerate_text, aget_embeddings, generate_text_stream, DEFAULT_GENERATE_MODEL
+from agent.prompting import assemble_prompt, assemble_continuation_prompt, PROMPT_TOKEN_BUDGET
+from agent.kv_context import context_cache, OLLAMA_CONTEXT_REUSE
+from agent.response_cache import (
+    response_cache,
+    context_fingerprint,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_MIN_CHARS,
+)
 
 logger = logging.getLogger(__name__)
 
+# --- Configuration ---
+GENERATE_MODEL = DEFAULT_GENERATE_MODEL
+
+# Comma-separated flow names (see FLOW_BUILDERS) that run retrieval speculatively
+# in parallel with classification, e.g. "chat_stream" or "chat,chat_stream".
+SPECULATIVE_RETRIEVAL_FLOWS = {
+    name.strip() for name in os.environ.get("SPECULATIVE_RETRIEVAL_FLOWS", "").split(",") if name.strip()
+}
+
 # --- State ---
 class AgentState(TypedDict):
     """State for the LangGraph agent."""
     conversation_id: str
     user_id: str
-    chat_history: Annotated[List[Dict[str, Any]], add_messages]  # List of message dicts with 'role' and 'content'
+    chat_history: List[Dict[str, Any]]  # List of message dicts with 'role', 'content' and optional stored 'tokens'
     metadata: Dict[str, Any]  # Additional metadata
+    need_retrieval: bool  # Set by the classify node
     retrieved_context: Optional[List[Dict[str, Any]]]  # Retrieved context from ChromaDB
     response: Optional[str]  # Final response from the LLM
     stream: bool
+    cache_hit: bool  # Set by the response_cache node
+    query_embedding: Optional[List[float]]  # Embedding of the latest user message (response cache)
+    summary: Optional[str]  # Rolling summary of the turns before chat_history (agent.summaries)
+    raise_errors: bool  # Job path: let generation errors propagate so the job queue retries
 
 
 async def classify_node(state: AgentState) -> Dict[str, Any]:
@@ -57,90 +95,225 @@ async def classify_node(state: AgentState) -> Dict[str, Any]:
     return {"need_retrieval": need_retrieval}
 
 
-def build_prompt(state: AgentState) -> str:
-    """Build a simple prompt from chat history and retrieved context."""
-    parts = []
-    # include retrieved context first if present
-    rc = state.get("retrieved_context") or []
-    if rc:
-        parts.append("Retrieved context:")
-        for d in rc:
-            parts.append(d.get("text") or d.get("content") or str(d))
+def build_prompt(state: AgentState, token_budget: Optional[int] = None) -> str:
+    """
+    Build the prompt from chat history and retrieved context within a token budget.
 
-    # Instruction: ask the model to be concise. This ensures both streaming and
-    # non-streaming nodes produce short answers (approx ~5 sentences).
-    parts.append("Instruction: Provide a concise answer in about 5 sentences. Be clear, direct, and avoid unnecessary details.")
+    Uses the conversation summary (if the state has one) plus the most recent
+    turns and the best-scored retrieved chunks that fit; see agent.prompting
+    for the budgeting rules.
+    """
+    return assemble_prompt(
+        state.get("chat_history", []),
+        state.get("retrieved_context") or [],
+        conversation_id=state.get("conversation_id"),
+        token_budget=token_budget or PROMPT_TOKEN_BUDGET,
+        summary=state.get("summary"),
+    )
 
-    parts.append("Conversation:")
-    for msg in state.get("chat_history", []):
-        role = msg.get("role") if isinstance(msg, dict) else getattr(msg, "role", "user")
-        content = msg.get("content") if isinstance(msg, dict) else getattr(msg, "content", "")
-        parts.append(f"{role}: {content}")
 
-    parts.append("Assistant:")
-    return "\n".join(parts)
+# --- Nodes ---
+def latest_user_message(chat_history: List[Any]) -> Optional[str]:
+    """Content of the latest user message in the history, if any."""
+    for msg in reversed(chat_history or []):
+        # Check if it's a HumanMessage or dict with role 'user'
+        if isinstance(msg, HumanMessage):
+            return msg.content
+        if isinstance(msg, dict) and msg.get("role") == "user":
+            return msg.get("content")
+    return None
+
+
+async def retrieve_context(query_text: str, metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Query knowledge and conversation memory for `query_text` and re-rank the merged results.
+
+    Two scoped searches run concurrently: the (per-tenant or global) knowledge
+    collection without filters, and the memory collection filtered to this
+    conversation/user. Both use the same query embedding (one request, shared
+    through the embedding cache/singleflight); failures in one scope only
+    drop that scope's results.
+    """
+    # Memory is filtered by conversation_id and user_id; without either there is no memory scope
+    filter_metadata = {}
+    if "conversation_id" in metadata:
+        filter_metadata["conversation_id"] = metadata["conversation_id"]
+    if "user_id" in metadata:
+        filter_metadata["user_id"] = metadata["user_id"]
+
+    scopes: List[Tuple[str, Optional[Dict[str, Any]]]] = [(knowledge_collection_name(metadata.get("tenant_id")), None)]
+    if filter_metadata:
+        scopes.append((MEMORY_COLLECTION_NAME, filter_metadata))
+
+    # Over-fetch candidates; rerank_select picks the final K within the token budget
+    lexical_results = None
+    if LEXICAL_ENABLED:
+        # Hybrid: BM25 first (cheap, no embedding); identifier queries it fully
+        # answers ("Tensor G5") skip the embedding + vector search entirely.
+        lexical_lists = await _gather_scopes(
+            [alexical_query(query_text, name, RETRIEVAL_CANDIDATES, where) for name, where in scopes], scopes
+        )
+        lexical_results = [r for results in lexical_lists for r in results]
+        exact = LEXICAL_EXACT_SHORTCUT and any(
+            results and lexical_index.is_exact_match(query_text, results) for results in lexical_lists
+        )
+    else:
+        exact = False
+
+    if exact:
+        logger.info(f"Retrieve: exact lexical match for '{query_text}', skipping vector search")
+        results = []
+    else:
+        vector_lists = await _gather_scopes(
+            [
+                aquery_vectors(
+                    query_text=query_text,
+                    collection_name=name,
+                    top_k=RETRIEVAL_CANDIDATES,
+                    filter_metadata=where,
+                    include_embeddings=RERANK_MMR_LAMBDA is not None,
+                )
+                for name, where in scopes
+            ],
+            scopes,
+        )
+        results = [r for scope_results in vector_lists for r in scope_results]
+    # Memory is already scoped to this conversation, so only freshness (not the
+    # same-conversation boost) should decide between memory and knowledge
+    return rerank_select(results, query_metadata=None, lexical_results=lexical_results)
+
+
+async def _gather_scopes(
+    queries: List[Any], scopes: List[Tuple[str, Optional[Dict[str, Any]]]]
+) -> List[List[Dict[str, Any]]]:
+    """Await the per-scope queries concurrently; a failed scope contributes no results."""
+    outcomes = await asyncio.gather(*queries, return_exceptions=True)
+    results = []
+    for (name, _), outcome in zip(scopes, outcomes):
+        if isinstance(outcome, BaseException):
+            logger.error(f"Retrieve: query on collection '{name}' failed: {outcome}")
+            outcome = []
+        results.append(outcome)
+    return results
 
 
-# --- Nodes ---
 async def retrieve_node(state: AgentState) -> Dict[str, Any]:
     """
     Retrieve node: Query ChromaDB for context based on the user's latest message.
     """
     logger.info("Retrieve node: Querying ChromaDB for context")
     
-    # Get the latest user message
-    user_message = None
-    for msg in reversed(state["chat_history"]):
-        # Check if it's a HumanMessage or dict with role 'user'
-        if isinstance(msg, HumanMessage) or (isinstance(msg, dict) and msg.get("role") == "user"):
-            user_message = msg
-            break
-            
-    if not user_message:
+    query_text = latest_user_message(state["chat_history"])
+    if not query_text:
         logger.warning("Retrieve node: No user message found in chat history")
-        state["retrieved_context"] = []
-        # Return the expected node output shape
-        return {"documents": [], "user_message": None}
+        return {"retrieved_context": []}
         
-    # Query ChromaDB
     # Prepare a safe default so we always have the variable defined
     reranked_results = []
     try:
-        # Get content from message (handle both dict and object)
-        if isinstance(user_message, dict):
-            query_text = user_message["content"]
-        else:
-            query_text = user_message.content
-            
-        # Filter by conversation_id and user_id if available in metadata
-        filter_metadata = {}
-        if "conversation_id" in state["metadata"]:
-            filter_metadata["conversation_id"] = state["metadata"]["conversation_id"]
-        if "user_id" in state["metadata"]:
-            filter_metadata["user_id"] = state["metadata"]["user_id"]
-            
-        results = query_vectors(
-            query_text=query_text,
-            collection_name="conversations_dev",  # Use default collection for now
-            top_k=3,
-            filter_metadata=filter_metadata or None
-        )
-        
-        # Re-rank results
-        reranked_results = simple_rerank(results, query_metadata=state["metadata"])
-        
-        # Store in state
-        state["retrieved_context"] = reranked_results
+        reranked_results = await retrieve_context(query_text, state["metadata"])
         logger.info(f"Retrieve node: Retrieved and re-ranked {len(reranked_results)} results")
-        
     except Exception as e:
         logger.error(f"Retrieve node: Error querying ChromaDB: {e}")
-        state["retrieved_context"] = []
         
     logger.info("---RETRIEVE NODE FINISHED---")
     # Ensure we return the documents we actually retrieved/re-ranked
-    documents = reranked_results
-    return {"documents": documents, "user_message": user_message}
+    return {"retrieved_context": reranked_results}
+
+
+# --- Speculative retrieval ---
+# Retrieval (embedding + Chroma query) costs far more than the classifier, so a
+# speculative flow starts it as soon as the user message is known and only keeps
+# the result if the classifier asks for retrieval.
+speculation_stats: Dict[str, int] = {"started": 0, "used": 0, "wasted": 0, "failed": 0}
+
+
+def start_speculative_retrieval(query_text: str, metadata: Dict[str, Any]) -> "asyncio.Task[List[Dict[str, Any]]]":
+    """
+    Start retrieval for `query_text` in the background and return its task.
+
+    Callers (e.g. the API, before loading history) pass the task to a speculative
+    flow via `config={"configurable": {"speculative_retrieval": task}}`.
+    """
+    speculation_stats["started"] += 1
+    task = asyncio.ensure_future(retrieve_context(query_text, metadata))
+    # Consume the exception if nobody ends up awaiting the task
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+
+async def classify_speculative_node(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+    """
+    Classify while retrieval runs concurrently; keep the retrieval result only if needed.
+    """
+    task = (config.get("configurable") or {}).get("speculative_retrieval")
+    if task is None:
+        query_text = latest_user_message(state.get("chat_history", []))
+        if query_text:
+            task = start_speculative_retrieval(query_text, state["metadata"])
+
+    classify_out = await classify_node(state)
+    if task is None:
+        return {**classify_out, "retrieved_context": []}
+
+    if not classify_out.get("need_retrieval"):
+        task.cancel()
+        speculation_stats["wasted"] += 1
+        logger.info("Classify node: retrieval not needed, discarded speculative retrieval")
+        return classify_out
+
+    try:
+        retrieved = await task
+        speculation_stats["used"] += 1
+    except Exception as e:
+        speculation_stats["failed"] += 1
+        logger.error(f"Classify node: speculative retrieval failed: {e}")
+        retrieved = []
+    return {**classify_out, "retrieved_context": retrieved}
+
+
+def speculation_config(flow_name: str, user_text: Optional[str], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Start speculative retrieval for `user_text` if the flow is configured for it.
+
+    Called before history is loaded so retrieval overlaps with the DB round-trips
+    and classification. Returns the LangGraph run config carrying the task.
+    """
+    if not user_text or not is_speculative(flow_name):
+        return {}
+    return {"configurable": {"speculative_retrieval": start_speculative_retrieval(user_text, metadata)}}
+
+
+def get_speculation_stats() -> Dict[str, Any]:
+    finished = speculation_stats["used"] + speculation_stats["wasted"]
+    return {
+        **speculation_stats,
+        "waste_rate": speculation_stats["wasted"] / finished if finished else 0.0,
+    }
+
+
+def prepare_generation(state: AgentState) -> Tuple[str, Optional[List[int]]]:
+    """
+    Pick the prompt for this turn.
+
+    If the conversation has a valid cached Ollama context, only this turn's
+    context and user message are sent along with it; otherwise the full
+    budgeted prompt is built.
+    """
+    history = state.get("chat_history", [])
+    context = None
+    if OLLAMA_CONTEXT_REUSE:
+        context = context_cache.get_continuation(state.get("conversation_id"), GENERATE_MODEL, history)
+    if context:
+        logger.info(f"Reusing Ollama context ({len(context)} tokens) for conversation {state.get('conversation_id')}")
+        return assemble_continuation_prompt(history[-1], state.get("retrieved_context") or []), context
+    return build_prompt(state), None
+
+
+def remember_context(state: AgentState, response_text: str, tokens: Optional[List[int]]) -> None:
+    """Store the context Ollama returned so the next turn can continue from it."""
+    if OLLAMA_CONTEXT_REUSE and tokens:
+        context_cache.store(state.get("conversation_id"), GENERATE_MODEL, state.get("chat_history", []), response_text, tokens)
 
 
 async def respond_node(state: AgentState) -> Dict[str, str]:
@@ -148,99 +321,226 @@ async def respond_node(state: AgentState) -> Dict[str, str]:
     Respond node: Build prompt and generate a complete response.
     """
     logger.info("Respond node: Generating complete response")
+    returned_context: Dict[str, List[int]] = {}
     try:
-        prompt = build_prompt(state)
+        prompt, context = prepare_generation(state)
         logger.info(f"Respond node: Built prompt:\n{prompt}")
 
-        response_text = generate_text(prompt, model="gpt-oss")
-        state["response"] = response_text
+        response_text = await agenerate_text(
+            prompt, model=GENERATE_MODEL, context=context,
+            on_context=lambda tokens: returned_context.update(tokens=tokens),
+        )
+        remember_context(state, response_text, returned_context.get("tokens"))
+        remember_answer(state, response_text)
         logger.info("Respond node: Generated response successfully")
 
     except Exception as e:
         logger.error(f"Respond node: Error generating response: {e}")
-        state["response"] = "Sorry, I encountered an error."
-        response_text = state["response"]
+        if state.get("raise_errors"):
+            raise
+        response_text = "Sorry, I encountered an error."
 
     logger.info("---RESPOND NODE FINISHED---")
     return {"response": response_text}
 
 
-async def stream_respond_node(state: AgentState) -> AsyncGenerator[Dict[str, str], None]:
+async def stream_respond_node(state: AgentState) -> Dict[str, str]:
     """
     Generates a response stream from the Ollama client.
+
+    Each chunk is emitted on the graph's "custom" stream as {"response": chunk}
+    (consume with `astream(..., stream_mode="custom")`); the full text is
+    returned as the node's state update.
     """
     logger.info("Stream Respond node: Building prompt and streaming response")
+    write = _get_writer()
+    full_response = ""
+    returned_context: Dict[str, List[int]] = {}
     try:
-        prompt = build_prompt(state)
+        prompt, context = prepare_generation(state)
         logger.info(f"Stream Respond node: Built prompt:\n{prompt}")
         
         # Use the streaming client
-        full_response = ""
-        async for chunk in generate_text_stream(prompt, model="gpt-oss"):
+        async for chunk in generate_text_stream(
+            prompt, model=GENERATE_MODEL, context=context,
+            on_context=lambda tokens: returned_context.update(tokens=tokens),
+        ):
             if chunk:
                 full_response += chunk
-                logger.info(f"Node yielding chunk: '{chunk}'")
-                yield {"response": chunk}
-        
-        # After the loop, LangGraph will have the full response in the state
-        # No explicit return is needed for the final state if done via yielding
+                logger.debug(f"Node emitting chunk: '{chunk}'")
+                write({"response": chunk})
+        remember_context(state, full_response, returned_context.get("tokens"))
+        if not full_response.startswith("[ERROR:"):
+            remember_answer(state, full_response)
         
     except Exception as e:
         logger.error(f"Stream Respond node: Error generating response: {e}", exc_info=True)
-        yield {"response": "Sorry, I encountered an error while streaming."}
+        full_response = "Sorry, I encountered an error while streaming."
+        write({"response": full_response})
+
+    return {"response": full_response}
+
+
+def _get_writer() -> Callable[[Any], None]:
+    """Stream writer of the running graph, or a no-op when a node is called directly."""
+    try:
+        return get_stream_writer()
+    except Exception:
+        return lambda _chunk: None
+
+
+# --- Semantic response cache ---
+async def response_cache_node(state: AgentState) -> Dict[str, Any]:
+    """
+    Answer from the semantic response cache when a near-identical question with
+    the same retrieved knowledge was answered before. On a hit the cached answer
+    is emitted on the custom stream (like the streaming respond node) and the
+    flow ends without calling the LLM.
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return {"cache_hit": False}
+    question = latest_user_message(state.get("chat_history", []))
+    fingerprint = _answer_fingerprint(state)
+    if not question or len(question) < RESPONSE_CACHE_MIN_CHARS or fingerprint is None:
+        return {"cache_hit": False}
+
+    try:
+        embedding = (await aget_embeddings([question]))[0]
+    except Exception as e:
+        logger.error(f"Response cache: could not embed question: {e}")
+        return {"cache_hit": False}
+
+    entry = response_cache.lookup(_tenant(state), embedding, fingerprint)
+    if entry is None:
+        return {"cache_hit": False, "query_embedding": embedding}
+
+    write = _get_writer()
+    for piece in re.findall(r"\S+\s*", entry.answer):
+        write({"response": piece})
+    return {"cache_hit": True, "response": entry.answer}
+
+
+def _answer_fingerprint(state: AgentState) -> Optional[str]:
+    """Response cache fingerprint: retrieved chunks plus the turns and summary before the question."""
+    history = state.get("chat_history", [])
+    prior = list(history)
+    for i in range(len(history) - 1, -1, -1):
+        msg = history[i]
+        if isinstance(msg, HumanMessage) or (isinstance(msg, dict) and msg.get("role") == "user"):
+            prior = list(history[:i])
+            break
+    return context_fingerprint(state.get("retrieved_context"), prior, state.get("summary"))
+
+
+def _tenant(state: AgentState) -> str:
+    return (state.get("metadata") or {}).get("tenant_id") or DEFAULT_TENANT
+
+
+def remember_answer(state: AgentState, response_text: str) -> None:
+    """Store a freshly generated answer in the semantic response cache."""
+    embedding = state.get("query_embedding")
+    if not RESPONSE_CACHE_ENABLED or not embedding:
+        return
+    question = latest_user_message(state.get("chat_history", []))
+    if question:
+        response_cache.store(
+            _tenant(state), question, embedding, _answer_fingerprint(state), response_text
+        )
+
+
+def route_after_classify(state: AgentState) -> str:
+    """Skip retrieval when the classifier decided it is not needed."""
+    return "retrieve" if state.get("need_retrieval") else "response_cache"
+
+
+def route_after_cache(state: AgentState) -> str:
+    """End the flow on a response cache hit."""
+    return "hit" if state.get("cache_hit") else "miss"
 
 
 # --- Flow Definition ---
-def create_flow() -> Any:
+def _build_flow(respond_name: str, respond: Callable[..., Any], speculative: bool) -> Any:
     """
-    Create the LangGraph flow.
+    classify -> [retrieve] -> response_cache -> respond -> END
+
+    With `speculative=True` the classify node also runs retrieval concurrently,
+    so there is no separate retrieve node.
     """
-    logger.info("Creating LangGraph flow")
-    
-    # Create the graph
     workflow = StateGraph(AgentState)
-    
-    # Add nodes
-    workflow.add_node("classify", classify_node)
-    workflow.add_node("retrieve", retrieve_node)
-    workflow.add_node("respond", respond_node)
-    
-    # Add edges
-    workflow.add_edge("classify", "retrieve")
-    workflow.add_edge("retrieve", "respond")
-    workflow.add_edge("respond", END)
-    
+
+    workflow.add_node("response_cache", response_cache_node)
+    workflow.add_node(respond_name, respond)
+    if speculative:
+        workflow.add_node("classify", classify_speculative_node)
+        workflow.add_edge("classify", "response_cache")
+    else:
+        workflow.add_node("classify", classify_node)
+        workflow.add_node("retrieve", retrieve_node)
+        workflow.add_conditional_edges(
+            "classify", route_after_classify, {"retrieve": "retrieve", "response_cache": "response_cache"}
+        )
+        workflow.add_edge("retrieve", "response_cache")
+    workflow.add_conditional_edges("response_cache", route_after_cache, {"hit": END, "miss": respond_name})
+    workflow.add_edge(respond_name, END)
+
     # Set entry point
     workflow.set_entry_point("classify")
-    
+
     # Compile the graph
-    app = workflow.compile()
+    return workflow.compile()
+
+
+def create_flow(speculative: bool = False) -> Any:
+    """
+    Create the LangGraph flow.
+    """
+    logger.info(f"Creating LangGraph flow (speculative={speculative})")
+    app = _build_flow("respond", respond_node, speculative)
     logger.info("LangGraph flow created successfully")
     return app
 
-def create_streaming_flow() -> Any:
+def create_streaming_flow(speculative: bool = False) -> Any:
     """
     Create a LangGraph flow that supports streaming.
     """
-    logger.info("Creating LangGraph streaming flow")
-    
-    workflow = StateGraph(AgentState)
-    
-    workflow.add_node("classify", classify_node)
-    workflow.add_node("retrieve", retrieve_node)
-    workflow.add_node("respond_stream", stream_respond_node) # Use the streaming node
-    
-    workflow.add_edge("classify", "retrieve")
-    workflow.add_edge("retrieve", "respond_stream")
-    workflow.add_edge("respond_stream", END)
-    
-    workflow.set_entry_point("classify")
-    
-    app = workflow.compile()
+    logger.info(f"Creating LangGraph streaming flow (speculative={speculative})")
+    app = _build_flow("respond_stream", stream_respond_node, speculative) # Use the streaming node
     logger.info("LangGraph streaming flow created successfully")
     return app
 
 
+# --- Flow Registry ---
+# Compiled graphs are immutable and safe to share between concurrent requests,
+# so each flow is built once per process instead of once per message.
+FLOW_BUILDERS: Dict[str, Callable[[], Any]] = {
+    "chat": lambda: create_flow(speculative=is_speculative("chat")),
+    "chat_stream": lambda: create_streaming_flow(speculative=is_speculative("chat_stream")),
+}
+_compiled_flows: Dict[str, Any] = {}
+
+
+def is_speculative(name: str) -> bool:
+    """Whether the flow registered under `name` runs retrieval speculatively."""
+    return name in SPECULATIVE_RETRIEVAL_FLOWS
+
+
+def init_flows() -> None:
+    """Compile every registered flow. Called once from the FastAPI startup hook."""
+    for name in FLOW_BUILDERS:
+        get_flow(name)
+
+
+def get_flow(name: str = "chat") -> Any:
+    """Return the compiled flow registered under `name`, compiling it on first use."""
+    flow = _compiled_flows.get(name)
+    if flow is None:
+        if name not in FLOW_BUILDERS:
+            raise KeyError(f"Unknown flow '{name}'")
+        flow = FLOW_BUILDERS[name]()
+        _compiled_flows[name] = flow
+    return flow
+
+
 # --- Test function ---
 async def test_flow():
     """Test the LangGraph flow with a simple example."""
@@ -265,8 +565,8 @@ async def test_flow():
     print("Testing LangGraph flow...")
     print(f"Initial state: {test_state}")
     
-    # Create and run the flow
-    app = create_flow()
+    # Get and run the flow
+    app = get_flow("chat")
     # The compiled graph exposes async invocation methods; cast to Any for type checkers
     app_any = app  # type: Any
     final_state = await app_any.ainvoke(test_state)
@@ -0,0 +1,367 @@
+"""
+Lexical (BM25) retrieval for the Mai-Sale chat application.
+
+Vector search ranks exact identifiers poorly ("Tensor G5", "Pixel 7 Pro"), so
+chunks are also kept in a persistent inverted index (SQLite):
+
+- Tokenization folds Vietnamese diacritics (NFD + strip combining marks,
+  đ -> d) and lowercases, so "điện thoại" matches "dien thoai".
+- The index is updated incrementally whenever chunks are upserted into Chroma
+  (`agent.retriever.upsert_embedded`) and by scripts/index_knowledge.py.
+- `search` scores candidates with BM25; results are fused with vector results
+  in `simple_rerank` (reciprocal rank fusion). Conversation/user filters are
+  applied in SQL before scoring, and stopwords and very common terms are
+  skipped, so memory searches stay cheap as the collection grows.
+- `is_exact_match` recognizes short identifier queries that the lexical
+  results already answer, so retrieval can skip the embedding call.
+"""
+
+import os
+import re
+import json
+import math
+import sqlite3
+import logging
+import threading
+import uuid
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+# --- Configuration ---
+LEXICAL_ENABLED = os.environ.get("LEXICAL_ENABLED", "true").lower() in ("1", "true", "yes")
+LEXICAL_INDEX_PATH = os.environ.get("LEXICAL_INDEX_PATH", "./database/lexical_index.sqlite")
+LEXICAL_EXACT_SHORTCUT = os.environ.get("LEXICAL_EXACT_SHORTCUT", "true").lower() in ("1", "true", "yes")
+# Queries with at most this many terms (one containing a digit) may skip vector search
+LEXICAL_EXACT_MAX_TERMS = int(os.environ.get("LEXICAL_EXACT_MAX_TERMS", 4))
+# In scopes of at least LEXICAL_DF_CUTOFF_MIN_DOCS chunks, terms found in more than
+# this share of them are too common to rank anything and are not scored
+LEXICAL_MAX_DF_RATIO = float(os.environ.get("LEXICAL_MAX_DF_RATIO", 0.5))
+LEXICAL_DF_CUTOFF_MIN_DOCS = int(os.environ.get("LEXICAL_DF_CUTOFF_MIN_DOCS", 100))
+LEXICAL_BUSY_TIMEOUT = float(os.environ.get("LEXICAL_BUSY_TIMEOUT", 5.0))  # seconds
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Folded Vietnamese function words; they match nearly every chat message
+STOPWORDS = frozenset("""
+    a ai bi bao cac cai cho chu co con cua cung da dang de den di duoc gi ha hay khi khong la lam
+    ma minh mot nao nay nhe nhi nhu nhung o oi ra roi sao se thi toi trong tu va vay vi voi vua
+""".split())
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def fold_text(text: str) -> str:
+    """Lowercase and strip Vietnamese diacritics ("Điện thoại" -> "dien thoai")."""
+    text = text.lower().replace("đ", "d")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+
+
+def tokenize(text: str) -> List[str]:
+    """Folded alphanumeric tokens of `text`."""
+    return _TOKEN_PATTERN.findall(fold_text(text or ""))
+
+
+class LexicalIndex:
+    """BM25 inverted index over chunks, persisted in SQLite and keyed by (collection, id)."""
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH):
+        self.path = path
+        # One connection per thread: searches run concurrently (WAL), writers are serialized
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._anchor: Optional[sqlite3.Connection] = None
+        if path == ":memory:":
+            # Per-thread connections must share one in-memory database
+            self._uri = f"file:lexical_{uuid.uuid4().hex}?mode=memory&cache=shared"
+        else:
+            self._uri = None
+        self.searches = 0
+        self.exact_matches = 0
+        self.postings_scored = 0
+        self.terms_dropped = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self._uri is not None:
+                conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+                if self._anchor is None:
+                    # The shared in-memory database lives as long as one connection is open
+                    self._anchor = conn
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                conn = sqlite3.connect(self.path, timeout=LEXICAL_BUSY_TIMEOUT, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self._create_schema(conn)
+                    self._schema_ready = True
+        return conn
+
+    @staticmethod
+    def _create_schema(conn: sqlite3.Connection) -> None:
+        # Postings carry the scope columns and the chunk length so scoring never reads lexical_docs
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS lexical_docs (
+                collection TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                document TEXT NOT NULL,
+                metadata TEXT,
+                conversation_id TEXT NOT NULL DEFAULT '',
+                user_id TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (collection, doc_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS lexical_postings (
+                collection TEXT NOT NULL,
+                term TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                length INTEGER NOT NULL DEFAULT 0,
+                conversation_id TEXT NOT NULL DEFAULT '',
+                user_id TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (collection, term, doc_id)
+            ) WITHOUT ROWID;
+        """)
+        LexicalIndex._add_scope_columns(conn)
+        conn.executescript("""
+            CREATE INDEX IF NOT EXISTS ix_lexical_postings_doc ON lexical_postings (collection, doc_id);
+            CREATE INDEX IF NOT EXISTS ix_lexical_postings_conversation
+                ON lexical_postings (collection, conversation_id, term);
+            CREATE INDEX IF NOT EXISTS ix_lexical_postings_user ON lexical_postings (collection, user_id, term);
+            CREATE INDEX IF NOT EXISTS ix_lexical_docs_conversation ON lexical_docs (collection, conversation_id, length);
+            CREATE INDEX IF NOT EXISTS ix_lexical_docs_user ON lexical_docs (collection, user_id, length);
+        """)
+
+    @staticmethod
+    def _add_scope_columns(conn: sqlite3.Connection) -> None:
+        """Add and backfill the scope/length columns in index files created before them."""
+        columns = {
+            "lexical_docs": {"conversation_id": "TEXT NOT NULL DEFAULT ''", "user_id": "TEXT NOT NULL DEFAULT ''"},
+            "lexical_postings": {
+                "conversation_id": "TEXT NOT NULL DEFAULT ''",
+                "user_id": "TEXT NOT NULL DEFAULT ''",
+                "length": "INTEGER NOT NULL DEFAULT 0",
+            },
+        }
+        added = False
+        with conn:
+            for table, definitions in columns.items():
+                existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for column, definition in definitions.items():
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                        added = True
+            if not added:
+                return
+            logger.info("Backfilling lexical index scope columns")
+            conn.execute("""
+                UPDATE lexical_docs SET
+                    conversation_id = COALESCE(json_extract(metadata, '$.conversation_id'), ''),
+                    user_id = COALESCE(json_extract(metadata, '$.user_id'), '')
+            """)
+            conn.execute("""
+                UPDATE lexical_postings SET (conversation_id, user_id, length) = (
+                    SELECT d.conversation_id, d.user_id, d.length FROM lexical_docs d
+                    WHERE d.collection = lexical_postings.collection AND d.doc_id = lexical_postings.doc_id
+                )
+            """)
+
+    def upsert(
+        self,
+        collection: str,
+        ids: List[str],
+        documents: List[str],
+        metadatas: Optional[List[Optional[Dict[str, Any]]]] = None,
+    ) -> None:
+        """Add or replace chunks (same ids as in Chroma)."""
+        metadatas = metadatas or [None] * len(ids)
+        conn = self._connection()
+        with self._write_lock, conn:
+            self._delete(conn, collection, ids)
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                metadata = metadata or {}
+                counts = Counter(tokenize(document))
+                length = sum(counts.values())
+                conversation_id = str(metadata.get("conversation_id") or "")
+                user_id = str(metadata.get("user_id") or "")
+                conn.execute(
+                    "INSERT INTO lexical_docs (collection, doc_id, length, document, metadata, conversation_id, user_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (collection, doc_id, length, document, json.dumps(metadata, ensure_ascii=False), conversation_id, user_id),
+                )
+                conn.executemany(
+                    "INSERT INTO lexical_postings (collection, term, doc_id, tf, length, conversation_id, user_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(collection, term, doc_id, tf, length, conversation_id, user_id) for term, tf in counts.items()],
+                )
+
+    def delete(self, collection: str, ids: List[str]) -> None:
+        conn = self._connection()
+        with self._write_lock, conn:
+            self._delete(conn, collection, ids)
+
+    @staticmethod
+    def _delete(conn: sqlite3.Connection, collection: str, ids: List[str]) -> None:
+        conn.executemany(
+            "DELETE FROM lexical_postings WHERE collection = ? AND doc_id = ?", [(collection, i) for i in ids]
+        )
+        conn.executemany(
+            "DELETE FROM lexical_docs WHERE collection = ? AND doc_id = ?", [(collection, i) for i in ids]
+        )
+
+    def clear(self, collection: Optional[str] = None) -> None:
+        """Drop all chunks of `collection` (or of every collection)."""
+        conn = self._connection()
+        with self._write_lock, conn:
+            if collection is None:
+                conn.execute("DELETE FROM lexical_postings")
+                conn.execute("DELETE FROM lexical_docs")
+            else:
+                conn.execute("DELETE FROM lexical_postings WHERE collection = ?", (collection,))
+                conn.execute("DELETE FROM lexical_docs WHERE collection = ?", (collection,))
+
+    def search(
+        self,
+        collection: str,
+        query_text: str,
+        top_k: int = 10,
+        filter_metadata: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        BM25 search over one collection.
+
+        conversation_id / user_id filters are applied in SQL through the scope
+        indexes, so only postings of the matching conversation (or user) are
+        read; collection statistics are computed over the same scope. Stopwords
+        and, in large scopes, terms found in more than LEXICAL_MAX_DF_RATIO of
+        the chunks are not scored. Document text is only read for the results.
+
+        Args:
+            collection (str): Collection name (same as the Chroma collection).
+            query_text (str): The query; folded and tokenized like the documents.
+            top_k (int): Number of results.
+            filter_metadata (Optional[Dict]): Metadata equality filters (all must match).
+
+        Returns:
+            List[Dict]: Results with 'id', 'document', 'metadata', 'bm25' and
+            'matched_terms' (how many distinct query terms the chunk contains).
+        """
+        terms = [t for t in dict.fromkeys(tokenize(query_text)) if t not in STOPWORDS]
+        if not terms:
+            return []
+        self.searches += 1
+        filter_metadata = dict(filter_metadata or {})
+        scope_sql, scope_params = "collection = ?", [collection]
+        for column in ("conversation_id", "user_id"):
+            if column in filter_metadata:
+                scope_sql += f" AND {column} = ?"
+                scope_params.append(str(filter_metadata.pop(column)))
+
+        conn = self._connection()
+        doc_count, total_length = conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lexical_docs WHERE {scope_sql}", scope_params
+        ).fetchone()
+        if not doc_count:
+            return []
+        if doc_count >= LEXICAL_DF_CUTOFF_MIN_DOCS:
+            placeholders = ",".join("?" for _ in terms)
+            df = dict(conn.execute(
+                f"SELECT term, COUNT(*) FROM lexical_postings WHERE {scope_sql} AND term IN ({placeholders}) GROUP BY term",
+                (*scope_params, *terms),
+            ).fetchall())
+            kept = [t for t in terms if df.get(t, 0) <= LEXICAL_MAX_DF_RATIO * doc_count]
+            self.terms_dropped += len(terms) - len(kept)
+            terms = [t for t in kept if df.get(t, 0)]
+            if not terms:
+                return []
+        placeholders = ",".join("?" for _ in terms)
+        rows = conn.execute(
+            f"SELECT term, doc_id, tf, length FROM lexical_postings WHERE {scope_sql} AND term IN ({placeholders})",
+            (*scope_params, *terms),
+        ).fetchall()
+        self.postings_scored += len(rows)
+
+        avg_length = total_length / doc_count or 1.0
+        postings = defaultdict(list)
+        for term, doc_id, tf, length in rows:
+            postings[term].append((doc_id, tf, length))
+
+        scores: Dict[str, float] = defaultdict(float)
+        matched: Dict[str, int] = defaultdict(int)
+        for term, entries in postings.items():
+            idf = math.log(1 + (doc_count - len(entries) + 0.5) / (len(entries) + 0.5))
+            for doc_id, tf, length in entries:
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / norm
+                matched[doc_id] += 1
+
+        # Fetch documents for the best candidates only, a page at a time while other filters reject some
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        results = []
+        page_size = max(top_k, 1) * 2
+        for start in range(0, len(ranked), page_size):
+            page = ranked[start:start + page_size]
+            placeholders = ",".join("?" for _ in page)
+            docs = {
+                doc_id: (document, metadata)
+                for doc_id, document, metadata in conn.execute(
+                    f"SELECT doc_id, document, metadata FROM lexical_docs WHERE collection = ? AND doc_id IN ({placeholders})",
+                    (collection, *page),
+                )
+            }
+            for doc_id in page:
+                document, metadata_json = docs[doc_id]
+                metadata = json.loads(metadata_json) if metadata_json else {}
+                if any(metadata.get(k) != v for k, v in filter_metadata.items()):
+                    continue
+                results.append({
+                    "id": doc_id,
+                    "document": document,
+                    "metadata": metadata,
+                    "bm25": scores[doc_id],
+                    "matched_terms": matched[doc_id],
+                })
+                if len(results) >= top_k:
+                    return results
+        return results
+
+    def is_exact_match(self, query_text: str, results: List[Dict[str, Any]]) -> bool:
+        """
+        True if `query_text` is a short identifier-style query ("Tensor G5",
+        "pixel 7 pro") and the best lexical result contains every query term,
+        in which case the lexical results are used without vector search.
+        """
+        terms = set(tokenize(query_text))
+        exact = (
+            bool(terms)
+            and len(terms) <= LEXICAL_EXACT_MAX_TERMS
+            and any(ch.isdigit() for term in terms for ch in term)
+            and bool(results)
+            and results[0]["matched_terms"] == len(terms)
+        )
+        if exact:
+            self.exact_matches += 1
+        return exact
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": LEXICAL_ENABLED,
+            "searches": self.searches,
+            "exact_matches": self.exact_matches,
+            "postings_scored": self.postings_scored,
+            "terms_dropped": self.terms_dropped,
+        }
+
+
+# Process-wide index (opened lazily on first use)
+lexical_index = LexicalIndex()
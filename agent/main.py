@@ -1,7 +1,8 @@
 import os
+import hashlib
 import logging
 import uuid
-from fastapi import FastAPI, Request, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException, Depends, Query
 from fastapi.responses import JSONResponse
 try:
     # Prefer sse-starlette if installed for robust SSE handling
@@ -18,9 +19,23 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime
-from agent.database import init_db, create_conversation, get_conversation, create_message, get_messages_history
-from agent.langgraph_flow import AgentState, create_flow, create_streaming_flow
-from agent.retriever import upsert_vectors
+from agent.database import (
+    init_db,
+    async_session,
+    create_conversation,
+    get_conversation_info,
+    add_message,
+    get_recent_messages,
+    encode_cursor,
+)
+from agent.langgraph_flow import AgentState, get_flow, init_flows, speculation_config
+from agent.jobs import JobWorker, queue_stats
+from agent.tasks import enqueue_embedding, enqueue_assistant_reply, enqueue_summary
+from agent.ollama_client import init_http_client, close_http_client
+from agent.vector_index import load_vector_indexes
+from agent.prompting import PROMPT_HISTORY_TOKENS, PROMPT_HISTORY_WINDOW
+from agent.summaries import get_summary, split_history, needs_summary
+from agent.write_buffer import message_buffer
 
 # --- Configuration ---
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "localhost")
@@ -34,6 +49,9 @@ DATABASE_URL = os.environ.get(
 X_API_KEYS = set(
     os.environ.get("X_API_KEYS", "default-dev-key").split(",")
 )
+# Process background jobs inside the API process (dev). Set to false when running `python -m agent.worker`.
+RUN_INLINE_WORKER = os.environ.get("RUN_INLINE_WORKER", "true").lower() in ("1", "true", "yes")
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", 200))
 
 # --- Logging ---
 logging.basicConfig(
@@ -45,6 +63,10 @@ logger = logging.getLogger(__name__)
 # --- FastAPI App ---
 app = FastAPI(title="Mai-Sale Chat API", version="0.1.0")
 
+# Job worker started on startup when RUN_INLINE_WORKER is set
+inline_worker: Optional[JobWorker] = None
+inline_worker_task: Optional[asyncio.Task] = None
+
 # --- CORS ---
 # Allow all for development; restrict in production
 app.add_middleware(
@@ -57,6 +79,11 @@ app.add_middleware(
 )
 
 # --- Middleware for API Key Authentication ---
+def tenant_id_for_key(api_key: str) -> str:
+    """Stable, non-reversible tenant id derived from an API key."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
 @app.middleware("http")
 async def api_key_auth_middleware(request: Request, call_next):
     """Middleware to check for valid X-API-Key header, except for /healthz and /version"""
@@ -79,6 +106,8 @@ async def api_key_auth_middleware(request: Request, call_next):
         )
     # Optionally, you could attach the user_id or other info derived from the key to the request state
     # request.state.user_id = get_user_id_from_key(api_key)
+    # Each API key is its own tenant (e.g. for the semantic response cache)
+    request.state.tenant_id = tenant_id_for_key(api_key)
     
     logger.info("API Key is valid, proceeding with request")
     response = await call_next(request)
@@ -92,6 +121,30 @@ async def startup_event():
     logger.info("Initializing database...")
     await init_db()
     logger.info("Database initialized.")
+    await init_http_client()
+    init_flows()
+    logger.info("LangGraph flows compiled.")
+    load_vector_indexes()
+    if RUN_INLINE_WORKER:
+        # Dev convenience: process jobs in the API process. In production run
+        # `python -m agent.worker` separately and set RUN_INLINE_WORKER=false.
+        global inline_worker, inline_worker_task
+        inline_worker = JobWorker()
+        inline_worker_task = asyncio.create_task(inline_worker.run())
+        logger.info("Inline job worker started.")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush buffered messages, drain the inline job worker and release pooled connections on shutdown"""
+    # Write buffered messages (and enqueue their jobs) before the worker drains
+    await message_buffer.flush()
+    if inline_worker is not None:
+        await inline_worker.stop()
+        await inline_worker_task
+    await close_http_client()
+    from agent.chroma_pool import chroma_pool
+    chroma_pool.shutdown()
 
 
 # Pydantic models for request/response
@@ -118,6 +171,8 @@ class MessageResponse(BaseModel):
 
 class ConversationHistoryResponse(BaseModel):
     messages: List[MessageResponse]
+    # Pass as `cursor` to get the previous (older) page; None on the oldest page
+    next_cursor: Optional[str] = None
 @app.get("/healthz")
 async def health_check():
     """Health check endpoint"""
@@ -148,9 +203,9 @@ async def ready_check():
     # Check Ollama connectivity (simple ping)
     ollama_ready = False
     try:
-        from agent.ollama_client import generate_text
+        from agent.ollama_client import agenerate_text
         # Simple generate call to check if Ollama is responsive
-        generate_text("ping", model="gpt-oss")
+        await agenerate_text("ping", model="gpt-oss")
         ollama_ready = True
     except Exception as e:
         logger.error(f"Ollama readiness check failed: {e}")
@@ -159,8 +214,9 @@ async def ready_check():
     chroma_ready = False
     try:
         from agent.retriever import chroma_client
-        # Simple operation to check connectivity
-        chroma_client.heartbeat()
+        from agent.chroma_pool import chroma_pool
+        # Simple operation to check connectivity (off the event loop)
+        await chroma_pool.run(chroma_client.heartbeat)
         chroma_ready = True
     except Exception as e:
         logger.error(f"ChromaDB readiness check failed: {e}")
@@ -180,6 +236,36 @@ async def ready_check():
             }
         )
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Process-local performance counters (caches, pools, queues)"""
+    from agent.embedding_cache import embedding_cache
+    from agent.singleflight import singleflight_stats
+    from agent.langgraph_flow import get_speculation_stats
+    from agent.kv_context import context_cache
+    from agent.response_cache import response_cache
+    from agent.upsert_batcher import upsert_batcher
+    from agent.chroma_pool import chroma_pool
+    from agent.retrieval_cache import retrieval_cache
+    from agent.database import engine
+    from agent.db_config import pool_stats
+    from agent.database import conversation_cache_stats
+    return {
+        "db_pool": pool_stats(engine),
+        "conversation_cache": conversation_cache_stats(),
+        "jobs": await queue_stats(),
+        "inline_worker": inline_worker.stats() if inline_worker is not None else None,
+        "embedding_cache": embedding_cache.stats(),
+        "singleflight": singleflight_stats(),
+        "speculative_retrieval": get_speculation_stats(),
+        "ollama_context": context_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "upsert_batcher": upsert_batcher.stats(),
+        "message_buffer": message_buffer.stats(),
+        "chroma_pool": chroma_pool.stats(),
+    }
+
 # --- Main API Endpoints ---
 @app.post("/conversations", response_model=CreateConversationResponse, status_code=201)
 async def create_conversation_endpoint(request: CreateConversationRequest):
@@ -198,54 +284,71 @@ async def create_conversation_endpoint(request: CreateConversationRequest):
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @app.post("/conversations/{conversation_id}/stream")
-async def stream_message_endpoint(conversation_id: str, request: CreateMessageRequest, background_tasks: BackgroundTasks):
+async def stream_message_endpoint(conversation_id: str, request: CreateMessageRequest, http_request: Request):
     """
     Create a new message and stream the assistant's response.
     """
     logger.info(f"Streaming message in conversation {conversation_id}")
     try:
         conv_uuid = uuid.UUID(conversation_id)
-        conv = await get_conversation(conv_uuid)
+        conv = await get_conversation_info(conv_uuid)
         if not conv:
             raise HTTPException(status_code=404, detail="Conversation not found")
 
-        # 1. Save user message and enqueue its embedding
-        user_msg = await create_message(
-            conversation_id=conv_uuid, sender="user", text=request.content
-        )
-        background_tasks.add_task(
-            embed_and_store_message,
-            message_id=str(user_msg.id),
-            conversation_id=str(conv_uuid),
-            user_id=conv.user_id,
-            text=request.content,
-        )
-        logger.info(f"User message {user_msg.id} saved.")
+        flow_metadata = {
+            "conversation_id": str(conv_uuid),
+            "user_id": conv.user_id,
+            "tenant_id": getattr(http_request.state, "tenant_id", None),
+        }
+        flow_config = speculation_config("chat_stream", request.content, flow_metadata)
+
+        # 1. Queue the user message (written with its embedding job by the write-behind buffer)
+        user_msg = await message_buffer.submit(conv_uuid, "user", request.content, user_id=conv.user_id)
+        logger.info(f"User message {user_msg.id} accepted.")
 
         # 2. Prepare the generator for the streaming response
+        async def save_assistant_message(full_response, history):
+            # Queued; the write is confirmed before the final SSE event
+            assistant_msg = await message_buffer.submit(
+                conv_uuid, "assistant", full_response, user_id=conv.user_id
+            )
+            logger.info(f"Assistant message {assistant_msg.id} queued for writing.")
+            if needs_summary(history + [assistant_msg]):
+                # Summarized off the request path by the job worker
+                try:
+                    await enqueue_summary(str(conv_uuid), str(assistant_msg.id))
+                except Exception as e:
+                    logger.warning(f"[{conversation_id}] Could not enqueue summary update: {e}")
+            return assistant_msg
+
         async def response_generator():
             full_response = ""
+            history = []
+            assistant_msg = None
+            save_attempted = False
             try:
-                # Get history for the flow state
-                history = await get_messages_history(conv_uuid)
+                # Get history for the flow state; turns covered by the rolling summary are replaced by it
+                history = await message_buffer.recent_messages(
+                    conv_uuid, PROMPT_HISTORY_WINDOW, token_budget=PROMPT_HISTORY_TOKENS
+                )
+                summary = await get_summary(conv_uuid)
+                history = split_history(history, summary)
                 initial_state: AgentState = {
                     "conversation_id": str(conv_uuid),
                     "user_id": conv.user_id,
-                    "chat_history": [{"role": msg.sender, "content": msg.text} for msg in history],
-                    "metadata": {"conversation_id": str(conv_uuid), "user_id": conv.user_id},
+                    "chat_history": [
+                        {"id": str(msg.id), "role": msg.sender, "content": msg.text, "tokens": msg.tokens_estimate}
+                        for msg in history
+                    ],
+                    "summary": summary.summary if summary is not None else None,
+                    "metadata": flow_metadata,
                     "retrieved_context": None, "response": None, "stream": True,
                 }
 
-                # We'll run the classify/retrieve nodes directly and then stream from
-                # the streaming response node. This ensures per-chunk yields from
-                # `generate_text_stream` are forwarded immediately to the SSE client.
-                from agent.langgraph_flow import (
-                    classify_node,
-                    retrieve_node,
-                    stream_respond_node,
-                )
-
-                logger.info(f"[{conversation_id}] Running classify/retrieve then streaming node directly")
+                # Drive the compiled streaming flow; the respond node emits each
+                # chunk from `generate_text_stream` on the "custom" stream mode,
+                # so chunks are forwarded to the SSE client as soon as they arrive.
+                flow = get_flow("chat_stream")
 
                 # Emit an initial debug SSE payload so clients can detect the open stream
                 initial_payload = json.dumps({"debug": "stream-open"})
@@ -255,37 +358,17 @@ async def stream_message_endpoint(conversation_id: str, request: CreateMessageRe
                 # allow the event loop and server to flush this chunk
                 await asyncio.sleep(0)
 
-                # Run classifier node to decide if we should retrieve
-                try:
-                    classify_out = await classify_node(initial_state)
-                    logger.info(f"[{conversation_id}] classify_out={classify_out}")
-                except Exception as e:
-                    logger.error(f"[{conversation_id}] classify_node failed: {e}", exc_info=True)
-                    classify_out = {"need_retrieval": False}
-
-                # Optionally run retrieve node
-                try:
-                    if classify_out.get("need_retrieval"):
-                        await retrieve_node(initial_state)
-                        logger.info(f"[{conversation_id}] retrieve populated state.retrieved_context")
-                except Exception as e:
-                    logger.error(f"[{conversation_id}] retrieve_node failed: {e}", exc_info=True)
-
-                # Stream directly from the streaming node
                 chunk_index = 0
                 try:
-                    async for chunk in stream_respond_node(initial_state):
-                        # chunk is expected to be a dict like {'response': '...'} or a string
-                        logger.info(f"[{conversation_id}] streaming node yielded: {chunk!r}")
-                        # Normalize
-                        response_chunk = None
-                        if isinstance(chunk, dict) and "response" in chunk:
-                            response_chunk = chunk["response"]
-                        elif isinstance(chunk, str):
-                            response_chunk = chunk
-
-                        if response_chunk is None:
-                            logger.info(f"[{conversation_id}] streaming node yielded non-response: {chunk!r}")
+                    async for mode, chunk in flow.astream(
+                        initial_state, config=flow_config, stream_mode=["updates", "custom"]
+                    ):
+                        if mode == "updates":
+                            logger.info(f"[{conversation_id}] flow step finished: {list(chunk)}")
+                            continue
+                        # custom chunks are dicts like {'response': '...'}
+                        response_chunk = chunk.get("response") if isinstance(chunk, dict) else None
+                        if not response_chunk:
                             continue
 
                         try:
@@ -293,32 +376,37 @@ async def stream_message_endpoint(conversation_id: str, request: CreateMessageRe
                         except Exception:
                             payload = json.dumps({"chunk": str(response_chunk)})
                         sse_data = f"data: {payload}\n\n"
-                        logger.info(f"[{conversation_id}] Yielding chunk {chunk_index}: {sse_data.strip()}")
+                        logger.debug(f"[{conversation_id}] Yielding chunk {chunk_index}: {sse_data.strip()}")
                         yield sse_data
                         # give the event loop a chance to schedule IO/flush
                         await asyncio.sleep(0)
                         full_response += response_chunk
                         chunk_index += 1
                 except Exception as e:
-                    logger.error(f"[{conversation_id}] Error in streaming node: {e}", exc_info=True)
-            
+                    logger.error(f"[{conversation_id}] Error in streaming flow: {e}", exc_info=True)
+
+                logger.info(f"[{conversation_id}] Stream finished. Saving full assistant response.")
+                if full_response:
+                    save_attempted = True
+                    assistant_msg = await save_assistant_message(full_response, history)
+                # Tell the client whether both turns were stored before closing the stream
+                try:
+                    await message_buffer.confirm(user_msg, assistant_msg)
+                    final_payload = {
+                        "done": True,
+                        "message_id": str(assistant_msg.id) if assistant_msg is not None else None,
+                    }
+                except Exception as e:
+                    logger.error(f"[{conversation_id}] Messages of this turn were not saved: {e!r}")
+                    final_payload = {"done": True, "error": "The conversation could not be saved."}
+                yield f"data: {json.dumps(final_payload)}\n\n"
+
             except Exception as e:
                 logger.error(f"[{conversation_id}] Error during stream generation: {e}", exc_info=True)
             finally:
-                logger.info(f"[{conversation_id}] Stream finished. Saving full assistant response.")
-                if full_response:
-                    # Save the complete assistant message
-                    assistant_msg = await create_message(
-                        conversation_id=conv_uuid, sender="assistant", text=full_response
-                    )
-                    # Enqueue embedding for the assistant's message
-                    await embed_and_store_message(
-                        message_id=str(assistant_msg.id),
-                        conversation_id=str(conv_uuid),
-                        user_id=conv.user_id,
-                        text=full_response,
-                    )
-                    logger.info(f"Assistant message {assistant_msg.id} saved and embedding enqueued.")
+                if full_response and not save_attempted:
+                    # Client disconnected mid-stream: still keep what was generated
+                    await save_assistant_message(full_response, history)
 
         # Use EventSourceResponse if available for better SSE semantics and flushing
         if EventSourceResponse is not None:
@@ -336,89 +424,8 @@ async def stream_message_endpoint(conversation_id: str, request: CreateMessageRe
         return JSONResponse(status_code=500, content={"detail": f"Error: {e}"})
 
 
-async def run_assistant_flow(conversation_id: uuid.UUID, user_id: str):
-    """
-    Runs the LangGraph flow to generate and save the assistant's response.
-    This is run in the background.
-    """
-    logger.info(f"Starting assistant flow for conversation {conversation_id}")
-    try:
-        # 1. Get history to build the current state
-        history = await get_messages_history(conversation_id)
-        
-        # 2. Create initial state for the flow
-        initial_state: AgentState = {
-            "conversation_id": str(conversation_id),
-            "user_id": user_id,
-            "chat_history": [
-                {"role": msg.sender, "content": msg.text} for msg in history
-            ],
-            "metadata": {
-                "conversation_id": str(conversation_id),
-                "user_id": user_id,
-            },
-            "retrieved_context": None,
-            "response": None,
-        }
-
-        # 3. Create and invoke the LangGraph flow
-        flow = create_flow()
-        final_state = await flow.ainvoke(initial_state)
-
-        # 4. Save the assistant's response to the database
-        assistant_response = final_state.get("response")
-        if assistant_response:
-            assistant_msg = await create_message(
-                conversation_id=conversation_id,
-                sender="assistant",
-                text=assistant_response,
-            )
-            logger.info(f"Assistant response saved for conversation {conversation_id}")
-            
-            # Also embed the assistant's response
-            background_tasks = BackgroundTasks()
-            background_tasks.add_task(
-                embed_and_store_message,
-                message_id=str(assistant_msg.id),
-                conversation_id=str(conversation_id),
-                user_id=user_id,
-                text=assistant_response,
-            )
-        else:
-            logger.warning(f"No response generated by the flow for conversation {conversation_id}")
-
-    except Exception as e:
-        logger.error(f"Error in assistant flow for conversation {conversation_id}: {e}", exc_info=True)
-
-
-async def embed_and_store_message(message_id: str, conversation_id: str, user_id: str, text: str):
-    """
-    Generates embedding for a message and stores it in ChromaDB.
-    This is run in the background.
-    """
-    logger.info(f"Starting embedding for message {message_id}")
-    try:
-        # For now, we treat the whole message as a single document.
-        # In the future, we might chunk it.
-        documents = [text]
-        metadatas = [{
-            "message_id": message_id,
-            "conversation_id": conversation_id,
-            "user_id": user_id,
-            "created_at": datetime.utcnow().isoformat(),
-        }]
-        ids = [message_id]
-
-        # Upsert into ChromaDB
-        upsert_vectors(documents=documents, metadatas=metadatas, ids=ids)
-        logger.info(f"Successfully embedded and stored message {message_id}")
-
-    except Exception as e:
-        logger.error(f"Error embedding message {message_id}: {e}", exc_info=True)
-
-
 @app.post("/conversations/{conversation_id}/messages", status_code=202)
-async def create_message_endpoint(conversation_id: str, request: CreateMessageRequest, background_tasks: BackgroundTasks):
+async def create_message_endpoint(conversation_id: str, request: CreateMessageRequest, http_request: Request):
     """Create a new message in a conversation"""
     logger.info(f"Creating message in conversation {conversation_id}")
     try:
@@ -429,32 +436,39 @@ async def create_message_endpoint(conversation_id: str, request: CreateMessageRe
             logger.warning(f"Invalid conversation ID format: {conversation_id}")
             raise HTTPException(status_code=400, detail="Invalid conversation ID format")
         
-        # Check if conversation exists
-        conv = await get_conversation(conv_uuid)
+        # Check if conversation exists (cached per process)
+        conv = await get_conversation_info(conv_uuid)
         if not conv:
             logger.warning(f"Conversation not found: {conversation_id}")
             raise HTTPException(status_code=404, detail="Conversation not found")
             
-        # Create message (user message)
-        msg = await create_message(
-            conversation_id=conv_uuid,
-            sender="user",
-            text=request.content,
-            metadata=request.metadata
-        )
-        logger.info(f"Message created with ID {msg.id}")
-        
-        # Enqueue embedding for the user's message
-        background_tasks.add_task(
-            embed_and_store_message,
-            message_id=str(msg.id),
-            conversation_id=str(conv_uuid),
-            user_id=conv.user_id,
-            text=request.content,
-        )
-
-        # Enqueue the assistant flow to run in the background
-        background_tasks.add_task(run_assistant_flow, conversation_id=conv_uuid, user_id=conv.user_id)
+        # One transaction: the user message is never stored without its embedding and reply jobs
+        async with async_session() as session:
+            async with session.begin():
+                msg = await add_message(
+                    conversation_id=conv_uuid,
+                    sender="user",
+                    text=request.content,
+                    metadata=request.metadata,
+                    session=session,
+                )
+                await enqueue_embedding(
+                    message_id=str(msg.id),
+                    conversation_id=str(conv_uuid),
+                    user_id=conv.user_id,
+                    text=request.content,
+                    session=session,
+                )
+                # A job worker generates and saves the reply
+                await enqueue_assistant_reply(
+                    message_id=str(msg.id),
+                    conversation_id=str(conv_uuid),
+                    user_id=conv.user_id,
+                    user_text=request.content,
+                    tenant_id=getattr(http_request.state, "tenant_id", None),
+                    session=session,
+                )
+        logger.info(f"Message created with ID {msg.id}, embedding and reply jobs enqueued")
         
         # Return minimal response for fast ACK
         return {"message_id": str(msg.id), "status": "accepted"}
@@ -467,8 +481,12 @@ async def create_message_endpoint(conversation_id: str, request: CreateMessageRe
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @app.get("/conversations/{conversation_id}/history", response_model=ConversationHistoryResponse)
-async def get_conversation_history_endpoint(conversation_id: str):
-    """Get the message history for a conversation"""
+async def get_conversation_history_endpoint(
+    conversation_id: str,
+    limit: int = Query(50, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    """Get the message history for a conversation, newest page first (oldest message first within a page)"""
     logger.info(f"Getting history for conversation {conversation_id}")
     try:
         # Validate conversation ID
@@ -478,14 +496,23 @@ async def get_conversation_history_endpoint(conversation_id: str):
             logger.warning(f"Invalid conversation ID format: {conversation_id}")
             raise HTTPException(status_code=400, detail="Invalid conversation ID format")
         
-        # Check if conversation exists
-        conv = await get_conversation(conv_uuid)
+        # Check if conversation exists (cached per process)
+        conv = await get_conversation_info(conv_uuid)
         if not conv:
             logger.warning(f"Conversation not found: {conversation_id}")
             raise HTTPException(status_code=404, detail="Conversation not found")
             
-        # Get messages
-        messages = await get_messages_history(conv_uuid)
+        # Get one page of messages (one extra tells whether an older page exists);
+        # the newest page also shows messages still in the write-behind buffer
+        try:
+            if cursor is None:
+                messages = await message_buffer.recent_messages(conv_uuid, limit + 1)
+            else:
+                messages = await get_recent_messages(conv_uuid, limit + 1, before=cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        has_more = len(messages) > limit
+        messages = messages[-limit:]
         logger.info(f"Retrieved {len(messages)} messages")
         
         # Convert to response model
@@ -501,7 +528,10 @@ async def get_conversation_history_endpoint(conversation_id: str):
             for msg in messages
         ]
         
-        return ConversationHistoryResponse(messages=message_responses)
+        return ConversationHistoryResponse(
+            messages=message_responses,
+            next_cursor=encode_cursor(messages[0]) if has_more else None,
+        )
         
     except HTTPException:
         # Re-raise HTTP exceptions
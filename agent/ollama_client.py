@@ -2,6 +2,7 @@
 # requires-python = ">=3.10"
 # dependencies = [
 #     "requests",
+#     "httpx",
 # ]
 # ///
 """
@@ -10,11 +11,15 @@ Ollama client adapters for the Mai-Sale chat application.
 This module provides adapters to interact with the Ollama API:
 - generate: For text generation using gpt-oss model
 - embeddings: For creating embeddings using bge-m3 model
+
+All adapters share one pooled HTTP layer (keep-alive connections, bounded pool
+size, per-endpoint timeouts). The async pool is opened/closed by the FastAPI
+startup/shutdown hooks in agent/main.py and created lazily elsewhere (scripts, tests).
 """
 
 import os
 import requests
-from typing import List, Optional, Dict, Any, AsyncGenerator
+from typing import List, Optional, Dict, Any, AsyncGenerator, Callable
 import pathlib
 
 
@@ -54,7 +59,11 @@ def _load_dotenv_simple(filename: str = ".env.local") -> None:
 _load_dotenv_simple()
 import logging
 import json
+import asyncio
 import httpx
+from requests.adapters import HTTPAdapter
+from agent.embedding_cache import embedding_cache
+from agent.singleflight import SingleFlight
 
 # --- Configuration ---
 # Allow configuring Ollama endpoints via environment variables.
@@ -68,14 +77,113 @@ OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", _DEFAULT_BASE)
 OLLAMA_GENERATE_URL = os.environ.get("OLLAMA_GENERATE_URL", f"{OLLAMA_BASE_URL}/api/generate")
 OLLAMA_EMBEDDING_URL = os.environ.get("OLLAMA_EMBEDDING_URL", f"{OLLAMA_BASE_URL}/api/embeddings")
 OLLAMA_TAGS_URL = os.environ.get("OLLAMA_TAGS_URL", f"{OLLAMA_BASE_URL}/api/tags")
+# Batch embeddings endpoint (accepts an `input` array). Older servers only have /api/embeddings.
+OLLAMA_EMBED_BATCH_URL = os.environ.get("OLLAMA_EMBED_BATCH_URL", f"{OLLAMA_BASE_URL}/api/embed")
+
+# How long Ollama keeps the model (and its KV cache) loaded after a request, e.g. "30m".
+# Empty leaves the server default.
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
 
 # Default models
 DEFAULT_GENERATE_MODEL = os.environ.get("DEFAULT_GENERATE_MODEL", "gpt-oss")
 DEFAULT_EMBEDDING_MODEL = os.environ.get("DEFAULT_EMBEDDING_MODEL", "bge-m3")
 
+# HTTP connection pool (shared by every adapter below)
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get("OLLAMA_MAX_CONNECTIONS", 100))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", 20))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.environ.get("OLLAMA_KEEPALIVE_EXPIRY", 30.0))
+
+# Per-endpoint timeouts in seconds. The read timeout for streaming is the max gap
+# between two chunks, not the total generation time.
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", 5.0))
+OLLAMA_GENERATE_TIMEOUT = float(os.environ.get("OLLAMA_GENERATE_TIMEOUT", 120.0))
+OLLAMA_STREAM_TIMEOUT = float(os.environ.get("OLLAMA_STREAM_TIMEOUT", 60.0))
+OLLAMA_EMBEDDING_TIMEOUT = float(os.environ.get("OLLAMA_EMBEDDING_TIMEOUT", 30.0))
+
+# Batch embedding: max inputs per /api/embed request, and parallelism of the
+# single-text fallback used against servers without /api/embed.
+OLLAMA_EMBED_BATCH_SIZE = int(os.environ.get("OLLAMA_EMBED_BATCH_SIZE", 32))
+OLLAMA_EMBED_FALLBACK_CONCURRENCY = int(os.environ.get("OLLAMA_EMBED_FALLBACK_CONCURRENCY", 8))
+
 # --- Logging ---
 logger = logging.getLogger(__name__)
 
+# --- HTTP Client Pool ---
+_async_client: Optional[httpx.AsyncClient] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_session: Optional[requests.Session] = None
+# Flipped to False the first time the server answers 404 on /api/embed.
+_batch_embed_supported: bool = True
+# Concurrent identical embedding requests share one Ollama call
+_embedding_flight = SingleFlight("embeddings")
+
+
+def _timeout(read_timeout: float) -> httpx.Timeout:
+    """Build an httpx timeout for one endpoint (shared connect timeout)."""
+    return httpx.Timeout(read_timeout, connect=OLLAMA_CONNECT_TIMEOUT)
+
+
+def _build_async_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=OLLAMA_MAX_CONNECTIONS,
+        max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=_timeout(OLLAMA_GENERATE_TIMEOUT))
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """Open the shared async client pool. Called from the FastAPI startup hook."""
+    global _async_client, _async_client_loop
+    if _async_client is None or _async_client.is_closed:
+        _async_client = _build_async_client()
+        _async_client_loop = asyncio.get_running_loop()
+        logger.info(
+            f"Opened Ollama HTTP pool (max_connections={OLLAMA_MAX_CONNECTIONS}, "
+            f"max_keepalive={OLLAMA_MAX_KEEPALIVE_CONNECTIONS})"
+        )
+    return _async_client
+
+
+async def close_http_client() -> None:
+    """Close the shared async client pool and the sync session. Called on shutdown."""
+    global _async_client, _async_client_loop, _sync_session
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+        _async_client_loop = None
+        logger.info("Closed Ollama HTTP pool")
+    if _sync_session is not None:
+        _sync_session.close()
+        _sync_session = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Return the shared async client, creating it lazily if the startup hook did not run.
+
+    Connections are bound to the event loop that opened them, so a new pool is
+    created when called from a different loop (e.g. successive asyncio.run calls in scripts).
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+        _async_client = _build_async_client()
+        _async_client_loop = loop
+    return _async_client
+
+
+def get_sync_session() -> requests.Session:
+    """Return the shared keep-alive session used by the synchronous adapters."""
+    global _sync_session
+    if _sync_session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=OLLAMA_MAX_CONNECTIONS)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sync_session = session
+    return _sync_session
+
 # --- Adapter Functions ---
 
 def generate_text(prompt: str, model: str = DEFAULT_GENERATE_MODEL, **kwargs) -> str:
@@ -104,7 +212,9 @@ def generate_text(prompt: str, model: str = DEFAULT_GENERATE_MODEL, **kwargs) ->
     
     logger.info(f"Calling Ollama generate API with model {model}")
     try:
-        response = requests.post(url, json=payload)
+        response = get_sync_session().post(
+            url, json=payload, timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_GENERATE_TIMEOUT)
+        )
         response.raise_for_status()
         data = response.json()
         
@@ -120,53 +230,121 @@ def generate_text(prompt: str, model: str = DEFAULT_GENERATE_MODEL, **kwargs) ->
         logger.error(f"Invalid response from Ollama generate API: {e}")
         raise
 
-async def generate_text_stream(prompt: str, model: str = "gpt-oss") -> AsyncGenerator[str, None]:
+def _generate_payload(prompt: str, model: str, stream: bool, context: Optional[List[int]], **kwargs) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"model": model, "prompt": prompt, "stream": stream}
+    if context:
+        payload["context"] = context
+    if OLLAMA_KEEP_ALIVE:
+        payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+    payload.update(kwargs)
+    return payload
+
+
+async def agenerate_text(
+    prompt: str,
+    model: str = DEFAULT_GENERATE_MODEL,
+    context: Optional[List[int]] = None,
+    on_context: Optional[Callable[[List[int]], None]] = None,
+    **kwargs,
+) -> str:
+    """
+    Async variant of `generate_text` using the shared connection pool.
+
+    Args:
+        prompt (str): The prompt to send to the model.
+        model (str): The model to use for generation.
+        context (Optional[List[int]]): Token context returned by a previous call;
+            Ollama continues from it so only `prompt` needs to be prefilled.
+        on_context (Optional[Callable]): Called with the new context returned by Ollama.
+        **kwargs: Additional parameters to pass to the API (e.g., options).
+
+    Raises:
+        httpx.HTTPError: If there's an error with the HTTP request.
+        ValueError: If the response is invalid or missing expected fields.
+    """
+    url = OLLAMA_GENERATE_URL
+    payload = _generate_payload(prompt, model, False, context, **kwargs)
+
+    logger.info(f"Calling Ollama generate API (async) with model {model}")
+    try:
+        response = await get_http_client().post(url, json=payload, timeout=_timeout(OLLAMA_GENERATE_TIMEOUT))
+        response.raise_for_status()
+        data = response.json()
+
+        if "response" not in data:
+            raise ValueError("Invalid response from Ollama API: missing 'response' field")
+
+        logger.info("Successfully generated text with Ollama")
+        if on_context is not None and data.get("context"):
+            on_context(data["context"])
+        return data["response"]
+    except httpx.HTTPError as e:
+        logger.error(f"Error calling Ollama generate API: {e}")
+        raise
+    except ValueError as e:
+        logger.error(f"Invalid response from Ollama generate API: {e}")
+        raise
+
+async def generate_text_stream(
+    prompt: str,
+    model: str = "gpt-oss",
+    context: Optional[List[int]] = None,
+    on_context: Optional[Callable[[List[int]], None]] = None,
+) -> AsyncGenerator[str, None]:
     """
     Generates text from a prompt using the Ollama API with streaming.
+
+    `context` / `on_context` work as in `agenerate_text`; the new context is
+    reported when the final (done) chunk arrives.
     """
     url = OLLAMA_GENERATE_URL
-    data = {"model": model, "prompt": prompt, "stream": True}
+    data = _generate_payload(prompt, model, True, context)
+
+    def response_text(json_chunk: Dict[str, Any]) -> str:
+        if on_context is not None and json_chunk.get("done") and json_chunk.get("context"):
+            on_context(json_chunk["context"])
+        return json_chunk.get("response", "")
     
     logger.info(f"Calling Ollama generate API with streaming for model {model}")
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            async with client.stream("POST", url, json=data) as response:
-                response.raise_for_status()
-                # Buffer text and parse line-delimited JSON or individual JSON objects
-                buffer = ""
-                async for text_chunk in response.aiter_text():
-                    if not text_chunk:
+        client = get_http_client()
+        async with client.stream("POST", url, json=data, timeout=_timeout(OLLAMA_STREAM_TIMEOUT)) as response:
+            response.raise_for_status()
+            # Buffer text and parse line-delimited JSON or individual JSON objects
+            buffer = ""
+            async for text_chunk in response.aiter_text():
+                if not text_chunk:
+                    continue
+                buffer += text_chunk
+                # Try to split by newlines which many streaming endpoints use
+                while "\n" in buffer:
+                    line, buffer = buffer.split("\n", 1)
+                    line = line.strip()
+                    if not line:
                         continue
-                    buffer += text_chunk
-                    # Try to split by newlines which many streaming endpoints use
-                    while "\n" in buffer:
-                        line, buffer = buffer.split("\n", 1)
-                        line = line.strip()
-                        if not line:
-                            continue
+                    try:
+                        json_chunk = json.loads(line)
+                        yield response_text(json_chunk)
+                    except json.JSONDecodeError:
+                        # If the line is not valid JSON, try to parse the accumulated buffer as JSON
                         try:
                             json_chunk = json.loads(line)
-                            yield json_chunk.get("response", "")
-                        except json.JSONDecodeError:
-                            # If the line is not valid JSON, try to parse the accumulated buffer as JSON
-                            try:
-                                json_chunk = json.loads(line)
-                                yield json_chunk.get("response", "")
-                            except Exception:
-                                # Give up on this line; yield raw fallback so UI can at least show text
-                                yield line
-                # After the stream finishes, try to parse any remaining buffer
-                if buffer:
-                    rem = buffer.strip()
-                    if rem:
-                        try:
-                            json_chunk = json.loads(rem)
-                            yield json_chunk.get("response", "")
+                            yield response_text(json_chunk)
                         except Exception:
-                            yield rem
+                            # Give up on this line; yield raw fallback so UI can at least show text
+                            yield line
+            # After the stream finishes, try to parse any remaining buffer
+            if buffer:
+                rem = buffer.strip()
+                if rem:
+                    try:
+                        json_chunk = json.loads(rem)
+                        yield response_text(json_chunk)
+                    except Exception:
+                        yield rem
     except httpx.ReadTimeout:
-        logger.error(f"Ollama request timed out after 60 seconds for model {model}.")
+        logger.error(f"Ollama request timed out after {OLLAMA_STREAM_TIMEOUT} seconds for model {model}.")
         yield "[ERROR: The request to the AI model timed out. The model might be busy or unavailable. Please try again later.]"
     except Exception as e:
         logger.error(f"An unexpected error occurred while streaming from Ollama: {e}", exc_info=True)
@@ -189,12 +367,18 @@ def get_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> List[float
         requests.RequestException: If there's an error with the HTTP request.
         ValueError: If the response is invalid or missing expected fields.
     """
+    cached = embedding_cache.get(model, text)
+    if cached is not None:
+        return cached
+
     url = OLLAMA_EMBEDDING_URL
     payload = {"model": model, "prompt": text}
     
     logger.info(f"Calling Ollama embeddings API with model {model}")
     try:
-        response = requests.post(url, json=payload)
+        response = get_sync_session().post(
+            url, json=payload, timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_EMBEDDING_TIMEOUT)
+        )
         response.raise_for_status()
         data = response.json()
         
@@ -206,6 +390,7 @@ def get_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> List[float
             raise ValueError("Invalid response from Ollama API: 'embedding' is not a list of numbers")
             
         logger.info(f"Successfully generated embedding with Ollama (dimension: {len(embedding)})")
+        embedding_cache.put(model, text, embedding)
         return embedding
     except requests.RequestException as e:
         logger.error(f"Error calling Ollama embeddings API: {e}")
@@ -214,6 +399,121 @@ def get_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> List[float
         logger.error(f"Invalid response from Ollama embeddings API: {e}")
         raise
 
+
+def _validate_embedding(embedding: Any) -> List[float]:
+    if not isinstance(embedding, list) or not all(isinstance(x, (int, float)) for x in embedding):
+        raise ValueError("Invalid response from Ollama API: 'embedding' is not a list of numbers")
+    return embedding
+
+
+async def aget_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> List[float]:
+    """
+    Async single-text embedding via the legacy /api/embeddings endpoint.
+
+    Raises:
+        httpx.HTTPError: If there's an error with the HTTP request.
+        ValueError: If the response is invalid or missing expected fields.
+    """
+    payload = {"model": model, "prompt": text}
+    response = await get_http_client().post(
+        OLLAMA_EMBEDDING_URL, json=payload, timeout=_timeout(OLLAMA_EMBEDDING_TIMEOUT)
+    )
+    response.raise_for_status()
+    data = response.json()
+    if "embedding" not in data:
+        raise ValueError("Invalid response from Ollama API: missing 'embedding' field")
+    return _validate_embedding(data["embedding"])
+
+
+async def _embed_batch(texts: List[str], model: str) -> List[List[float]]:
+    """One /api/embed request for a batch of texts."""
+    payload = {"model": model, "input": texts}
+    response = await get_http_client().post(
+        OLLAMA_EMBED_BATCH_URL, json=payload, timeout=_timeout(OLLAMA_EMBEDDING_TIMEOUT)
+    )
+    response.raise_for_status()
+    data = response.json()
+    embeddings = data.get("embeddings")
+    if not isinstance(embeddings, list) or len(embeddings) != len(texts):
+        raise ValueError("Invalid response from Ollama API: 'embeddings' missing or wrong length")
+    return [_validate_embedding(e) for e in embeddings]
+
+
+async def _embed_parallel(texts: List[str], model: str) -> List[List[float]]:
+    """Fallback for servers without /api/embed: bounded parallel single-text calls."""
+    semaphore = asyncio.Semaphore(OLLAMA_EMBED_FALLBACK_CONCURRENCY)
+
+    async def one(text: str) -> List[float]:
+        async with semaphore:
+            return await aget_embedding(text, model=model)
+
+    return list(await asyncio.gather(*(one(t) for t in texts)))
+
+
+async def aget_embeddings(texts: List[str], model: str = DEFAULT_EMBEDDING_MODEL) -> List[List[float]]:
+    """
+    Get embeddings for several texts without blocking the event loop.
+
+    Texts found in the embedding cache are not sent; the rest (deduplicated,
+    and coalesced with identical requests already in flight) go to Ollama's
+    batch /api/embed endpoint in OLLAMA_EMBED_BATCH_SIZE chunks. If the server
+    does not know that endpoint (404), falls back to parallel /api/embeddings
+    calls and remembers the fallback for later calls.
+
+    Args:
+        texts (List[str]): The texts to embed.
+        model (str): The model to use for embeddings. Defaults to "bge-m3".
+
+    Returns:
+        List[List[float]]: One embedding vector per input text, in input order.
+
+    Raises:
+        httpx.HTTPError: If there's an error with the HTTP request.
+        ValueError: If the response is invalid or missing expected fields.
+    """
+    if not texts:
+        return []
+
+    results = await embedding_cache.aget_many(model, texts)
+    pending = list(dict.fromkeys(t for t, r in zip(texts, results) if r is None))
+    if not pending:
+        return results  # type: ignore[return-value]
+
+    key = (model, tuple(pending))
+    computed = await _embedding_flight.do(key, lambda: _fetch_embeddings(pending, model))
+    # Shared with other single-flight waiters and duplicate texts: hand out copies
+    return [r if r is not None else list(computed[t]) for t, r in zip(texts, results)]
+
+
+async def _fetch_embeddings(texts: List[str], model: str) -> Dict[str, List[float]]:
+    """Embed `texts` with Ollama (batched, with fallback) and populate the cache."""
+    global _batch_embed_supported
+    logger.info(f"Calling Ollama embeddings API (async) for {len(texts)} texts with model {model}")
+    try:
+        embeddings: List[List[float]] = []
+        for start in range(0, len(texts), OLLAMA_EMBED_BATCH_SIZE):
+            batch = texts[start:start + OLLAMA_EMBED_BATCH_SIZE]
+            if _batch_embed_supported:
+                try:
+                    embeddings.extend(await _embed_batch(batch, model))
+                    continue
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code != 404:
+                        raise
+                    logger.warning("Ollama server has no /api/embed endpoint; falling back to single-text embeddings")
+                    _batch_embed_supported = False
+            embeddings.extend(await _embed_parallel(batch, model))
+        logger.info(f"Successfully generated {len(embeddings)} embeddings with Ollama")
+        computed = dict(zip(texts, embeddings))
+        await embedding_cache.aput_many(model, computed)
+        return computed
+    except httpx.HTTPError as e:
+        logger.error(f"Error calling Ollama embeddings API: {e}")
+        raise
+    except ValueError as e:
+        logger.error(f"Invalid response from Ollama embeddings API: {e}")
+        raise
+
 # --- Test functions ---
 def test_generate():
     """Test the generate_text function with a simple prompt."""
@@ -244,6 +544,7 @@ if __name__ == "__main__":
     print("OLLAMA_BASE_URL:", OLLAMA_BASE_URL)
     print("OLLAMA_GENERATE_URL:", OLLAMA_GENERATE_URL)
     print("OLLAMA_EMBEDDING_URL:", OLLAMA_EMBEDDING_URL)
+    print("OLLAMA_EMBED_BATCH_URL:", OLLAMA_EMBED_BATCH_URL)
     print("OLLAMA_TAGS_URL:", OLLAMA_TAGS_URL)
     print("DEFAULT_GENERATE_MODEL:", DEFAULT_GENERATE_MODEL)
     print("DEFAULT_EMBEDDING_MODEL:", DEFAULT_EMBEDDING_MODEL)
\ No newline at end of file
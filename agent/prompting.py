@@ -0,0 +1,276 @@
+"""
+Token-budgeted prompt assembly for the Mai-Sale chat application.
+
+The prompt is built from fixed parts (instruction, latest user message), the
+most recent conversation turns and retrieved chunks, within a token budget:
+
+1. The latest user message is always included.
+2. The rolling conversation summary (agent/summaries.py), if any, comes next;
+   it stands in for the turns before the summary watermark.
+3. Older turns are added newest-first up to PROMPT_HISTORY_SHARE of the budget.
+4. Retrieved chunks are added by score until the rest of the budget is spent.
+
+History lines are counted with the token counts stored on the messages at
+write time (messages.tokens_estimate), so history is not re-tokenized on every
+turn; the history loader picks the window with the same counts in SQL
+(`agent.database.get_context_window`, PROMPT_HISTORY_TOKENS). The serialized
+history is cached per conversation as one joined text with running token
+totals: each turn appends only the new messages, and the older turns that fit
+are one slice of that text, found by bisecting the totals.
+"""
+
+import os
+import bisect
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from agent.cache import LRUCache
+from agent.tokens import count_tokens, message_tokens
+
+# --- Configuration ---
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 4096))
+PROMPT_HISTORY_SHARE = float(os.environ.get("PROMPT_HISTORY_SHARE", 0.6))
+# Most recent messages loaded per turn; older turns rarely fit the history share of the budget
+PROMPT_HISTORY_WINDOW = int(os.environ.get("PROMPT_HISTORY_WINDOW", 64))
+# Token budget used to select the history window when loading it
+PROMPT_HISTORY_TOKENS = int(PROMPT_TOKEN_BUDGET * PROMPT_HISTORY_SHARE)
+PROMPT_CACHE_CONVERSATIONS = int(os.environ.get("PROMPT_CACHE_CONVERSATIONS", 1000))
+PROMPT_CACHE_MESSAGES_PER_CONVERSATION = 512
+
+INSTRUCTION = "Instruction: Provide a concise answer in about 5 sentences. Be clear, direct, and avoid unnecessary details."
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+# conversation_id -> _SerializedHistory
+_history_cache = LRUCache(PROMPT_CACHE_CONVERSATIONS)
+
+
+def _stored_tokens(msg: Any) -> Optional[int]:
+    if isinstance(msg, dict):
+        return msg.get("tokens")
+    return getattr(msg, "tokens_estimate", None)
+
+
+def _message_fields(msg: Any) -> Tuple[str, str, Optional[str]]:
+    if isinstance(msg, dict):
+        return msg.get("role") or "user", msg.get("content") or "", msg.get("id")
+    return getattr(msg, "role", "user"), getattr(msg, "content", ""), getattr(msg, "id", None)
+
+
+def message_key(role: str, content: str, message_id: Optional[str]) -> str:
+    if message_id:
+        return str(message_id)
+    return hashlib.sha1(f"{role}\x00{content}".encode("utf-8")).hexdigest()
+
+
+class _SerializedHistory:
+    """
+    A conversation's history serialized once: the joined "role: content" text,
+    where each line starts in it, and running token totals.
+
+    New turns are appended to the text; the newest lines that fit a budget are
+    found by bisecting the totals and returned as one slice of the text.
+    """
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.text = ""
+        self.offsets: List[int] = []  # start of line i in `text`
+        self.totals: List[int] = [0]  # totals[i] = tokens of lines [0, i)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def append(self, key: str, line: str, tokens: int) -> None:
+        self.positions[key] = len(self.keys)
+        self.keys.append(key)
+        if self.text:
+            self.text = f"{self.text}\n{line}"
+            self.offsets.append(len(self.text) - len(line))
+        else:
+            self.text = line
+            self.offsets.append(0)
+        self.totals.append(self.totals[-1] + tokens)
+
+    def line(self, i: int) -> str:
+        end = self.offsets[i + 1] - 1 if i + 1 < len(self.keys) else len(self.text)
+        return self.text[self.offsets[i]:end]
+
+    def tokens(self, start: int, end: int) -> int:
+        return self.totals[end] - self.totals[start]
+
+    def newest(self, start: int, end: int, budget: int) -> Tuple[int, str]:
+        """The newest lines of [start, end) whose tokens fit `budget`: (first index, joined text)."""
+        first = bisect.bisect_left(self.totals, self.totals[end] - budget, start, end)
+        if first >= end:
+            return end, ""
+        stop = self.offsets[end] - 1 if end < len(self.keys) else len(self.text)
+        return first, self.text[self.offsets[first]:stop]
+
+
+def _serialized(chat_history: List[Any], conversation_id: Optional[str]) -> Tuple[_SerializedHistory, int]:
+    """
+    Serialized history for `chat_history` and the index of its first message in it.
+
+    With a `conversation_id` the cached serialization is reused when its last
+    messages line up with the start of `chat_history` (the window only slides
+    forward), and only the messages after them are serialized and appended.
+    """
+    keys = []
+    for msg in chat_history:
+        role, content, message_id = _message_fields(msg)
+        keys.append(message_key(role, content, message_id))
+
+    history = _history_cache.get(conversation_id) if conversation_id else None
+    start = history.positions.get(keys[0]) if history is not None and keys else None
+    if start is not None:
+        overlap = len(history) - start
+        if overlap > len(keys) or keys[:overlap] != history.keys[start:] or start > PROMPT_CACHE_MESSAGES_PER_CONVERSATION:
+            start = None
+    if start is None:
+        history, start, overlap = _SerializedHistory(), 0, 0
+        if conversation_id:
+            _history_cache.set(conversation_id, history)
+
+    for msg, key in zip(chat_history[overlap:], keys[overlap:]):
+        role, content, _ = _message_fields(msg)
+        history.append(key, f"{role}: {content}", message_tokens(role, content, _stored_tokens(msg)))
+    return history, start
+
+
+def serialize_history(chat_history: List[Any], conversation_id: Optional[str] = None) -> List[Tuple[str, int]]:
+    """
+    Serialize messages to "role: content" lines with token counts.
+
+    Messages carrying a stored count ('tokens' key, or `tokens_estimate`) are not re-tokenized.
+
+    With a `conversation_id`, messages serialized on a previous turn are reused
+    from the per-conversation cache.
+    """
+    history, start = _serialized(chat_history, conversation_id)
+    return [(history.line(i), history.tokens(i, i + 1)) for i in range(start, len(history))]
+
+
+def _context_text(chunk: Dict[str, Any]) -> str:
+    return chunk.get("document") or chunk.get("text") or chunk.get("content") or ""
+
+
+def _by_score(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Order chunks best-first: re-rank 'rank', else 'score' (higher is better), else 'distance', else as given."""
+    if chunks and all("rank" in c for c in chunks):
+        return sorted(chunks, key=lambda c: c["rank"])
+    if chunks and all("score" in c for c in chunks):
+        return sorted(chunks, key=lambda c: c["score"], reverse=True)
+    if chunks and all("distance" in c for c in chunks):
+        return sorted(chunks, key=lambda c: c["distance"])
+    return list(chunks)
+
+
+def assemble_prompt(
+    chat_history: List[Any],
+    retrieved_context: Optional[List[Dict[str, Any]]] = None,
+    conversation_id: Optional[str] = None,
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+    summary: Optional[str] = None,
+) -> str:
+    """
+    Build the LLM prompt from history, summary and retrieved context within `token_budget`.
+
+    Args:
+        chat_history (List): Messages (dicts with 'role', 'content' and optional 'id').
+        retrieved_context (Optional[List[Dict]]): Retrieved chunks, ideally re-ranked.
+        conversation_id (Optional[str]): Enables the per-conversation serialization cache.
+        token_budget (int): Approximate max tokens for the whole prompt.
+        summary (Optional[str]): Running summary of the turns before `chat_history`.
+
+    Returns:
+        str: The prompt text.
+    """
+    history, start = _serialized(chat_history, conversation_id)
+    end = len(history)
+    older_end = max(start, end - 1)
+    latest = history.line(end - 1) if end > start else None
+
+    fixed = [INSTRUCTION, "Conversation:", "Assistant:"]
+    used = sum(count_tokens(p) for p in fixed) + history.tokens(older_end, end)
+    summary_line = f"Summary of earlier conversation: {summary}" if summary else None
+    if summary_line:
+        used += count_tokens(summary_line)
+
+    # Most recent turns first, up to the history share of the budget
+    history_budget = max(0, int(token_budget * PROMPT_HISTORY_SHARE) - used)
+    first_kept, kept = history.newest(start, older_end, history_budget)
+    used += history.tokens(first_kept, older_end)
+
+    # Retrieved chunks by score with what is left
+    context_budget = token_budget - used - count_tokens("Retrieved context:")
+    context_parts: List[str] = []
+    for chunk in _by_score(retrieved_context or []):
+        text = _context_text(chunk)
+        tokens = count_tokens(text)
+        if not text or tokens > context_budget:
+            continue
+        context_parts.append(text)
+        context_budget -= tokens
+
+    if first_kept > start or len(context_parts) < len(retrieved_context or []):
+        logger.info(
+            f"Prompt budget {token_budget}: kept {older_end - first_kept}/{older_end - start} older turns, "
+            f"{len(context_parts)}/{len(retrieved_context or [])} context chunks"
+        )
+
+    parts: List[str] = []
+    # include retrieved context first if present
+    if context_parts:
+        parts.append("Retrieved context:")
+        parts.extend(context_parts)
+    parts.append(INSTRUCTION)
+    if summary_line:
+        parts.append(summary_line)
+    parts.append("Conversation:")
+    if kept:
+        parts.append(kept)
+    if latest is not None:
+        parts.append(latest)
+    parts.append("Assistant:")
+    return "\n".join(parts)
+
+
+def assemble_continuation_prompt(
+    latest_message: Any,
+    retrieved_context: Optional[List[Dict[str, Any]]] = None,
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+) -> str:
+    """
+    Prompt for a turn that continues from a cached Ollama context.
+
+    Earlier turns (and the instruction) are already in the context tokens, so
+    only this turn's retrieved chunks and the new user message are sent.
+    """
+    role, content, _ = _message_fields(latest_message)
+    latest_line = f"{role}: {content}"
+    context_budget = token_budget - count_tokens(latest_line) - count_tokens("Retrieved context:")
+    parts: List[str] = []
+    for chunk in _by_score(retrieved_context or []):
+        text = _context_text(chunk)
+        tokens = count_tokens(text)
+        if not text or tokens > context_budget:
+            continue
+        if not parts:
+            parts.append("Retrieved context:")
+        parts.append(text)
+        context_budget -= tokens
+    parts.append(latest_line)
+    parts.append("Assistant:")
+    return "\n".join(parts)
+
+
+def clear_prompt_cache(conversation_id: Optional[str] = None) -> None:
+    """Drop cached serialized history for one conversation (or all)."""
+    if conversation_id is None:
+        _history_cache.clear()
+    else:
+        _history_cache.pop(conversation_id)
@@ -0,0 +1,192 @@
+"""
+Semantic answer cache for the Mai-Sale chat application.
+
+Near-duplicate product questions ("Pixel 10 chip là gì?") are answered from a
+cache instead of calling the LLM:
+
+- Questions are embedded (bge-m3) and compared by cosine similarity against an
+  in-process NumPy index, one per tenant.
+- A hit requires similarity >= RESPONSE_CACHE_THRESHOLD and the same retrieved
+  knowledge fingerprint, so an answer is never reused with different sources.
+- Entries expire after RESPONSE_CACHE_TTL seconds; each tenant keeps at most
+  RESPONSE_CACHE_MAX_ENTRIES (oldest evicted first).
+
+Only answers built from shared knowledge are stored; turns that used
+conversation memory (personal context) are never cached. The earlier turns
+and the rolling summary in the prompt are part of the fingerprint too, so an
+answer is only reused for a conversation with the same preceding context
+(in practice: first turns).
+"""
+
+import os
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# --- Configuration ---
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get("RESPONSE_CACHE_THRESHOLD", 0.95))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 2000))
+# Very short follow-ups ("còn cái kia?") depend on history, so they are not cached
+RESPONSE_CACHE_MIN_CHARS = int(os.environ.get("RESPONSE_CACHE_MIN_CHARS", 12))
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    fingerprint: str
+    expires_at: float
+
+
+def _turn_text(msg: Any) -> str:
+    if isinstance(msg, dict):
+        return f"{msg.get('role')}: {msg.get('content')}"
+    return f"{getattr(msg, 'type', 'user')}: {getattr(msg, 'content', '')}"
+
+
+def context_fingerprint(
+    retrieved_context: Optional[List[Dict[str, Any]]],
+    prior_turns: Optional[List[Any]] = None,
+    summary: Optional[str] = None,
+) -> Optional[str]:
+    """
+    Fingerprint of everything besides the question that an answer was built from.
+
+    Args:
+        retrieved_context (Optional[List[Dict]]): The retrieved chunks.
+        prior_turns (Optional[List]): Conversation turns before the question.
+        summary (Optional[str]): Rolling summary of the conversation.
+
+    Returns:
+        Optional[str]: None when the context contains conversation-scoped chunks
+        (chat memory), which makes the answer personal and therefore not cacheable.
+    """
+    ids = []
+    for chunk in retrieved_context or []:
+        metadata = chunk.get("metadata") or {}
+        if metadata.get("conversation_id"):
+            return None
+        ids.append(str(chunk.get("id")))
+    digest = hashlib.sha1("\x00".join(sorted(ids)).encode("utf-8"))
+    # Answers to "what is my name?" depend on the conversation, not only on the chunks
+    for turn in prior_turns or []:
+        digest.update(b"\x01" + _turn_text(turn).encode("utf-8"))
+    if summary:
+        digest.update(b"\x02" + summary.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class _TenantIndex:
+    """Normalized question vectors (one row per entry) plus their answers."""
+
+    def __init__(self):
+        self.entries: List[CachedAnswer] = []
+        self.vectors: Optional[np.ndarray] = None
+
+    def purge(self, now: float) -> int:
+        keep = [i for i, e in enumerate(self.entries) if e.expires_at > now]
+        removed = len(self.entries) - len(keep)
+        if removed:
+            self.entries = [self.entries[i] for i in keep]
+            self.vectors = self.vectors[keep] if keep else None
+        return removed
+
+
+class SemanticResponseCache:
+    """Per-tenant semantic cache of LLM answers with TTL and hit-rate counters."""
+
+    def __init__(
+        self,
+        threshold: float = RESPONSE_CACHE_THRESHOLD,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._tenants: Dict[str, _TenantIndex] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.expired = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, tenant: str, embedding: List[float], fingerprint: Optional[str]) -> Optional[CachedAnswer]:
+        """Return the cached answer for the most similar question, if close enough."""
+        if fingerprint is None:
+            return None
+        self.lookups += 1
+        query = self._normalize(embedding)
+        with self._lock:
+            index = self._tenants.get(tenant)
+            if index is None:
+                return None
+            self.expired += index.purge(time.time())
+            if index.vectors is None or index.vectors.shape[1] != query.shape[0]:
+                return None
+            similarities = index.vectors @ query
+            mask = np.fromiter((e.fingerprint == fingerprint for e in index.entries), dtype=bool, count=len(index.entries))
+            if not mask.any():
+                return None
+            similarities = np.where(mask, similarities, -1.0)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            self.hits += 1
+            entry = index.entries[best]
+        logger.info(f"Response cache hit for tenant {tenant} (similarity {similarities[best]:.3f}): '{entry.question}'")
+        return entry
+
+    def store(self, tenant: str, question: str, embedding: List[float], fingerprint: Optional[str], answer: str) -> None:
+        """Cache `answer` for `question` (ignored for personal / empty answers)."""
+        if fingerprint is None or not answer:
+            return
+        vector = self._normalize(embedding)[np.newaxis, :]
+        entry = CachedAnswer(question=question, answer=answer, fingerprint=fingerprint, expires_at=time.time() + self.ttl)
+        with self._lock:
+            index = self._tenants.setdefault(tenant, _TenantIndex())
+            if index.vectors is not None and index.vectors.shape[1] != vector.shape[1]:
+                index.entries, index.vectors = [], None  # embedding model changed
+            index.entries.append(entry)
+            index.vectors = vector if index.vectors is None else np.vstack([index.vectors, vector])
+            overflow = len(index.entries) - self.max_entries
+            if overflow > 0:
+                index.entries = index.entries[overflow:]
+                index.vectors = index.vectors[overflow:]
+            self.stores += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tenants.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "entries": sum(len(t.entries) for t in self._tenants.values()),
+            "tenants": len(self._tenants),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "stores": self.stores,
+            "expired": self.expired,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
+
+
+# Process-wide instance used by the flow
+response_cache = SemanticResponseCache()
@@ -0,0 +1,242 @@
+"""
+Short-TTL cache for vector retrieval results.
+
+UI retries, regenerations and users re-asking the same question repeat the
+exact same query; `aquery_vectors` / `query_vectors` answer those from this
+cache instead of embedding the text and querying Chroma again.
+
+- Key: (collection, normalized query text, filter_metadata, top_k,
+  include_embeddings) plus the current write generation of what the query
+  can see.
+- Generations: every upsert bumps the collection's generation and the
+  generation of each conversation it wrote to. Queries filtered on a
+  conversation_id depend only on that conversation's generation, so a new
+  message in one chat never evicts another chat's entries; other queries
+  depend on the collection generation. Stale entries are never read again
+  and age out through TTL / LRU eviction.
+- Backends: in-process LRU (default, per worker) or a local Redis-compatible
+  server (Redis, Valkey, KeyDB) shared by all workers, selected with
+  RETRIEVAL_CACHE_BACKEND. With the Redis backend, writes made by the job
+  worker process also invalidate the API workers' entries.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from agent.cache import LRUCache
+from agent.embedding_cache import normalize_text
+
+try:
+    import redis  # optional: shared cache across uvicorn / job workers
+except ImportError:
+    redis = None
+
+# --- Configuration ---
+RETRIEVAL_CACHE_ENABLED = os.environ.get("RETRIEVAL_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# "memory" (per process) or "redis"
+RETRIEVAL_CACHE_BACKEND = os.environ.get("RETRIEVAL_CACHE_BACKEND", "memory").lower()
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL", 60))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 2000))
+RETRIEVAL_CACHE_REDIS_URL = os.environ.get("RETRIEVAL_CACHE_REDIS_URL", "redis://localhost:6379/0")
+_REDIS_PREFIX = "retrieval:"
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+def _scope(collection: str, filter_metadata: Optional[Dict[str, Any]]) -> Tuple[str, ...]:
+    """The generation counter a query depends on."""
+    conversation_id = (filter_metadata or {}).get("conversation_id")
+    if conversation_id is not None:
+        return (collection, "conversation", str(conversation_id))
+    return (collection,)
+
+
+class MemoryBackend:
+    """Per-process backend: an LRU with TTL plus in-memory generation counters."""
+
+    blocking = False
+
+    def __init__(self, maxsize: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL):
+        self.entries = LRUCache(maxsize, ttl=ttl)
+        self._generations: Dict[Tuple[str, ...], int] = {}
+        self._lock = threading.Lock()
+
+    def generation(self, scope: Tuple[str, ...]) -> int:
+        return self._generations.get(scope, 0)
+
+    def bump(self, scopes: Iterable[Tuple[str, ...]]) -> None:
+        with self._lock:
+            for scope in scopes:
+                self._generations[scope] = self._generations.get(scope, 0) + 1
+
+    def get(self, key: Hashable) -> Optional[List[Dict[str, Any]]]:
+        return self.entries.get(key)
+
+    def set(self, key: Hashable, results: List[Dict[str, Any]]) -> None:
+        self.entries.set(key, results)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        with self._lock:
+            self._generations.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return self.entries.stats()
+
+
+class RedisBackend:
+    """
+    Shared backend on a Redis-compatible server.
+
+    Entries are JSON strings stored with SETEX; generations are INCR counters.
+    Size is bounded by the server's maxmemory policy (use allkeys-lru).
+    """
+
+    blocking = True
+
+    def __init__(self, url: str = RETRIEVAL_CACHE_REDIS_URL, ttl: float = RETRIEVAL_CACHE_TTL):
+        if redis is None:
+            raise RuntimeError("RETRIEVAL_CACHE_BACKEND=redis requires the 'redis' package")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = max(1, int(ttl))
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _generation_key(scope: Tuple[str, ...]) -> str:
+        return _REDIS_PREFIX + "gen:" + ":".join(scope)
+
+    @staticmethod
+    def _entry_key(key: Hashable) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return _REDIS_PREFIX + "q:" + digest
+
+    def generation(self, scope: Tuple[str, ...]) -> int:
+        return int(self.client.get(self._generation_key(scope)) or 0)
+
+    def bump(self, scopes: Iterable[Tuple[str, ...]]) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        for scope in scopes:
+            pipe.incr(self._generation_key(scope))
+        pipe.execute()
+
+    def get(self, key: Hashable) -> Optional[List[Dict[str, Any]]]:
+        raw = self.client.get(self._entry_key(key))
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key: Hashable, results: List[Dict[str, Any]]) -> None:
+        self.client.setex(self._entry_key(key), self.ttl, json.dumps(results, ensure_ascii=False))
+
+    def clear(self) -> None:
+        keys = list(self.client.scan_iter(match=_REDIS_PREFIX + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "ttl": self.ttl}
+
+
+class RetrievalCache:
+    """Retrieval results keyed by query and filters, invalidated by write generations."""
+
+    def __init__(self, backend: Any = None, enabled: bool = RETRIEVAL_CACHE_ENABLED):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.enabled = enabled
+        self.errors = 0
+        self.invalidations = 0
+
+    def make_key(
+        self,
+        collection: str,
+        query_text: str,
+        filter_metadata: Optional[Dict[str, Any]],
+        top_k: int,
+        include_embeddings: bool = False,
+    ) -> Hashable:
+        """
+        Cache key for a query at the current generation of its scope.
+
+        Compute it before running the query: if a write lands meanwhile, the
+        result is stored under the old generation and never served.
+        """
+        scope = _scope(collection, filter_metadata)
+        return (
+            collection,
+            normalize_text(query_text),
+            tuple(sorted((filter_metadata or {}).items())),
+            top_k,
+            include_embeddings,
+            self.backend.generation(scope),
+        )
+
+    def get(self, key: Hashable) -> Optional[List[Dict[str, Any]]]:
+        """Cached results (a fresh copy of each dict), or None."""
+        if not self.enabled:
+            return None
+        try:
+            results = self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Retrieval cache read failed: {e}")
+            return None
+        return None if results is None else [dict(r) for r in results]
+
+    def set(self, key: Hashable, results: List[Dict[str, Any]]) -> None:
+        if not self.enabled:
+            return
+        try:
+            self.backend.set(key, [dict(r) for r in results])
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Retrieval cache write failed: {e}")
+
+    def invalidate(self, collection: str, metadatas: Optional[List[Optional[Dict[str, Any]]]] = None) -> None:
+        """Called after every write to `collection`; bumps its generation and those of the touched conversations."""
+        if not self.enabled:
+            return
+        scopes = {(collection,)}
+        for metadata in metadatas or []:
+            conversation_id = (metadata or {}).get("conversation_id")
+            if conversation_id is not None:
+                scopes.add((collection, "conversation", str(conversation_id)))
+        try:
+            self.backend.bump(scopes)
+            self.invalidations += 1
+        except Exception as e:
+            # A missed bump could serve stale results until the TTL expires
+            self.errors += 1
+            logger.warning(f"Retrieval cache invalidation failed for '{collection}': {e}")
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "invalidations": self.invalidations,
+            "errors": self.errors,
+            **self.backend.stats(),
+        }
+
+
+def _create_retrieval_cache() -> RetrievalCache:
+    if RETRIEVAL_CACHE_BACKEND == "redis":
+        try:
+            return RetrievalCache(RedisBackend())
+        except Exception as e:
+            logger.warning(f"Redis retrieval cache unavailable ({e}); using in-process cache")
+    return RetrievalCache(MemoryBackend())
+
+
+# Process-wide cache used by the retriever
+retrieval_cache = _create_retrieval_cache()
@@ -5,23 +5,59 @@ This module provides functions to interact with ChromaDB for vector retrieval:
 - Initialize PersistentClient with CHROMA_PATH
 - Query vectors with filters and top-K selection
 - Simple re-ranking based on scores and heuristics
+
+`aquery_vectors` / `aupsert_vectors` are the async entry points used by the
+flow and the API; they embed through `aget_embeddings` and run the blocking
+Chroma calls on the dedicated Chroma thread pool, so the event loop is never
+blocked on Ollama or Chroma. Collections exported with
+scripts/export_vector_index.py and listed in VECTOR_INDEX_COLLECTIONS are
+served from the in-process mmap index (agent/vector_index.py) instead.
+Repeated queries are answered from the retrieval cache
+(agent/retrieval_cache.py), which every upsert invalidates.
 """
 
 import os
+import asyncio
 import chromadb
+import numpy as np
+from datetime import datetime
 from chromadb import Documents, EmbeddingFunction, Embeddings
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import logging
-from agent.ollama_client import get_embedding
+from agent.ollama_client import get_embedding, aget_embeddings
+from agent.singleflight import SingleFlight
+from agent.chroma_pool import chroma_pool
+from agent.vector_index import get_vector_index
+from agent.lexical import lexical_index, LEXICAL_ENABLED
+from agent.tokens import count_tokens
+from agent.retrieval_cache import retrieval_cache
 
 # --- Configuration ---
 CHROMA_PATH = os.environ.get("CHROMA_PATH", "./database/chroma_db")
 DEFAULT_TOP_K = 3
 DEFAULT_COLLECTION_NAME = "conversations_dev"
+# Chat messages (filtered per conversation/user) and indexed knowledge live in separate collections
+MEMORY_COLLECTION_NAME = os.environ.get("MEMORY_COLLECTION_NAME", DEFAULT_COLLECTION_NAME)
+# "{tenant}" in the name gives each tenant its own knowledge collection, e.g. "knowledge_{tenant}"
+KNOWLEDGE_COLLECTION_NAME = os.environ.get("KNOWLEDGE_COLLECTION_NAME", "knowledge")
+# Tenant of requests without one (e.g. background jobs and scripts)
+DEFAULT_TENANT = "default"
+RRF_K = int(os.environ.get("RRF_K", 60))  # reciprocal rank fusion constant
+# Over-fetch N candidates, re-rank, keep up to K that fit the context token budget
+RETRIEVAL_CANDIDATES = int(os.environ.get("RETRIEVAL_CANDIDATES", 20))
+RERANK_MAX_K = int(os.environ.get("RERANK_MAX_K", 10))
+RERANK_TOKEN_BUDGET = int(os.environ.get("RERANK_TOKEN_BUDGET", 1536))
+RERANK_FRESHNESS_WEIGHT = float(os.environ.get("RERANK_FRESHNESS_WEIGHT", 0.2))
+RERANK_FRESHNESS_HALF_LIFE_HOURS = float(os.environ.get("RERANK_FRESHNESS_HALF_LIFE_HOURS", 72))
+# MMR diversity: unset disables, e.g. 0.7 trades a little relevance for less redundant chunks
+RERANK_MMR_LAMBDA = float(os.environ["RERANK_MMR_LAMBDA"]) if os.environ.get("RERANK_MMR_LAMBDA") else None
 
 # --- Logging ---
 logger = logging.getLogger(__name__)
 
+# Concurrent identical queries (same text, collection, filters, top_k) share one embedding + Chroma query
+_query_flight = SingleFlight("retrieval")
+
 # --- ChromaDB Client ---
 # Create persistent client
 chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
@@ -30,6 +66,10 @@ def get_or_create_collection(name: str = DEFAULT_COLLECTION_NAME):
     """Get or create a ChromaDB collection."""
     return chroma_client.get_or_create_collection(name)
 
+def knowledge_collection_name(tenant_id: Optional[str] = None) -> str:
+    """Knowledge collection for `tenant_id` (the same global collection unless the name contains "{tenant}")."""
+    return KNOWLEDGE_COLLECTION_NAME.format(tenant=tenant_id or DEFAULT_TENANT)
+
 # --- Retrieval Functions ---
 
 def query_vectors(
@@ -52,84 +92,311 @@ def query_vectors(
     """
     logger.info(f"Querying vectors from collection '{collection_name}' with top_k={top_k}")
     
+    cache_key = retrieval_cache.make_key(collection_name, query_text, filter_metadata, top_k)
+    cached = retrieval_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Retrieval cache hit for collection '{collection_name}'")
+        return cached
     try:
         # Get embedding for query text
         query_embedding = get_embedding(query_text)
-        
-        # Get collection
-        collection = get_or_create_collection(collection_name)
-        
-        # Query collection
-        # ChromaDB requires $and operator for multiple filters
-        chroma_where = None
-        if filter_metadata:
-            if len(filter_metadata) == 1:
-                # Single filter, can use directly
-                chroma_where = filter_metadata
-            else:
-                # Multiple filters, need to use $and
-                chroma_where = {"$and": [{k: v} for k, v in filter_metadata.items()]}
-        
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k,
-            where=chroma_where,
-        )
-        
-        # Format results
-        formatted_results = []
-        for i in range(len(results['ids'][0])):
-            formatted_results.append({
-                'id': results['ids'][0][i],
-                'document': results['documents'][0][i],
-                'metadata': results['metadatas'][0][i],
-                'distance': results['distances'][0][i],
-            })
-            
-        logger.info(f"Retrieved {len(formatted_results)} results from ChromaDB")
-        return formatted_results
-        
+        index = get_vector_index(collection_name)
+        if index is not None:
+            results = index.search(query_embedding, top_k, filter_metadata)
+        else:
+            results = _query_collection(query_embedding, collection_name, top_k, filter_metadata)
+        retrieval_cache.set(cache_key, results)
+        return results
     except Exception as e:
         logger.error(f"Error querying vectors from ChromaDB: {e}")
         raise
 
-def simple_rerank(results: List[Dict[str, Any]], query_metadata: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+async def aquery_vectors(
+    query_text: str,
+    collection_name: str = DEFAULT_COLLECTION_NAME,
+    top_k: int = DEFAULT_TOP_K,
+    filter_metadata: Optional[Dict[str, Any]] = None,
+    include_embeddings: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Async variant of `query_vectors`; the query embedding is fetched with `aget_embeddings`.
+
+    Repeated queries are served from the retrieval cache and identical
+    concurrent queries are coalesced into one; each caller gets its own copy
+    of the result dicts so re-ranking cannot leak between requests. With
+    `include_embeddings`, each result also carries its 'embedding' (for MMR).
+    """
+    if retrieval_cache.backend.blocking:
+        cache_key = await asyncio.to_thread(
+            retrieval_cache.make_key, collection_name, query_text, filter_metadata, top_k, include_embeddings
+        )
+        cached = await asyncio.to_thread(retrieval_cache.get, cache_key)
+    else:
+        cache_key = retrieval_cache.make_key(collection_name, query_text, filter_metadata, top_k, include_embeddings)
+        cached = retrieval_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Retrieval cache hit for collection '{collection_name}'")
+        return cached
+
+    async def run_query() -> List[Dict[str, Any]]:
+        logger.info(f"Querying vectors (async) from collection '{collection_name}' with top_k={top_k}")
+        try:
+            query_embedding = (await aget_embeddings([query_text]))[0]
+            index = get_vector_index(collection_name)
+            if index is not None:
+                # Exported mmap index: exact scans are CPU-bound, keep them off the loop too
+                results = await chroma_pool.run(index.search, query_embedding, top_k, filter_metadata, include_embeddings)
+            else:
+                results = await chroma_pool.run(
+                    _query_collection, query_embedding, collection_name, top_k, filter_metadata, include_embeddings
+                )
+            if retrieval_cache.backend.blocking:
+                await asyncio.to_thread(retrieval_cache.set, cache_key, results)
+            else:
+                retrieval_cache.set(cache_key, results)
+            return results
+        except Exception as e:
+            logger.error(f"Error querying vectors from ChromaDB: {e}")
+            raise
+
+    # The cache key carries the query's write generation, so it is also a safe singleflight key
+    results = await _query_flight.do(cache_key, run_query)
+    return [dict(r) for r in results]
+
+def _build_where(filter_metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Translate a flat metadata filter into a Chroma `where` clause."""
+    # ChromaDB requires $and operator for multiple filters
+    if not filter_metadata:
+        return None
+    if len(filter_metadata) == 1:
+        # Single filter, can use directly
+        return filter_metadata
+    # Multiple filters, need to use $and
+    return {"$and": [{k: v} for k, v in filter_metadata.items()]}
+
+def _query_collection(
+    query_embedding: List[float],
+    collection_name: str,
+    top_k: int,
+    filter_metadata: Optional[Dict[str, Any]],
+    include_embeddings: bool = False,
+) -> List[Dict[str, Any]]:
+    """Run a Chroma query for a precomputed embedding and format the results."""
+    collection = get_or_create_collection(collection_name)
+    query_args = {}
+    if include_embeddings:
+        query_args['include'] = ['documents', 'metadatas', 'distances', 'embeddings']
+    results = collection.query(
+        query_embeddings=[query_embedding],
+        n_results=top_k,
+        where=_build_where(filter_metadata),
+        **query_args,
+    )
+    
+    # Format results
+    formatted_results = []
+    for i in range(len(results['ids'][0])):
+        formatted_results.append({
+            'id': results['ids'][0][i],
+            'document': results['documents'][0][i],
+            'metadata': results['metadatas'][0][i],
+            'distance': results['distances'][0][i],
+        })
+        if include_embeddings:
+            # Chroma returns numpy arrays; plain lists keep results JSON-serializable (Redis cache)
+            embedding = results['embeddings'][0][i]
+            formatted_results[-1]['embedding'] = embedding.tolist() if hasattr(embedding, 'tolist') else list(embedding)
+        
+    logger.info(f"Retrieved {len(formatted_results)} results from ChromaDB")
+    return formatted_results
+
+def simple_rerank(
+    results: List[Dict[str, Any]],
+    query_metadata: Optional[Dict[str, Any]] = None,
+    lexical_results: Optional[List[Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
     """
     Simple re-ranking of results based on distance and heuristics.
     
+    Score = -distance, +1.0 for the same conversation, +0.5 for the same user,
+    plus a freshness bonus for results with a 'created_at' metadata timestamp.
+    Computed as NumPy array operations over all candidates.
+
     Args:
         results (List[Dict]): List of results from query_vectors.
         query_metadata (Optional[Dict]): Metadata of the current query (e.g., conversation_id, user_id).
+        lexical_results (Optional[List[Dict]]): BM25 results from `alexical_query`. When given,
+            both lists are fused with reciprocal rank fusion.
         
     Returns:
-        List[Dict]: Re-ranked list of results.
+        List[Dict]: Re-ranked list of results, each with its 'score'.
     """
-    if not results:
-        return results
-        
-    logger.info(f"Re-ranking {len(results)} results")
-    
-    # For now, a simple re-ranking based on distance and same-conversation boost
-    def rank_score(result: Dict[str, Any]) -> float:
-        # Lower distance is better (closer vectors)
-        base_score = -result['distance']  # Negative because lower distance is better
-        
-        # Boost score if it's from the same conversation
-        if query_metadata and 'conversation_id' in query_metadata:
-            if result['metadata'] and result['metadata'].get('conversation_id') == query_metadata['conversation_id']:
-                base_score += 1.0  # Boost by 1.0 for same conversation
-                
-        # Boost score if it's from the same user
-        if query_metadata and 'user_id' in query_metadata:
-            if result['metadata'] and result['metadata'].get('user_id') == query_metadata['user_id']:
-                base_score += 0.5  # Boost by 0.5 for same user
-                
-        return base_score
-        
-    # Sort results by rank score (descending)
-    ranked_results = sorted(results, key=rank_score, reverse=True)
-    logger.info("Re-ranking completed")
-    return ranked_results
+    candidates, scores = _score_candidates(results, query_metadata, lexical_results)
+    if not candidates:
+        return candidates
+    order = np.argsort(-scores, kind="stable")
+    return [candidates[i] for i in order]
+
+def rerank_select(
+    results: List[Dict[str, Any]],
+    query_metadata: Optional[Dict[str, Any]] = None,
+    lexical_results: Optional[List[Dict[str, Any]]] = None,
+    top_k: int = RERANK_MAX_K,
+    token_budget: int = RERANK_TOKEN_BUDGET,
+    mmr_lambda: Optional[float] = RERANK_MMR_LAMBDA,
+) -> List[Dict[str, Any]]:
+    """
+    Re-rank a wide candidate set (e.g. RETRIEVAL_CANDIDATES from the vector
+    search) and pick the final context.
+
+    Candidates are scored like `simple_rerank`; with `mmr_lambda` set and
+    candidate embeddings present, selection uses maximal marginal relevance
+    (lambda * relevance - (1 - lambda) * max cosine similarity to chunks
+    already picked). Chunks are taken in that order while they fit in
+    `token_budget`, up to `top_k`.
+
+    Returns:
+        List[Dict]: The selected chunks, best first, without their embeddings. Each
+        has its 'score' and its 'rank' in the selection (1 = first), which is the
+        order `assemble_prompt` uses; with MMR it differs from the score order.
+    """
+    candidates, scores = _score_candidates(results, query_metadata, lexical_results)
+    if not candidates:
+        return []
+
+    tokens = [count_tokens(c.get('document') or '') for c in candidates]
+    similarity = _similarity_matrix(candidates) if mmr_lambda is not None else None
+    selected: List[int] = []
+    remaining_budget = token_budget
+
+    if similarity is None:
+        for i in np.argsort(-scores, kind="stable"):
+            if len(selected) >= top_k:
+                break
+            if tokens[i] <= remaining_budget:
+                selected.append(int(i))
+                remaining_budget -= tokens[i]
+    else:
+        # Put relevance on the same 0..1 scale as cosine similarity
+        spread = scores.max() - scores.min()
+        relevance = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+        token_array = np.asarray(tokens)
+        available = np.ones(len(candidates), dtype=bool)
+        max_similarity = np.zeros(len(candidates))
+        while len(selected) < top_k:
+            available &= token_array <= remaining_budget
+            if not available.any():
+                break
+            objective = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+            best = int(np.argmax(np.where(available, objective, -np.inf)))
+            selected.append(best)
+            available[best] = False
+            remaining_budget -= tokens[best]
+            max_similarity = np.maximum(max_similarity, similarity[best])
+
+    logger.info(f"Re-rank: selected {len(selected)}/{len(candidates)} candidates ({token_budget - remaining_budget} tokens)")
+    return [
+        {**{k: v for k, v in candidates[i].items() if k != 'embedding'}, 'rank': rank}
+        for rank, i in enumerate(selected, start=1)
+    ]
+
+def _score_candidates(
+    results: List[Dict[str, Any]],
+    query_metadata: Optional[Dict[str, Any]],
+    lexical_results: Optional[List[Dict[str, Any]]],
+) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """Candidates (fused with lexical results if given) and their scores as an array."""
+    if lexical_results is not None:
+        candidates, base = _fuse_candidates(results, lexical_results)
+        # Boosts scaled by 1 / RRF_K: a same-conversation boost is worth about one extra first place
+        scale = 1.0 / RRF_K
+    else:
+        candidates = list(results)
+        base = -np.fromiter((r['distance'] for r in candidates), dtype=np.float64, count=len(candidates))
+        scale = 1.0
+    if not candidates:
+        return candidates, base
+
+    metadatas = [r.get('metadata') or {} for r in candidates]
+    query_metadata = query_metadata or {}
+    boosts = np.zeros(len(candidates))
+    if 'conversation_id' in query_metadata:
+        # Boost by 1.0 for same conversation
+        boosts += 1.0 * np.fromiter(
+            (m.get('conversation_id') == query_metadata['conversation_id'] for m in metadatas), dtype=bool, count=len(metadatas)
+        )
+    if 'user_id' in query_metadata:
+        # Boost by 0.5 for same user
+        boosts += 0.5 * np.fromiter(
+            (m.get('user_id') == query_metadata['user_id'] for m in metadatas), dtype=bool, count=len(metadatas)
+        )
+    scores = base + scale * (boosts + _freshness(metadatas))
+    for result, score in zip(candidates, scores):
+        result['score'] = float(score)
+    return candidates, scores
+
+def _fuse_candidates(
+    vector_results: List[Dict[str, Any]],
+    lexical_results: List[Dict[str, Any]],
+) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """Reciprocal rank fusion: score = sum over lists of 1 / (RRF_K + rank)."""
+    fused: Dict[str, Dict[str, Any]] = {}
+    scores: Dict[str, float] = {}
+    ranked_vector = sorted(vector_results, key=lambda r: r['distance'])
+    ranked_lexical = sorted(lexical_results, key=lambda r: r['bm25'], reverse=True)
+    for ranked in (ranked_vector, ranked_lexical):
+        for rank, result in enumerate(ranked, start=1):
+            merged = fused.setdefault(result['id'], {})
+            for key, value in result.items():
+                merged.setdefault(key, value)
+            scores[result['id']] = scores.get(result['id'], 0.0) + 1.0 / (RRF_K + rank)
+    logger.info(f"Fused {len(vector_results)} vector + {len(lexical_results)} lexical results into {len(fused)}")
+    candidates = list(fused.values())
+    return candidates, np.fromiter((scores[r['id']] for r in candidates), dtype=np.float64, count=len(candidates))
+
+def _freshness(metadatas: List[Dict[str, Any]]) -> np.ndarray:
+    """RERANK_FRESHNESS_WEIGHT * 0.5 ** (age / half-life) for results with a 'created_at' timestamp."""
+    bonus = np.zeros(len(metadatas))
+    if RERANK_FRESHNESS_WEIGHT <= 0 or RERANK_FRESHNESS_HALF_LIFE_HOURS <= 0:
+        return bonus
+    now = datetime.utcnow()
+    ages = np.full(len(metadatas), np.nan)
+    for i, metadata in enumerate(metadatas):
+        created_at = metadata.get('created_at')
+        if not created_at:
+            continue
+        try:
+            ages[i] = max(0.0, (now - datetime.fromisoformat(str(created_at)).replace(tzinfo=None)).total_seconds() / 3600)
+        except ValueError:
+            continue
+    dated = ~np.isnan(ages)
+    bonus[dated] = RERANK_FRESHNESS_WEIGHT * np.power(0.5, ages[dated] / RERANK_FRESHNESS_HALF_LIFE_HOURS)
+    return bonus
+
+def _similarity_matrix(candidates: List[Dict[str, Any]]) -> Optional[np.ndarray]:
+    """Pairwise cosine similarity of candidate embeddings (0 for candidates without one)."""
+    dims = {len(c['embedding']) for c in candidates if c.get('embedding') is not None}
+    if len(dims) != 1:
+        return None
+    dim = dims.pop()
+    matrix = np.zeros((len(candidates), dim), dtype=np.float32)
+    for i, c in enumerate(candidates):
+        if c.get('embedding') is not None:
+            matrix[i] = c['embedding']
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+    return matrix @ matrix.T
+
+async def alexical_query(
+    query_text: str,
+    collection_name: str = DEFAULT_COLLECTION_NAME,
+    top_k: int = DEFAULT_TOP_K,
+    filter_metadata: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """BM25 results from the lexical index, run off the event loop ([] when disabled)."""
+    if not LEXICAL_ENABLED:
+        return []
+    return await asyncio.to_thread(lexical_index.search, collection_name, query_text, top_k, filter_metadata)
 
 def upsert_vectors(
     documents: List[str],
@@ -152,25 +419,66 @@ def upsert_vectors(
 
     logger.info(f"Upserting {len(documents)} documents into collection '{collection_name}'")
     try:
-        # Get embeddings for all documents in a single call if possible,
-        # but ollama_client supports one by one, which is fine for background tasks.
         embeddings = [get_embedding(doc) for doc in documents]
+        upsert_embedded(documents, metadatas, ids, embeddings, collection_name)
+    except Exception as e:
+        logger.error(f"Error upserting vectors to ChromaDB: {e}", exc_info=True)
+        raise
 
-        # Get collection
-        collection = get_or_create_collection(collection_name)
+async def aupsert_vectors(
+    documents: List[str],
+    metadatas: List[Dict[str, Any]],
+    ids: List[str],
+    collection_name: str = DEFAULT_COLLECTION_NAME,
+):
+    """
+    Async variant of `upsert_vectors`: all documents are embedded in one batch request.
+    """
+    if not documents:
+        logger.warning("Upsert called with no documents. Skipping.")
+        return
 
-        # Upsert into collection
-        collection.upsert(
-            ids=ids,
-            embeddings=embeddings,
-            documents=documents,
-            metadatas=metadatas,
-        )
-        logger.info(f"Successfully upserted {len(documents)} documents.")
+    logger.info(f"Upserting (async) {len(documents)} documents into collection '{collection_name}'")
+    try:
+        embeddings = await aget_embeddings(documents)
+        await chroma_pool.run(upsert_embedded, documents, metadatas, ids, embeddings, collection_name)
     except Exception as e:
         logger.error(f"Error upserting vectors to ChromaDB: {e}", exc_info=True)
         raise
 
+def upsert_embedded(
+    documents: List[str],
+    metadatas: List[Dict[str, Any]],
+    ids: List[str],
+    embeddings: List[List[float]],
+    collection_name: str,
+):
+    """
+    Upsert already-embedded documents (blocking; run it on `chroma_pool` from async code).
+
+    Also updates the lexical index and invalidates the retrieval cache for the collection.
+
+    Args:
+        documents (List[str]): Documents to store.
+        metadatas (List[Dict]): Metadata for each document.
+        ids (List[str]): Unique id for each document.
+        embeddings (List[List[float]]): Embedding for each document.
+        collection_name (str): The collection to upsert into.
+    """
+    collection = get_or_create_collection(collection_name)
+    collection.upsert(
+        ids=ids,
+        embeddings=embeddings,
+        documents=documents,
+        metadatas=metadatas,
+    )
+    if LEXICAL_ENABLED:
+        # Keep the BM25 index in step with Chroma (same ids)
+        lexical_index.upsert(collection_name, ids, documents, metadatas)
+    # Cached results for this collection (and the touched conversations) are now stale
+    retrieval_cache.invalidate(collection_name, metadatas)
+    logger.info(f"Successfully upserted {len(documents)} documents.")
+
 
 # --- Test functions ---
 def test_query_and_rerank():
@@ -0,0 +1,71 @@
+"""
+Request coalescing ("single-flight") for the Mai-Sale chat application.
+
+Concurrent callers asking for the same key share one in-flight task instead
+of duplicating work (e.g. N users sending the same trending question at once
+trigger a single embedding call and a single Chroma query).
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Named instances, so /metrics can report every coalescing layer
+_registry: Dict[str, "SingleFlight"] = {}
+
+
+class SingleFlight:
+    """Deduplicate concurrent async calls by key."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+        self.calls = 0
+        self.executions = 0
+        self.collapsed = 0
+        _registry[name] = self
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `fn()` for `key`, or await the call already in flight for it.
+
+        The shared work runs in its own task and is shielded, so one caller being
+        cancelled (e.g. a client disconnect) does not cancel it for the others.
+        Exceptions are propagated to every waiting caller.
+        """
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is not None and not task.done():
+            self.collapsed += 1
+            logger.debug(f"[{self.name}] joined in-flight call for key {key!r}")
+            return await asyncio.shield(task)
+
+        self.executions += 1
+        task = asyncio.ensure_future(fn())
+        self._inflight[key] = task
+
+        def _forget(done: "asyncio.Future[Any]", key: Hashable = key) -> None:
+            if self._inflight.get(key) is done:
+                del self._inflight[key]
+            if not done.cancelled():
+                done.exception()  # mark as retrieved even if every caller went away
+
+        task.add_done_callback(_forget)
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "collapsed": self.collapsed,
+            "in_flight": len(self._inflight),
+        }
+
+
+def singleflight_stats() -> Dict[str, Dict[str, Any]]:
+    """Counters of every SingleFlight instance, keyed by name."""
+    return {name: sf.stats() for name, sf in _registry.items()}
@@ -0,0 +1,222 @@
+"""
+Rolling conversation summaries for the Mai-Sale chat application.
+
+Long conversations are compressed so the prompt stays roughly constant in
+size: turns before a watermark are replaced by a stored running summary, and
+the prompt is summary + recent turns + retrieved context.
+
+- `conversation_summaries` holds one row per conversation: the summary text
+  and the watermark, i.e. the (created_at, id) of the last message folded in.
+- Request path: `split_history` drops the turns already covered by the
+  summary; `needs_summary` decides, from the turns after the watermark,
+  whether a `summarize_conversation` job should be enqueued.
+- Worker: `update_summary` folds the turns after the watermark, except the
+  most recent SUMMARY_KEEP_RECENT_TOKENS, into the summary with one LLM call
+  per batch and moves the watermark. Concurrent runs for the same
+  conversation are resolved by a conditional UPDATE on the old watermark.
+"""
+
+import os
+import uuid
+import logging
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import Text, DateTime, Integer, Uuid, select, update, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Mapped, mapped_column
+
+from agent.database import Base, Message, async_session, get_recent_messages, utcnow
+from agent.ollama_client import agenerate_text, DEFAULT_GENERATE_MODEL
+from agent.prompting import PROMPT_HISTORY_WINDOW
+from agent.tokens import count_tokens, message_tokens
+
+# --- Configuration ---
+SUMMARY_ENABLED = os.environ.get("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+# Unsummarized history above this many tokens triggers a summary update
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("SUMMARY_TRIGGER_TOKENS", 2000))
+# The newest turns up to this many tokens always stay verbatim in the prompt
+SUMMARY_KEEP_RECENT_TOKENS = int(os.environ.get("SUMMARY_KEEP_RECENT_TOKENS", 1000))
+SUMMARY_MAX_WORDS = int(os.environ.get("SUMMARY_MAX_WORDS", 200))
+# Messages folded per LLM call
+SUMMARY_BATCH_MESSAGES = int(os.environ.get("SUMMARY_BATCH_MESSAGES", 100))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", DEFAULT_GENERATE_MODEL)
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and a sales assistant. "
+    "Keep facts, user preferences, product names, numbers, decisions and open questions; "
+    "drop greetings and small talk. Write in the conversation's language, at most {max_words} words.\n"
+    "Current summary: {summary}\n"
+    "New messages:\n{messages}\n"
+    "Updated summary:"
+)
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+# --- Data Models ---
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+
+    conversation_id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True)
+    summary: Mapped[str] = mapped_column(Text)
+    # Last message folded into the summary
+    watermark_created_at: Mapped[datetime] = mapped_column(DateTime)
+    watermark_message_id: Mapped[uuid.UUID] = mapped_column(Uuid)
+    summarized_messages: Mapped[int] = mapped_column(Integer, default=0)
+    summary_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow, onupdate=utcnow)
+
+    def __repr__(self) -> str:
+        return f"<ConversationSummary(conversation_id={self.conversation_id}, messages={self.summarized_messages})>"
+
+
+def _position(message: Any) -> Tuple[datetime, str]:
+    return message.created_at, str(message.id)
+
+
+def _line(message: Any) -> str:
+    return f"{message.sender}: {message.text}"
+
+
+def _tokens(message: Any) -> int:
+    return message_tokens(message.sender, message.text, message.tokens_estimate)
+
+
+# --- Request path ---
+async def get_summary(conversation_id: uuid.UUID) -> Optional[ConversationSummary]:
+    """The stored summary of a conversation, if any."""
+    async with async_session() as session:
+        return await session.get(ConversationSummary, conversation_id)
+
+
+def split_history(messages: List[Any], summary: Optional[ConversationSummary]) -> List[Any]:
+    """The messages (rows or pending writes, oldest first) that come after the summary watermark."""
+    if summary is None:
+        return list(messages)
+    watermark = (summary.watermark_created_at, str(summary.watermark_message_id))
+    return [m for m in messages if _position(m) > watermark]
+
+
+def needs_summary(unsummarized: List[Any]) -> bool:
+    """True if the turns after the watermark exceed SUMMARY_TRIGGER_TOKENS."""
+    if not SUMMARY_ENABLED:
+        return False
+    return sum(_tokens(m) for m in unsummarized) > SUMMARY_TRIGGER_TOKENS
+
+
+# --- Worker ---
+async def _messages_after(
+    conversation_id: uuid.UUID, summary: Optional[ConversationSummary], before: Tuple[datetime, uuid.UUID], limit: int
+) -> List[Message]:
+    """Up to `limit` messages after the watermark and before `before`, oldest first."""
+    stmt = select(Message).where(
+        Message.conversation_id == conversation_id,
+        tuple_(Message.created_at, Message.id) < before,
+    )
+    if summary is not None:
+        stmt = stmt.where(
+            tuple_(Message.created_at, Message.id) > (summary.watermark_created_at, summary.watermark_message_id)
+        )
+    stmt = stmt.order_by(Message.created_at, Message.id).limit(limit)
+    async with async_session() as session:
+        return list((await session.scalars(stmt)).all())
+
+
+def _keep_boundary(recent: List[Message]) -> Optional[Message]:
+    """Oldest message of the verbatim tail (the newest turns within SUMMARY_KEEP_RECENT_TOKENS)."""
+    boundary, tokens = None, 0
+    for message in reversed(recent):
+        tokens += _tokens(message)
+        if boundary is not None and tokens > SUMMARY_KEEP_RECENT_TOKENS:
+            break
+        boundary = message
+    return boundary
+
+
+async def update_summary(conversation_id: uuid.UUID) -> int:
+    """
+    Fold the turns after the watermark (except the verbatim tail) into the summary.
+
+    Args:
+        conversation_id (uuid.UUID): The conversation to summarize.
+
+    Returns:
+        int: Number of messages folded in (0 if below the threshold or another
+        worker updated the summary first).
+
+    Raises:
+        Exception: LLM or database failures, so the job is retried.
+    """
+    recent = await get_recent_messages(conversation_id, PROMPT_HISTORY_WINDOW)
+    boundary = _keep_boundary(recent)
+    if boundary is None:
+        return 0
+    summary = await get_summary(conversation_id)
+    if not needs_summary(split_history(recent, summary)):
+        return 0
+
+    folded = 0
+    while True:
+        batch = await _messages_after(
+            conversation_id, summary, (boundary.created_at, boundary.id), SUMMARY_BATCH_MESSAGES
+        )
+        if not batch:
+            return folded
+        prompt = SUMMARY_PROMPT.format(
+            max_words=SUMMARY_MAX_WORDS,
+            summary=summary.summary if summary is not None else "(none)",
+            messages="\n".join(_line(m) for m in batch),
+        )
+        text = (await agenerate_text(prompt, model=SUMMARY_MODEL)).strip()
+        if not text:
+            raise ValueError(f"Empty summary generated for conversation {conversation_id}")
+        summary = await _store_summary(conversation_id, summary, text, batch[-1], len(batch))
+        if summary is None:
+            logger.info(f"Summary of conversation {conversation_id} was updated concurrently, stopping")
+            return folded
+        folded += len(batch)
+        logger.info(
+            f"Summarized {len(batch)} messages of conversation {conversation_id} "
+            f"({summary.summarized_messages} total, {summary.summary_tokens} summary tokens)"
+        )
+
+
+async def _store_summary(
+    conversation_id: uuid.UUID,
+    previous: Optional[ConversationSummary],
+    text: str,
+    last: Message,
+    count: int,
+) -> Optional[ConversationSummary]:
+    """Insert or advance the summary; None if another worker moved the watermark first."""
+    values = {
+        "summary": text,
+        "watermark_created_at": last.created_at,
+        "watermark_message_id": last.id,
+        "summarized_messages": (previous.summarized_messages if previous is not None else 0) + count,
+        "summary_tokens": count_tokens(text),
+    }
+    async with async_session() as session:
+        if previous is None:
+            row = ConversationSummary(conversation_id=conversation_id, **values)
+            session.add(row)
+            try:
+                await session.commit()
+            except IntegrityError:
+                return None
+            return row
+        result = await session.execute(
+            update(ConversationSummary)
+            .where(
+                ConversationSummary.conversation_id == conversation_id,
+                ConversationSummary.watermark_message_id == previous.watermark_message_id,
+            )
+            .values(updated_at=utcnow(), **values)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        if result.rowcount == 0:
+            return None
+    return ConversationSummary(conversation_id=conversation_id, **values)
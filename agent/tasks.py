@@ -0,0 +1,223 @@
+"""
+Background jobs of the Mai-Sale chat application.
+
+The API enqueues these jobs (see agent/jobs.py) and a worker process runs them:
+
+- `embed_message`: embed a message and upsert it into ChromaDB. Each chunk's
+  vector id is `{message_id}#chunk_{i}`, so retries overwrite instead of
+  duplicating. Concurrent embedding jobs share batched Ollama/Chroma calls
+  (agent/upsert_batcher.py).
+- `assistant_reply`: run the LangGraph flow for the latest user message, save
+  the assistant message and enqueue its embedding.
+
+Handlers raise on failure so the queue can retry them with backoff.
+"""
+
+import os
+import uuid
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from agent.database import add_message, get_context_window
+from agent.jobs import enqueue, register_handler
+from agent.langgraph_flow import AgentState, get_flow, speculation_config
+from agent.prompting import PROMPT_HISTORY_TOKENS, PROMPT_HISTORY_WINDOW
+from agent.summaries import get_summary, split_history, needs_summary, update_summary
+from agent.upsert_batcher import upsert_batcher, UPSERT_JOB_CONCURRENCY
+
+# --- Configuration ---
+MESSAGE_CHUNK_CHARS = int(os.environ.get("MESSAGE_CHUNK_CHARS", 1000))
+
+EMBED_MESSAGE = "embed_message"
+ASSISTANT_REPLY = "assistant_reply"
+SUMMARIZE_CONVERSATION = "summarize_conversation"
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+def chunk_message(text: str, chunk_size: int = MESSAGE_CHUNK_CHARS) -> List[str]:
+    """Split a message into chunks of at most `chunk_size` characters, on whitespace when possible."""
+    text = text.strip()
+    chunks = []
+    while len(text) > chunk_size:
+        cut = text.rfind(" ", 0, chunk_size)
+        if cut <= 0:
+            cut = chunk_size
+        chunks.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def chunk_id(message_id: str, index: int) -> str:
+    """Idempotent vector id for chunk `index` of a message."""
+    return f"{message_id}#chunk_{index}"
+
+
+# --- Enqueue helpers (used by the API) ---
+async def enqueue_embedding(message_id: str, conversation_id: str, user_id: str, text: str, session=None) -> bool:
+    """Enqueue the embedding job for a stored message (at most once per message)."""
+    return await enqueue(
+        EMBED_MESSAGE,
+        {"message_id": message_id, "conversation_id": conversation_id, "user_id": user_id, "text": text},
+        idempotency_key=f"embed:{message_id}",
+        session=session,
+    )
+
+
+async def enqueue_assistant_reply(
+    message_id: str, conversation_id: str, user_id: str, user_text: Optional[str] = None,
+    tenant_id: Optional[str] = None, session=None,
+) -> bool:
+    """Enqueue generation of the assistant reply to user message `message_id`."""
+    return await enqueue(
+        ASSISTANT_REPLY,
+        {
+            "message_id": message_id,
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "user_text": user_text,
+            "tenant_id": tenant_id,
+        },
+        idempotency_key=f"reply:{message_id}",
+        session=session,
+    )
+
+
+async def enqueue_summary(conversation_id: str, latest_message_id: str, session=None) -> bool:
+    """Enqueue a summary update for a conversation (at most once per latest message)."""
+    return await enqueue(
+        SUMMARIZE_CONVERSATION,
+        {"conversation_id": conversation_id},
+        idempotency_key=f"summarize:{conversation_id}:{latest_message_id}",
+        session=session,
+    )
+
+
+# --- Job implementations ---
+async def embed_and_store_message(message_id: str, conversation_id: str, user_id: str, text: str):
+    """
+    Generates embeddings for a message and stores them in ChromaDB.
+
+    Raises:
+        Exception: Embedding or upsert failures, so the job is retried.
+    """
+    logger.info(f"Starting embedding for message {message_id}")
+    documents = chunk_message(text)
+    if not documents:
+        logger.info(f"Message {message_id} is empty, nothing to embed")
+        return
+    created_at = datetime.utcnow().isoformat()
+    metadatas = [{
+        "message_id": message_id,
+        "conversation_id": conversation_id,
+        "user_id": user_id,
+        "chunk_index": i,
+        "created_at": created_at,
+    } for i in range(len(documents))]
+    ids = [chunk_id(message_id, i) for i in range(len(documents))]
+
+    # Upsert into ChromaDB, batched with other messages being embedded concurrently
+    await upsert_batcher.submit(documents=documents, metadatas=metadatas, ids=ids)
+    logger.info(f"Successfully embedded and stored message {message_id} ({len(documents)} chunks)")
+
+
+async def run_assistant_flow(
+    conversation_id: uuid.UUID, user_id: str, user_text: Optional[str] = None, tenant_id: Optional[str] = None
+) -> Optional[str]:
+    """
+    Runs the LangGraph flow, saves the assistant's response and enqueues its embedding.
+
+    Returns:
+        Optional[str]: The assistant message id, or None if nothing was generated.
+
+    Raises:
+        Exception: Generation (e.g. Ollama unavailable) or database failures, so the job is retried.
+    """
+    logger.info(f"Starting assistant flow for conversation {conversation_id}")
+    flow_metadata = {"conversation_id": str(conversation_id), "user_id": user_id, "tenant_id": tenant_id}
+    flow_config = speculation_config("chat", user_text, flow_metadata)
+
+    # 1. Get the recent history window (chosen by stored token counts) to build the current state
+    history = await get_context_window(conversation_id, PROMPT_HISTORY_TOKENS, PROMPT_HISTORY_WINDOW)
+    if history and history[-1].sender != "user":
+        # A previous attempt already answered (e.g. the job was retried after saving)
+        logger.info(f"Conversation {conversation_id} already has a reply to its latest message, skipping")
+        return None
+
+    # Turns already folded into the rolling summary are replaced by it
+    summary = await get_summary(conversation_id)
+    history = split_history(history, summary)
+
+    # 2. Create initial state for the flow
+    initial_state: AgentState = {
+        "conversation_id": str(conversation_id),
+        "user_id": user_id,
+        "chat_history": [
+            {"id": str(msg.id), "role": msg.sender, "content": msg.text, "tokens": msg.tokens_estimate}
+            for msg in history
+        ],
+        "summary": summary.summary if summary is not None else None,
+        "metadata": flow_metadata,
+        "retrieved_context": None,
+        "response": None,
+        # An LLM failure fails the job (retried with backoff) instead of saving an apology as the reply
+        "raise_errors": True,
+    }
+
+    # 3. Invoke the compiled LangGraph flow
+    final_state = await get_flow("chat").ainvoke(initial_state, config=flow_config)
+
+    # 4. Save the assistant's response to the database
+    assistant_response = final_state.get("response")
+    if not assistant_response:
+        logger.warning(f"No response generated by the flow for conversation {conversation_id}")
+        return None
+
+    assistant_msg = await add_message(
+        conversation_id=conversation_id,
+        sender="assistant",
+        text=assistant_response,
+    )
+    logger.info(f"Assistant response saved for conversation {conversation_id}")
+
+    # Also embed the assistant's response
+    await enqueue_embedding(
+        message_id=str(assistant_msg.id),
+        conversation_id=str(conversation_id),
+        user_id=user_id,
+        text=assistant_response,
+    )
+    if needs_summary(history + [assistant_msg]):
+        await enqueue_summary(str(conversation_id), str(assistant_msg.id))
+    return str(assistant_msg.id)
+
+
+# --- Job handlers ---
+# Enough embedding jobs in flight to fill an upsert batch, whatever JOB_WORKER_CONCURRENCY is
+@register_handler(EMBED_MESSAGE, concurrency=UPSERT_JOB_CONCURRENCY)
+async def handle_embed_message(payload: Dict[str, Any]) -> None:
+    await embed_and_store_message(
+        message_id=payload["message_id"],
+        conversation_id=payload["conversation_id"],
+        user_id=payload["user_id"],
+        text=payload["text"],
+    )
+
+
+@register_handler(ASSISTANT_REPLY)
+async def handle_assistant_reply(payload: Dict[str, Any]) -> None:
+    await run_assistant_flow(
+        conversation_id=uuid.UUID(payload["conversation_id"]),
+        user_id=payload["user_id"],
+        user_text=payload.get("user_text"),
+        tenant_id=payload.get("tenant_id"),
+    )
+
+
+@register_handler(SUMMARIZE_CONVERSATION)
+async def handle_summarize_conversation(payload: Dict[str, Any]) -> None:
+    await update_summary(uuid.UUID(payload["conversation_id"]))
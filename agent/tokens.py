@@ -0,0 +1,85 @@
+"""
+Token counting helpers for the Mai-Sale chat application.
+
+`estimate_tokens` is a fast local estimate (no model tokenizer needed) used for
+prompt budgeting. It approximates BPE tokenizers by counting punctuation as one
+token and splitting words into ~4-character pieces, which errs on the high
+side for Vietnamese text with diacritics.
+
+`count_tokens` uses a real tokenizer when TOKENIZER_PATH names one (a local
+tokenizer.json, or a Hugging Face model id) and the optional `tokenizers`
+package is installed; otherwise it falls back to `estimate_tokens`. Message
+token counts are computed with it once, when the message is written, and
+stored in `messages.tokens_estimate`.
+"""
+
+import os
+import re
+import logging
+from functools import lru_cache
+from typing import Any, Optional
+
+# --- Configuration ---
+# tokenizer.json path or Hugging Face model id; empty = heuristic estimate only
+TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", "")
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+CHARS_PER_TOKEN = 4
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4096)
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of LLM tokens in `text`."""
+    if not text:
+        return 0
+    count = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        count += max(1, -(-len(piece) // CHARS_PER_TOKEN))
+    return count
+
+
+@lru_cache(maxsize=1)
+def get_tokenizer() -> Optional[Any]:
+    """The configured `tokenizers.Tokenizer`, loaded once; None if not configured or unavailable."""
+    if not TOKENIZER_PATH:
+        return None
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        logger.warning("TOKENIZER_PATH is set but the 'tokenizers' package is not installed; using estimates")
+        return None
+    try:
+        if os.path.exists(TOKENIZER_PATH):
+            return Tokenizer.from_file(TOKENIZER_PATH)
+        return Tokenizer.from_pretrained(TOKENIZER_PATH)
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer {TOKENIZER_PATH!r}: {e}; using estimates")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Number of tokens in `text` with the configured tokenizer, else `estimate_tokens`."""
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def message_tokens(role: str, text: str, tokens: Optional[int] = None) -> int:
+    """
+    Tokens of the prompt line "role: text".
+
+    Args:
+        role (str): 'user' or 'assistant'.
+        text (str): Message text.
+        tokens (Optional[int]): Stored count for `text` (messages.tokens_estimate), if known.
+    """
+    if tokens is None:
+        tokens = count_tokens(text)
+    return tokens + count_tokens(f"{role}:")
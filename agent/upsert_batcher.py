@@ -0,0 +1,184 @@
+"""
+Micro-batching of vector upserts for the Mai-Sale chat application.
+
+Embedding jobs each carry one message (a few chunks). Upserting them one by one
+means one Ollama request and one Chroma write (lock + flush) per message. The
+batcher collects submissions for up to UPSERT_BATCH_SIZE documents or
+UPSERT_LINGER_MS milliseconds, whichever comes first, then:
+
+- embeds all documents with one batched `aget_embeddings` call, and
+- writes one Chroma `upsert` per collection.
+
+Each `submit` returns when its own documents are stored (or raises the batch's
+error), so callers such as job handlers keep per-message retry semantics.
+
+Batches can only fill if enough jobs submit at the same time: the
+`embed_message` handler is registered with UPSERT_JOB_CONCURRENCY dedicated
+worker slots (default UPSERT_BATCH_SIZE), independent of
+JOB_WORKER_CONCURRENCY. When that is set below the batch size, lingering only
+adds latency, so UPSERT_LINGER_MS then defaults to 0.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from agent.ollama_client import aget_embeddings
+from agent.chroma_pool import chroma_pool
+from agent.retriever import DEFAULT_COLLECTION_NAME, upsert_embedded
+
+# --- Configuration ---
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", 64))
+# Embedding jobs a worker runs at once, in their own slots (see agent.jobs.register_handler)
+UPSERT_JOB_CONCURRENCY = int(os.environ.get("UPSERT_JOB_CONCURRENCY", UPSERT_BATCH_SIZE))
+UPSERT_LINGER_MS = float(os.environ.get(
+    "UPSERT_LINGER_MS", 50 if UPSERT_JOB_CONCURRENCY >= UPSERT_BATCH_SIZE else 0
+))
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Submission:
+    documents: List[str]
+    metadatas: List[Dict[str, Any]]
+    ids: List[str]
+    collection_name: str
+    future: asyncio.Future = field(repr=False)
+
+
+class UpsertBatcher:
+    """Collects upserts from concurrent callers and writes them in batches."""
+
+    def __init__(self, max_batch: int = UPSERT_BATCH_SIZE, linger_ms: float = UPSERT_LINGER_MS):
+        self.max_batch = max_batch
+        self.linger_ms = linger_ms
+        self._pending: List[_Submission] = []
+        self._pending_docs = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._flushes: set = set()
+        self.batches = 0
+        self.documents = 0
+        self.submissions = 0
+        self.size_flushes = 0
+        self.linger_flushes = 0
+        self.failed_batches = 0
+
+    async def submit(
+        self,
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+        ids: List[str],
+        collection_name: str = DEFAULT_COLLECTION_NAME,
+    ) -> None:
+        """
+        Queue documents for the next batch and wait until they are upserted.
+
+        Raises:
+            Exception: The embedding/upsert error of the batch the documents were in.
+        """
+        if not documents:
+            return
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Pending items and timers from another (finished) loop cannot be awaited here
+            self._loop, self._pending, self._pending_docs, self._timer = loop, [], 0, None
+
+        submission = _Submission(documents, metadatas, ids, collection_name, loop.create_future())
+        self._pending.append(submission)
+        self._pending_docs += len(documents)
+        self.submissions += 1
+
+        if self._pending_docs >= self.max_batch:
+            self.size_flushes += 1
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger_ms / 1000, self._on_linger)
+        await submission.future
+
+    def _on_linger(self) -> None:
+        self._timer = None
+        if self._pending:
+            self.linger_flushes += 1
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_docs = self._pending, [], 0
+        task = self._loop.create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[_Submission]) -> None:
+        started = time.perf_counter()
+        by_collection: Dict[str, List[_Submission]] = {}
+        for submission in batch:
+            by_collection.setdefault(submission.collection_name, []).append(submission)
+
+        for collection_name, submissions in by_collection.items():
+            # Chroma rejects duplicate ids within one upsert; the latest submission wins
+            rows: Dict[str, tuple] = {}
+            for s in submissions:
+                for doc_id, document, metadata in zip(s.ids, s.documents, s.metadatas):
+                    rows.pop(doc_id, None)
+                    rows[doc_id] = (document, metadata)
+            documents = [document for document, _ in rows.values()]
+            try:
+                # Identical texts are embedded once by aget_embeddings
+                embeddings = await aget_embeddings(documents)
+                await chroma_pool.run(
+                    upsert_embedded,
+                    documents,
+                    [metadata for _, metadata in rows.values()],
+                    list(rows),
+                    embeddings,
+                    collection_name,
+                )
+            except Exception as e:
+                self.failed_batches += 1
+                logger.error(f"Batched upsert of {len(documents)} documents into '{collection_name}' failed: {e}")
+                for s in submissions:
+                    if not s.future.done():
+                        s.future.set_exception(e)
+                continue
+            self.batches += 1
+            self.documents += len(documents)
+            for s in submissions:
+                if not s.future.done():
+                    s.future.set_result(None)
+            logger.info(
+                f"Batched upsert: {len(submissions)} messages / {len(documents)} documents into "
+                f"'{collection_name}' in {(time.perf_counter() - started) * 1000:.1f} ms"
+            )
+
+    async def flush(self) -> None:
+        """Write everything pending now and wait for in-progress batches (e.g. on shutdown)."""
+        if self._pending:
+            self._schedule_flush()
+        if self._flushes:
+            await asyncio.gather(*list(self._flushes), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch": self.max_batch,
+            "linger_ms": self.linger_ms,
+            "submissions": self.submissions,
+            "batches": self.batches,
+            "documents": self.documents,
+            "avg_batch_size": self.documents / self.batches if self.batches else 0.0,
+            "size_flushes": self.size_flushes,
+            "linger_flushes": self.linger_flushes,
+            "failed_batches": self.failed_batches,
+            "pending": self._pending_docs,
+        }
+
+
+# Process-wide instance used by the embedding job
+upsert_batcher = UpsertBatcher()
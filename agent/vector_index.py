@@ -0,0 +1,296 @@
+"""
+Read-only, memory-mapped vector index for the knowledge base.
+
+The knowledge collection built by scripts/index_knowledge.py is read-mostly, so
+it can be exported once from Chroma and served in-process:
+
+    <VECTOR_INDEX_DIR>/<collection>/
+        vectors.npy   float32/float16 matrix (one row per chunk), memory-mapped
+        norms.npy     squared L2 norm per row (float32)
+        meta.json     ids, documents, metadatas, dtype, dim
+        hnsw.bin      optional HNSW graph (only if hnswlib is installed at export)
+
+Vectors are loaded with `np.load(mmap_mode="r")`, so several uvicorn workers
+share one copy through the OS page cache instead of each opening a Chroma
+client. Queries use the HNSW graph when available and the collection is large,
+otherwise an exact brute-force NumPy scan. Distances are squared L2, the same
+as Chroma's default space, so results are interchangeable with `query_vectors`.
+
+Collections listed in VECTOR_INDEX_COLLECTIONS are served from the index by
+`query_vectors` / `aquery_vectors`; everything else still goes to Chroma.
+"""
+
+import os
+import json
+import shutil
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import hnswlib  # optional: approximate search for large collections
+except ImportError:
+    hnswlib = None
+
+# --- Configuration ---
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "./database/vector_index")
+VECTOR_INDEX_COLLECTIONS = {
+    name.strip() for name in os.environ.get("VECTOR_INDEX_COLLECTIONS", "").split(",") if name.strip()
+}
+# Collections up to this size are always searched exactly (fast enough, perfect recall)
+VECTOR_INDEX_BRUTE_FORCE_MAX = int(os.environ.get("VECTOR_INDEX_BRUTE_FORCE_MAX", 20000))
+VECTOR_INDEX_HNSW_EF = int(os.environ.get("VECTOR_INDEX_HNSW_EF", 64))
+_SCAN_ROWS = 8192  # rows per block in the brute-force scan (bounds float32 upcast memory)
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+def _matches(metadata: Dict[str, Any], filter_metadata: Dict[str, Any]) -> bool:
+    return all(metadata.get(key) == value for key, value in filter_metadata.items())
+
+
+class VectorIndex:
+    """An exported collection: mmap'd vectors, sidecar metadata and optional HNSW graph."""
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        norms: np.ndarray,
+        ids: List[str],
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+        hnsw: Any = None,
+    ):
+        self.vectors = vectors
+        self.norms = norms
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.hnsw = hnsw
+        self._filter_rows: Dict[Tuple, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path: str) -> "VectorIndex":
+        """Load an exported collection; vectors are memory-mapped, not read."""
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        norms = np.load(os.path.join(path, "norms.npy"), mmap_mode="r")
+        hnsw = None
+        hnsw_path = os.path.join(path, "hnsw.bin")
+        if hnswlib is not None and os.path.exists(hnsw_path) and len(meta["ids"]) > VECTOR_INDEX_BRUTE_FORCE_MAX:
+            hnsw = hnswlib.Index(space="l2", dim=meta["dim"])
+            hnsw.load_index(hnsw_path, max_elements=len(meta["ids"]))
+            hnsw.set_ef(max(VECTOR_INDEX_HNSW_EF, 10))
+        logger.info(
+            f"Loaded vector index '{meta['collection']}' from {path}: {len(meta['ids'])} x {meta['dim']} "
+            f"{meta['dtype']} ({'hnsw' if hnsw is not None else 'exact'})"
+        )
+        return cls(vectors, norms, meta["ids"], meta["documents"], meta["metadatas"], hnsw)
+
+    def _rows_for(self, filter_metadata: Dict[str, Any]) -> np.ndarray:
+        key = tuple(sorted(filter_metadata.items()))
+        with self._lock:
+            rows = self._filter_rows.get(key)
+            if rows is None:
+                rows = np.fromiter(
+                    (i for i, m in enumerate(self.metadatas) if _matches(m or {}, filter_metadata)), dtype=np.int64
+                )
+                if len(self._filter_rows) < 1024:
+                    self._filter_rows[key] = rows
+        return rows
+
+    def _exact(self, query: np.ndarray, top_k: int, rows: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Squared L2 distances via ||x||^2 - 2 x.q + ||q||^2, scanned in blocks."""
+        q_norm = float(query @ query)
+        if rows is not None:
+            vectors, norms = self.vectors[rows], self.norms[rows]
+        else:
+            vectors, norms = self.vectors, self.norms
+        distances = np.empty(len(norms), dtype=np.float32)
+        for start in range(0, len(norms), _SCAN_ROWS):
+            block = np.asarray(vectors[start:start + _SCAN_ROWS], dtype=np.float32)
+            distances[start:start + len(block)] = norms[start:start + len(block)] - 2.0 * (block @ query) + q_norm
+        k = min(top_k, len(distances))
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best])]
+        positions = rows[best] if rows is not None else best
+        return positions, np.maximum(distances[best], 0.0)
+
+    def search(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        filter_metadata: Optional[Dict[str, Any]] = None,
+        include_embeddings: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        Top-K nearest chunks, formatted like `query_vectors` results.
+
+        Args:
+            query_embedding (List[float]): The query vector.
+            top_k (int): Number of results.
+            filter_metadata (Optional[Dict]): Metadata equality filters (all must match).
+            include_embeddings (bool): Also return each result's 'embedding'.
+
+        Returns:
+            List[Dict]: Results with 'id', 'document', 'metadata' and 'distance' (squared L2).
+        """
+        if not len(self) or top_k <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape[0] != self.vectors.shape[1]:
+            raise ValueError(f"Query has dimension {query.shape[0]}, index has {self.vectors.shape[1]}")
+
+        if filter_metadata:
+            rows = self._rows_for(filter_metadata)
+            if not len(rows):
+                return []
+            positions, distances = self._exact(query, top_k, rows)
+        elif self.hnsw is not None:
+            labels, dists = self.hnsw.knn_query(query, k=min(top_k, len(self)))
+            positions, distances = labels[0], dists[0]
+        else:
+            positions, distances = self._exact(query, top_k, None)
+
+        results = []
+        for p, d in zip(positions, distances):
+            result = {
+                "id": self.ids[p],
+                "document": self.documents[p],
+                "metadata": self.metadatas[p],
+                "distance": float(d),
+            }
+            if include_embeddings:
+                result["embedding"] = np.asarray(self.vectors[p], dtype=np.float32).tolist()
+            results.append(result)
+        return results
+
+
+# --- Export ---
+def export_collection(
+    collection: Any,
+    out_dir: str,
+    dtype: str = "float32",
+    build_hnsw: bool = True,
+    page_size: int = 1000,
+) -> int:
+    """
+    Export a Chroma collection to the memory-mapped index format.
+
+    The export is written to a temporary directory and swapped in at the end,
+    so running workers never see a half-written index.
+
+    Args:
+        collection: A Chroma collection.
+        out_dir (str): Target directory (e.g. VECTOR_INDEX_DIR/<collection>).
+        dtype (str): "float32" or "float16" for the stored vectors.
+        build_hnsw (bool): Also build an HNSW graph if hnswlib is installed.
+        page_size (int): Rows fetched from Chroma per request.
+
+    Returns:
+        int: Number of exported rows.
+    """
+    if dtype not in ("float32", "float16"):
+        raise ValueError("dtype must be 'float32' or 'float16'")
+
+    ids: List[str] = []
+    documents: List[str] = []
+    metadatas: List[Dict[str, Any]] = []
+    blocks: List[np.ndarray] = []
+    offset = 0
+    while True:
+        page = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        ids.extend(page["ids"])
+        documents.extend(page["documents"])
+        metadatas.extend(m or {} for m in page["metadatas"])
+        blocks.append(np.asarray(page["embeddings"], dtype=np.float32))
+        offset += len(page["ids"])
+
+    vectors = np.vstack(blocks) if blocks else np.zeros((0, 0), dtype=np.float32)
+    stored = vectors.astype(dtype)
+    # Norms of the stored (possibly rounded) vectors keep distances consistent
+    stored32 = stored.astype(np.float32)
+    norms = np.einsum("ij,ij->i", stored32, stored32).astype(np.float32)
+
+    tmp_dir = out_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "vectors.npy"), stored)
+    np.save(os.path.join(tmp_dir, "norms.npy"), norms)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "collection": collection.name,
+            "dim": int(vectors.shape[1]) if len(ids) else 0,
+            "dtype": dtype,
+            "space": "l2",
+            "ids": ids,
+            "documents": documents,
+            "metadatas": metadatas,
+        }, f, ensure_ascii=False)
+
+    if build_hnsw and hnswlib is not None and len(ids):
+        graph = hnswlib.Index(space="l2", dim=int(vectors.shape[1]))
+        graph.init_index(max_elements=len(ids), ef_construction=200, M=16)
+        graph.add_items(stored32, np.arange(len(ids)))
+        graph.save_index(os.path.join(tmp_dir, "hnsw.bin"))
+
+    old_dir = out_dir.rstrip("/") + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    logger.info(f"Exported {len(ids)} vectors from '{collection.name}' to {out_dir} ({dtype})")
+    return len(ids)
+
+
+# --- Registry ---
+_indexes: Dict[str, Optional[VectorIndex]] = {}
+_registry_lock = threading.Lock()
+
+
+def index_path(collection_name: str) -> str:
+    return os.path.join(VECTOR_INDEX_DIR, collection_name)
+
+
+def get_vector_index(collection_name: str) -> Optional[VectorIndex]:
+    """
+    The exported index serving `collection_name`, or None to query Chroma.
+
+    Only collections listed in VECTOR_INDEX_COLLECTIONS are served; a missing
+    export is logged once and falls back to Chroma.
+    """
+    if collection_name not in VECTOR_INDEX_COLLECTIONS:
+        return None
+    with _registry_lock:
+        if collection_name not in _indexes:
+            path = index_path(collection_name)
+            try:
+                _indexes[collection_name] = VectorIndex.load(path)
+            except FileNotFoundError:
+                logger.warning(f"No vector index export for '{collection_name}' at {path}; using Chroma")
+                _indexes[collection_name] = None
+        return _indexes[collection_name]
+
+
+def load_vector_indexes() -> None:
+    """Load all configured indexes up front (called on startup)."""
+    for name in sorted(VECTOR_INDEX_COLLECTIONS):
+        get_vector_index(name)
+
+
+def reload_vector_index(collection_name: str) -> Optional[VectorIndex]:
+    """Drop the loaded index so the next query maps the latest export."""
+    with _registry_lock:
+        _indexes.pop(collection_name, None)
+    return get_vector_index(collection_name)
@@ -0,0 +1,65 @@
+"""
+Job worker process for the Mai-Sale chat application.
+
+Runs the background jobs (embeddings, assistant replies) enqueued by the API,
+so API and worker processes can be scaled independently:
+
+    uv run python -m agent.worker --concurrency 4
+
+Several workers can run against the same database. SIGINT/SIGTERM stop polling,
+drain in-flight jobs and release the ones that do not finish in time.
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+
+import agent.tasks  # noqa: F401  (registers the job handlers)
+from agent.database import init_db
+from agent.jobs import JobWorker, JOB_WORKER_CONCURRENCY, JOB_POLL_INTERVAL
+from agent.langgraph_flow import init_flows
+from agent.ollama_client import init_http_client, close_http_client
+from agent.upsert_batcher import upsert_batcher
+
+# --- Logging ---
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def run_worker(concurrency: int, poll_interval: float, kinds=None, drain_timeout: float = 30.0):
+    await init_db()
+    await init_http_client()
+    init_flows()
+
+    worker = JobWorker(concurrency=concurrency, poll_interval=poll_interval, kinds=kinds)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    runner = asyncio.create_task(worker.run())
+    await stop.wait()
+    logger.info("Stopping job worker...")
+    await worker.stop(timeout=drain_timeout)
+    await runner
+    await upsert_batcher.flush()
+    await close_http_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the background job worker.")
+    parser.add_argument('--concurrency', type=int, default=JOB_WORKER_CONCURRENCY, help='Jobs processed at the same time')
+    parser.add_argument('--poll-interval', type=float, default=JOB_POLL_INTERVAL, help='Seconds between polls when idle')
+    parser.add_argument('--kinds', type=str, default=None, help='Comma-separated job kinds to process (default: all)')
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help='Seconds to wait for in-flight jobs on shutdown')
+    args = parser.parse_args()
+    kinds = [k.strip() for k in args.kinds.split(",") if k.strip()] if args.kinds else None
+    asyncio.run(run_worker(args.concurrency, args.poll_interval, kinds, args.drain_timeout))
+
+
+if __name__ == "__main__":
+    main()
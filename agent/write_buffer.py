@@ -0,0 +1,485 @@
+"""
+Write-behind buffer for chat messages.
+
+The streaming endpoint used to wait for the user message INSERT before the
+first token, and for the assistant message INSERT before closing the
+connection. With the buffer, `submit` returns immediately with the message id
+and timestamp assigned in Python; a background flush writes queued messages:
+
+- in batches of up to MESSAGE_BUFFER_BATCH_SIZE, or every
+  MESSAGE_BUFFER_LINGER_MS milliseconds
+- as one multi-row INSERT plus one UPDATE of last_active_at and tokens_total
+  per batch, with the messages' embedding jobs enqueued in the same transaction
+- one batch at a time, in submission order, so messages of a conversation are
+  committed in the order they were written
+
+At most MESSAGE_BUFFER_MAX_PENDING messages wait in memory; further `submit`
+calls wait for space (backpressure). `flush()` drains the buffer on shutdown.
+Readers use `recent_messages`, which merges still-pending messages into the
+history read from the database.
+
+A batch that still fails after MESSAGE_BUFFER_MAX_RETRIES attempts is written
+again per conversation, and the messages of a failing conversation one by one,
+so one bad row does not lose the rest of the batch. Messages that still fail
+are moved to `dead_letter_jobs` (kind "message", with the full message as
+payload) and their `persisted` future fails. If even that write fails (e.g. the
+database is down), the messages stay queued and are retried every
+MESSAGE_BUFFER_RETRY_INTERVAL seconds. Callers that must know the outcome
+await `confirm` (the streaming endpoint does, before its final SSE event).
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, update, func, case, select
+from sqlalchemy.exc import IntegrityError
+
+from agent.database import (
+    async_session, Conversation, Message, add_message, get_context_window, get_recent_messages, utcnow,
+)
+from agent.jobs import DeadLetter
+from agent.tokens import count_tokens, message_tokens
+from agent.tasks import enqueue_embedding
+
+# --- Configuration ---
+MESSAGE_BUFFER_ENABLED = os.environ.get("MESSAGE_BUFFER_ENABLED", "true").lower() in ("1", "true", "yes")
+MESSAGE_BUFFER_MAX_PENDING = int(os.environ.get("MESSAGE_BUFFER_MAX_PENDING", 1000))
+MESSAGE_BUFFER_BATCH_SIZE = int(os.environ.get("MESSAGE_BUFFER_BATCH_SIZE", 100))
+MESSAGE_BUFFER_LINGER_MS = float(os.environ.get("MESSAGE_BUFFER_LINGER_MS", 20))
+MESSAGE_BUFFER_MAX_RETRIES = int(os.environ.get("MESSAGE_BUFFER_MAX_RETRIES", 3))
+# Seconds before messages that could neither be written nor dead-lettered are tried again
+MESSAGE_BUFFER_RETRY_INTERVAL = float(os.environ.get("MESSAGE_BUFFER_RETRY_INTERVAL", 5.0))
+# Seconds `confirm` waits for messages to be written
+MESSAGE_BUFFER_CONFIRM_TIMEOUT = float(os.environ.get("MESSAGE_BUFFER_CONFIRM_TIMEOUT", 10.0))
+
+DEAD_LETTER_KIND = "message"
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingMessage:
+    """A message accepted by the buffer; reads like a `Message` row."""
+
+    id: uuid.UUID
+    conversation_id: uuid.UUID
+    sender: str
+    text: str
+    created_at: datetime
+    metadata_: Optional[dict] = None
+    tokens_estimate: Optional[int] = None
+    # Embedding job owner; None skips the embedding job
+    user_id: Optional[str] = None
+    persisted: Optional[asyncio.Future] = field(default=None, repr=False)
+
+
+class MessageWriteBuffer:
+    """Bounded in-memory queue of message writes, flushed to the database in ordered batches."""
+
+    def __init__(
+        self,
+        max_pending: int = MESSAGE_BUFFER_MAX_PENDING,
+        max_batch: int = MESSAGE_BUFFER_BATCH_SIZE,
+        linger_ms: float = MESSAGE_BUFFER_LINGER_MS,
+        max_retries: int = MESSAGE_BUFFER_MAX_RETRIES,
+        enabled: bool = MESSAGE_BUFFER_ENABLED,
+        retry_interval: float = MESSAGE_BUFFER_RETRY_INTERVAL,
+    ):
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.linger_ms = linger_ms
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.enabled = enabled
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queued: List[PendingMessage] = []
+        self._by_conversation: Dict[uuid.UUID, List[PendingMessage]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._retry_timer: Optional[asyncio.TimerHandle] = None
+        self._awaiting_retry: List[PendingMessage] = []
+        self._space: Optional[asyncio.Semaphore] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._flushes: set = set()
+        self._last_created_at: Optional[datetime] = None
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.dead_lettered = 0
+        self.requeued = 0
+        self.max_batch_ms = 0.0
+
+    def _bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        if loop is self._loop:
+            return
+        # Timers, tasks and futures of another (finished) loop cannot be used here, but its
+        # uncommitted messages are carried over and queued again
+        carried = sorted(
+            (m for messages in self._by_conversation.values() for m in messages),
+            key=lambda m: (m.created_at, str(m.id)),
+        )
+        self._loop, self._timer, self._retry_timer, self._awaiting_retry = loop, None, None, []
+        self._space = asyncio.Semaphore(max(0, self.max_pending - len(carried)))
+        self._write_lock = asyncio.Lock()
+        for message in carried:
+            message.persisted = self._new_future()
+        self._queued = carried
+        if carried:
+            logger.warning(f"Re-queued {len(carried)} buffered messages from a previous event loop")
+            self._schedule_flush()
+
+    def _new_future(self) -> asyncio.Future:
+        future = self._loop.create_future()
+        # Nobody has to await `persisted`; consume a failure so it is not reported as unretrieved
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def _next_created_at(self) -> datetime:
+        # Strictly increasing, so submission order is also (created_at, id) order
+        now = utcnow()
+        if self._last_created_at is not None and now <= self._last_created_at:
+            now = self._last_created_at + timedelta(microseconds=1)
+        self._last_created_at = now
+        return now
+
+    async def submit(
+        self,
+        conversation_id: uuid.UUID,
+        sender: str,
+        text: str,
+        metadata: Optional[dict] = None,
+        user_id: Optional[str] = None,
+    ) -> Any:
+        """
+        Accept a message for writing and return it without waiting for the database.
+
+        Args:
+            conversation_id (uuid.UUID): The conversation.
+            sender (str): 'user' or 'assistant'.
+            text (str): Message text.
+            metadata (Optional[dict]): Extensible message metadata.
+            user_id (Optional[str]): When set, the message's embedding job is enqueued
+                in the same transaction as the message.
+
+        Returns:
+            PendingMessage: With its final id and created_at. When the buffer is
+            disabled, the message is written synchronously and the `Message` row is returned.
+        """
+        if not self.enabled:
+            message = await add_message(conversation_id, sender, text, metadata=metadata)
+            if user_id is not None:
+                await enqueue_embedding(str(message.id), str(conversation_id), user_id, text)
+            return message
+
+        loop = asyncio.get_running_loop()
+        self._bind(loop)
+        await self._space.acquire()
+        message = PendingMessage(
+            id=uuid.uuid4(),
+            conversation_id=conversation_id,
+            sender=sender,
+            text=text,
+            created_at=self._next_created_at(),
+            metadata_=metadata,
+            tokens_estimate=count_tokens(text),
+            user_id=user_id,
+            persisted=self._new_future(),
+        )
+        self._queued.append(message)
+        self._by_conversation.setdefault(conversation_id, []).append(message)
+        self.submitted += 1
+
+        if len(self._queued) >= self.max_batch:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger_ms / 1000, self._on_linger)
+        return message
+
+    def _on_linger(self) -> None:
+        self._timer = None
+        if self._queued:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queued = self._queued[: self.max_batch], self._queued[self.max_batch:]
+        task = self._loop.create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+        if self._queued:
+            self._schedule_flush()
+
+    async def _flush(self, batch: List[PendingMessage]) -> None:
+        # asyncio.Lock is FIFO: batches commit in the order they were scheduled
+        async with self._write_lock:
+            error: Optional[Exception] = None
+            for attempt in range(1, self.max_retries + 1):
+                started = time.perf_counter()
+                try:
+                    await self._write(batch)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if attempt < self.max_retries:
+                        self.retries += 1
+                        logger.warning(f"Message batch write failed (attempt {attempt}): {e}; retrying")
+                        await asyncio.sleep(0.1 * 2 ** (attempt - 1))
+
+            if error is None:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.batches += 1
+                self.written += len(batch)
+                self.max_batch_ms = max(self.max_batch_ms, elapsed_ms)
+                logger.info(f"Wrote {len(batch)} buffered messages in {elapsed_ms:.1f} ms")
+                self._settle(batch)
+                return
+
+            logger.warning(
+                f"Message batch of {len(batch)} failed after {self.max_retries} attempts: {error}; "
+                f"writing per conversation"
+            )
+            failed = await self._write_isolated(batch)
+            failed_ids = {m.id for m, _ in failed}
+            self._settle([m for m in batch if m.id not in failed_ids])
+            if failed:
+                await self._dead_letter(failed)
+
+    async def _write_isolated(self, batch: List[PendingMessage]) -> List[Tuple[PendingMessage, Exception]]:
+        """Write `batch` per conversation, and a failing conversation's messages one by one."""
+        groups: Dict[uuid.UUID, List[PendingMessage]] = {}
+        for m in batch:
+            groups.setdefault(m.conversation_id, []).append(m)
+        failed: List[Tuple[PendingMessage, Exception]] = []
+        for group in groups.values():
+            try:
+                await self._write(group)
+                self.written += len(group)
+                continue
+            except Exception:
+                pass
+            for m in group:
+                try:
+                    await self._write([m])
+                except Exception as e:
+                    if isinstance(e, IntegrityError) and await self._exists(m):
+                        continue  # committed by an earlier attempt whose outcome was lost
+                    failed.append((m, e))
+                    continue
+                self.written += 1
+        return failed
+
+    @staticmethod
+    async def _exists(message: PendingMessage) -> bool:
+        try:
+            async with async_session() as session:
+                return await session.scalar(select(Message.id).where(Message.id == message.id)) is not None
+        except Exception:
+            return False
+
+    async def _dead_letter(self, failed: List[Tuple[PendingMessage, Exception]]) -> None:
+        """Move messages that cannot be written to dead_letter_jobs; keep them queued if that fails too."""
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    session.add_all([
+                        DeadLetter(
+                            job_id=m.id,
+                            kind=DEAD_LETTER_KIND,
+                            idempotency_key=f"{DEAD_LETTER_KIND}:{m.id}",
+                            payload=json.dumps(_payload(m), ensure_ascii=False),
+                            attempts=self.max_retries + 1,
+                            error=f"{type(e).__name__}: {e}",
+                        )
+                        for m, e in failed
+                    ])
+        except Exception as e:
+            self.requeued += len(failed)
+            logger.error(
+                f"Could not dead-letter {len(failed)} buffered messages: {e}; "
+                f"retrying in {self.retry_interval:.0f}s"
+            )
+            self._awaiting_retry.extend(m for m, _ in failed)
+            if self._retry_timer is None:
+                self._retry_timer = self._loop.call_later(self.retry_interval, self._retry)
+            return
+        self.dead_lettered += len(failed)
+        for m, e in failed:
+            logger.error(f"Message {m.id} of conversation {m.conversation_id} moved to dead-letter: {e}")
+        for m, e in failed:
+            self._settle([m], e)
+
+    def _retry(self) -> None:
+        if self._retry_timer is not None:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        self._queued[:0], self._awaiting_retry = self._awaiting_retry, []
+        if self._queued:
+            self._schedule_flush()
+
+    def _settle(self, messages: List[PendingMessage], error: Optional[Exception] = None) -> None:
+        """Drop `messages` from the pending view, resolve their futures and free their slots."""
+        for message in messages:
+            pending = self._by_conversation.get(message.conversation_id, [])
+            if message in pending:
+                pending.remove(message)
+            if not pending:
+                self._by_conversation.pop(message.conversation_id, None)
+            if not message.persisted.done():
+                if error is None:
+                    message.persisted.set_result(message.id)
+                else:
+                    message.persisted.set_exception(error)
+            self._space.release()
+
+    async def _write(self, batch: List[PendingMessage]) -> None:
+        """One transaction: multi-row INSERT, last_active_at/tokens_total UPDATE and the embedding jobs."""
+        added_tokens: Dict[uuid.UUID, int] = {}
+        for m in batch:
+            added_tokens[m.conversation_id] = added_tokens.get(m.conversation_id, 0) + m.tokens_estimate
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    insert(Message).values([
+                        {
+                            "id": m.id,
+                            "conversation_id": m.conversation_id,
+                            "sender": m.sender,
+                            "text": m.text,
+                            "tokens_estimate": m.tokens_estimate,
+                            "created_at": m.created_at,
+                            "metadata_": m.metadata_,
+                        }
+                        for m in batch
+                    ])
+                )
+                await session.execute(
+                    update(Conversation)
+                    .where(Conversation.id.in_(added_tokens))
+                    .values(
+                        last_active_at=func.now(),
+                        tokens_total=Conversation.tokens_total
+                        + case(added_tokens, value=Conversation.id, else_=0),
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                for m in batch:
+                    if m.user_id is not None:
+                        await enqueue_embedding(
+                            str(m.id), str(m.conversation_id), m.user_id, m.text, session=session
+                        )
+
+    def pending(self, conversation_id: uuid.UUID) -> List[PendingMessage]:
+        """Messages of `conversation_id` accepted but not yet committed, oldest first."""
+        return list(self._by_conversation.get(conversation_id, []))
+
+    async def recent_messages(
+        self, conversation_id: uuid.UUID, limit: int, token_budget: Optional[int] = None
+    ) -> List[Any]:
+        """
+        `get_recent_messages` plus this buffer's pending messages for the conversation.
+
+        Args:
+            conversation_id (uuid.UUID): The conversation.
+            limit (int): Maximum number of messages.
+            token_budget (Optional[int]): When set, the window is chosen by stored token
+                counts instead (`get_context_window`), pending messages included.
+
+        Returns:
+            List: The `limit` most recent messages (rows or pending), oldest first.
+        """
+        # Snapshot pending first: a message committed during the read is then in at least one of the two
+        pending = self.pending(conversation_id)
+        if token_budget is None:
+            stored = await get_recent_messages(conversation_id, limit)
+        else:
+            stored = await get_context_window(conversation_id, token_budget, limit)
+        if not pending:
+            return stored
+        seen = {m.id for m in stored}
+        merged = stored + [m for m in pending if m.id not in seen]
+        merged.sort(key=lambda m: (m.created_at, str(m.id)))
+        merged = merged[-limit:]
+        if token_budget is not None:
+            merged = _fit_tokens(merged, token_budget)
+        return merged
+
+    async def flush(self) -> None:
+        """Write everything queued (or waiting for a retry) now and wait for in-progress batches (e.g. on shutdown)."""
+        if self._awaiting_retry:
+            self._retry()
+        elif self._queued:
+            self._schedule_flush()
+        if self._flushes:
+            await asyncio.gather(*list(self._flushes), return_exceptions=True)
+        if self._awaiting_retry:
+            logger.error(f"{len(self._awaiting_retry)} buffered messages could not be written or dead-lettered")
+
+    async def confirm(self, *messages: Any, timeout: float = MESSAGE_BUFFER_CONFIRM_TIMEOUT) -> None:
+        """
+        Wait until `messages` are committed.
+
+        Args:
+            *messages: Values returned by `submit` (`Message` rows are already committed); None is ignored.
+            timeout (float): Seconds to wait.
+
+        Raises:
+            Exception: The write error of a message moved to dead-letter.
+            asyncio.TimeoutError: Messages still pending after `timeout` (they stay queued).
+        """
+        futures = [m.persisted for m in messages if getattr(m, "persisted", None) is not None]
+        if futures:
+            await asyncio.wait_for(asyncio.shield(asyncio.gather(*futures)), timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_pending": self.max_pending,
+            "pending": sum(len(v) for v in self._by_conversation.values()),
+            "submitted": self.submitted,
+            "written": self.written,
+            "batches": self.batches,
+            "retries": self.retries,
+            "dead_lettered": self.dead_lettered,
+            "requeued": self.requeued,
+            "max_batch_ms": self.max_batch_ms,
+        }
+
+
+def _payload(message: PendingMessage) -> Dict[str, Any]:
+    """A dead-lettered message as JSON, enough to insert it again by hand."""
+    return {
+        "id": str(message.id),
+        "conversation_id": str(message.conversation_id),
+        "sender": message.sender,
+        "text": message.text,
+        "created_at": message.created_at.isoformat(),
+        "metadata": message.metadata_,
+        "tokens_estimate": message.tokens_estimate,
+        "user_id": message.user_id,
+    }
+
+
+def _fit_tokens(messages: List[Any], token_budget: int) -> List[Any]:
+    """The newest messages whose prompt lines fit `token_budget` (at least one), oldest first."""
+    kept, used = 0, 0
+    for m in reversed(messages):
+        used += message_tokens(m.sender, m.text, m.tokens_estimate)
+        if kept and used > token_budget:
+            break
+        kept += 1
+    return messages[len(messages) - kept:]
+
+
+# Process-wide buffer used by the streaming endpoint
+message_buffer = MessageWriteBuffer()
@@ -0,0 +1,105 @@
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#   "langgraph",
+#   "sqlalchemy[asyncio]>=2.0.0",
+#   "aiosqlite",
+#   "chromadb",
+#   "httpx",
+#   "requests",
+# ]
+# ///
+
+"""
+Script: bench_flow_compile.py
+Purpose: Measure per-turn LangGraph construction overhead, before and after the
+compiled-flow registry.
+
+- "before": every turn calls create_flow() and then ainvoke (old behaviour)
+- "after":  every turn reuses get_flow("chat") (compiled once per process)
+
+Ollama and Chroma calls are stubbed so only graph overhead is measured.
+
+Usage:
+    uv run scripts/bench_flow_compile.py --turns 200
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import statistics
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from agent.langgraph_flow import create_flow, get_flow
+
+
+def make_state():
+    return {
+        "conversation_id": "bench-conversation",
+        "user_id": "bench-user",
+        "chat_history": [
+            {"role": "user", "content": "Xin chào"},
+            {"role": "assistant", "content": "Chào bạn, mình có thể giúp gì?"},
+            {"role": "user", "content": "Pixel 10 dùng chip gì vậy, có mạnh hơn Pixel 9 không?"},
+        ],
+        "metadata": {"conversation_id": "bench-conversation", "user_id": "bench-user"},
+        "retrieved_context": None,
+        "response": None,
+        "stream": False,
+    }
+
+
+async def stub_generate(prompt, model="gpt-oss", **kwargs):
+    return "stub response"
+
+
+async def stub_query(*args, **kwargs):
+    return [{"id": "doc", "document": "Tensor G5", "metadata": {}, "distance": 0.1}]
+
+
+async def run_turns(turns, get_app):
+    build_ms, turn_ms = [], []
+    for _ in range(turns):
+        t0 = time.perf_counter()
+        app = get_app()
+        t1 = time.perf_counter()
+        await app.ainvoke(make_state())
+        t2 = time.perf_counter()
+        build_ms.append((t1 - t0) * 1000)
+        turn_ms.append((t2 - t0) * 1000)
+    return build_ms, turn_ms
+
+
+def summarize(label, build_ms, turn_ms):
+    p95 = sorted(turn_ms)[int(len(turn_ms) * 0.95) - 1]
+    print(
+        f"{label:<8} graph build mean {statistics.mean(build_ms):8.3f} ms | "
+        f"turn mean {statistics.mean(turn_ms):8.3f} ms | turn p95 {p95:8.3f} ms"
+    )
+
+
+async def main_async(turns):
+    with patch("agent.langgraph_flow.agenerate_text", stub_generate), \
+         patch("agent.langgraph_flow.aquery_vectors", stub_query):
+        get_flow("chat")  # warm the registry, as the startup hook does
+        before = await run_turns(turns, create_flow)
+        after = await run_turns(turns, lambda: get_flow("chat"))
+    print(f"--- LangGraph per-turn overhead ({turns} turns, I/O stubbed) ---")
+    summarize("before", *before)
+    summarize("after", *after)
+    saved = statistics.mean(before[1]) - statistics.mean(after[1])
+    print(f"Saved per turn: {saved:.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LangGraph flow construction per turn.")
+    parser.add_argument('--turns', type=int, default=200, help='Number of simulated turns per variant')
+    args = parser.parse_args()
+    asyncio.run(main_async(args.turns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#   "chromadb",
+#   "numpy",
+#   "httpx",
+#   "requests",
+#   "python-dotenv",
+# ]
+# ///
+
+"""
+Script: export_vector_index.py
+Purpose: Export a (read-mostly) Chroma collection to the memory-mapped vector
+index served in-process by agent/vector_index.py.
+
+- Reads all embeddings, documents and metadatas from the collection
+- Writes vectors.npy (float32/float16), norms.npy and meta.json
+- Builds hnsw.bin too if `hnswlib` is installed (used for large collections)
+
+Run after scripts/index_knowledge.py, then serve the collection from the index:
+
+    uv run scripts/export_vector_index.py --collection knowledge --dtype float16
+    VECTOR_INDEX_COLLECTIONS=knowledge uv run uvicorn agent.main:app
+
+Running API workers keep the index they loaded at startup; restart them to pick
+up a new export.
+"""
+
+import os
+import sys
+import argparse
+import time
+import chromadb
+from dotenv import load_dotenv
+
+# --- Config from .env.local ---
+load_dotenv(".env.local")
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from agent.vector_index import export_collection, index_path
+
+# ChromaDB persistent local path
+CHROMA_PATH = os.environ.get("CHROMA_PATH", "./database/chroma_db/")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Chroma collection to a memory-mapped vector index.")
+    parser.add_argument('--collection', type=str, default='knowledge', help='Chroma collection name')
+    parser.add_argument('--out', type=str, default=None, help='Output directory (default: VECTOR_INDEX_DIR/<collection>)')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32', help='Stored vector precision')
+    parser.add_argument('--no-hnsw', action='store_true', help='Skip building the HNSW graph')
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=CHROMA_PATH)
+    collection = client.get_collection(args.collection)
+    out_dir = args.out or index_path(args.collection)
+
+    start = time.time()
+    count = export_collection(collection, out_dir, dtype=args.dtype, build_hnsw=not args.no_hnsw)
+    print(f"Exported {count} vectors from '{args.collection}' to {out_dir} in {time.time() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
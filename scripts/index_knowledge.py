@@ -3,6 +3,7 @@
 # dependencies = [
 #   "chromadb",
 #   "requests",
+#   "httpx",
 #   "tqdm",
 #   "python-dotenv",
 # ]
@@ -12,33 +13,71 @@
 Script: index_knowledge.py
 Purpose: Index all documents in the 'knowledge' folder into ChromaDB for agent retrieval.
 
-- Reads all files in 'knowledge/'
+- Walks 'knowledge/' (recursively)
 - Splits content into chunks (200-512 tokens)
 - Embeds using bge-m3 (via Ollama)
 - Upserts into ChromaDB (local, ./database/chroma_db/)
+- Adds the same chunks to the BM25 lexical index (./database/lexical_index.sqlite)
+
+The work runs as a streaming pipeline of asyncio stages connected by bounded
+queues, so a slow stage holds back the ones before it instead of buffering the
+whole corpus in memory:
+
+    discover files -> read + chunk -> embed (batches, --concurrency requests) -> upsert (batches)
+
+Chunk ids are deterministic ("<path>#chunk_<n>") and written with upsert, so
+re-runs overwrite instead of failing on duplicate ids. A checkpoint manifest
+(content hash and chunk count per file, next to the Chroma data) is saved
+after each upsert batch: an interrupted run resumes with the files not yet
+indexed, and unchanged files are skipped on later runs. Use --no-resume to
+re-index everything.
 
 Usage:
-    uv run scripts/index_knowledge.py --source knowledge/ --collection conversations_dev
+    uv run scripts/index_knowledge.py --source knowledge/
+    uv run scripts/index_knowledge.py --source knowledge/acme/ --tenant <tenant_id>   # KNOWLEDGE_COLLECTION_NAME=knowledge_{tenant}
+    uv run scripts/index_knowledge.py --source knowledge/ --concurrency 8 --embed-batch 64
 
-Dependencies: chromadb, requests (for Ollama API), tqdm
+Knowledge goes into its own collection (KNOWLEDGE_COLLECTION_NAME, default
+"knowledge"), separate from the conversation memory collection.
+
+Dependencies: chromadb, httpx (for Ollama API via agent.ollama_client), tqdm
 """
 
 import os
+import sys
+import json
+import hashlib
 import argparse
+import asyncio
 import time
 import chromadb
 from tqdm import tqdm
-import requests
 from dotenv import load_dotenv
 
 # --- Config from .env.local ---
 load_dotenv(".env.local")
-OLLAMA_EMBEDDING_URL = os.environ.get("OLLAMA_EMBEDDING_URL", "http://localhost:11434/api/embeddings")
+
+# Make the `agent` package importable when run as `uv run scripts/index_knowledge.py`
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from agent.ollama_client import aget_embeddings
+from agent.lexical import lexical_index
+
 EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "bge-m3")
 CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 400))
+# Chunks per embedding request, concurrent embedding requests, chunks per upsert
+INDEX_EMBED_BATCH_SIZE = int(os.environ.get("INDEX_EMBED_BATCH_SIZE", 32))
+INDEX_EMBED_CONCURRENCY = int(os.environ.get("INDEX_EMBED_CONCURRENCY", 4))
+INDEX_UPSERT_BATCH_SIZE = int(os.environ.get("INDEX_UPSERT_BATCH_SIZE", 256))
+# Max items waiting between two stages (backpressure)
+INDEX_QUEUE_SIZE = int(os.environ.get("INDEX_QUEUE_SIZE", 1024))
 
 # ChromaDB persistent local path
 CHROMA_PATH = os.environ.get("CHROMA_PATH", "./database/chroma_db/")
+# Same setting as agent.retriever; "{tenant}" selects a per-tenant collection
+KNOWLEDGE_COLLECTION_NAME = os.environ.get("KNOWLEDGE_COLLECTION_NAME", "knowledge")
+
+_DONE = object()
+
 
 # --- Helpers ---
 def chunk_text(text, chunk_size=CHUNK_SIZE):
@@ -48,39 +87,232 @@ def chunk_text(text, chunk_size=CHUNK_SIZE):
         chunk = ' '.join(words[i:i+chunk_size])
         yield chunk, len(words[i:i+chunk_size])
 
-def get_embedding(text):
-    payload = {"model": EMBEDDING_MODEL, "prompt": text}
-    resp = requests.post(OLLAMA_EMBEDDING_URL, json=payload)
-    resp.raise_for_status()
-    return resp.json()["embedding"]
-
-def index_file(filepath, collection, metadata_base, stats):
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-        doc_id = os.path.basename(filepath)
-        for idx, (chunk, token_count) in enumerate(chunk_text(content)):
-            embedding = get_embedding(chunk)
-            meta = {"source": doc_id, "chunk": idx, **metadata_base}
-            collection.add(
-                ids=[f"{doc_id}#chunk_{idx}"],
-                embeddings=[embedding],
-                documents=[chunk],
-                metadatas=[meta]
-            )
-            stats['chunks'] += 1
-            stats['tokens'] += token_count
-        stats['files'] += 1
-    except Exception as e:
-        stats['errors'].append((filepath, str(e)))
+
+def chunk_ids(doc_id, count, start=0):
+    return [f"{doc_id}#chunk_{idx}" for idx in range(start, count)]
+
+
+def discover_files(source):
+    """Files under `source` (recursively, hidden entries skipped) as (path, doc_id) pairs, sorted."""
+    found = []
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            # Top-level files keep their basename as id, as in earlier runs
+            found.append((path, os.path.relpath(path, source).replace(os.sep, '/')))
+    return found
+
+
+class Manifest:
+    """Checkpoint of indexed files: doc_id -> {"sha256", "chunks"}, saved atomically as JSON."""
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.files = {}
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.files = json.load(f).get("files", {})
+
+    def is_current(self, doc_id, digest):
+        entry = self.files.get(doc_id)
+        return entry is not None and entry["sha256"] == digest
+
+    def previous_chunks(self, doc_id):
+        entry = self.files.get(doc_id)
+        return entry["chunks"] if entry else 0
+
+    def mark(self, doc_id, digest, chunks):
+        self.files[doc_id] = {"sha256": digest, "chunks": chunks}
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"files": self.files}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class IndexPipeline:
+    """Streaming discover -> chunk -> embed -> upsert pipeline with bounded queues between stages."""
+
+    def __init__(self, collection, manifest, embed_batch, concurrency, upsert_batch, queue_size, progress):
+        self.collection = collection
+        self.manifest = manifest
+        self.embed_batch = embed_batch
+        self.concurrency = concurrency
+        self.upsert_batch = upsert_batch
+        self.files_q = asyncio.Queue(maxsize=queue_size)
+        self.chunks_q = asyncio.Queue(maxsize=queue_size)
+        self.embedded_q = asyncio.Queue(maxsize=max(1, queue_size // embed_batch))
+        self.progress = progress
+        # doc_id -> [sha256, total chunks, chunks still to upsert]
+        self.open_files = {}
+        self.failed_files = set()
+        self.stats = {'files': 0, 'skipped': 0, 'chunks': 0, 'tokens': 0, 'embeddings': 0, 'errors': []}
+
+    async def discover(self, files):
+        for path, doc_id in files:
+            await self.files_q.put((path, doc_id))
+        await self.files_q.put(_DONE)
+
+    async def chunk(self):
+        while (item := await self.files_q.get()) is not _DONE:
+            path, doc_id = item
+            try:
+                raw = await asyncio.to_thread(_read_bytes, path)
+                digest = hashlib.sha256(raw).hexdigest()
+                if self.manifest.is_current(doc_id, digest):
+                    self.stats['skipped'] += 1
+                    self.progress.update(1)
+                    continue
+                chunks = list(chunk_text(raw.decode('utf-8')))
+            except Exception as e:
+                self.stats['errors'].append((path, str(e)))
+                self.progress.update(1)
+                continue
+            await asyncio.to_thread(self._drop_stale_chunks, doc_id, len(chunks))
+            if not chunks:
+                self._finish_file(doc_id, digest, 0)
+                continue
+            self.open_files[doc_id] = [digest, len(chunks), len(chunks)]
+            for idx, (text, token_count) in enumerate(chunks):
+                await self.chunks_q.put({
+                    "id": f"{doc_id}#chunk_{idx}",
+                    "document": text,
+                    "metadata": {"source": doc_id, "chunk": idx},
+                    "doc_id": doc_id,
+                    "tokens": token_count,
+                })
+        await self.chunks_q.put(_DONE)
+
+    def _drop_stale_chunks(self, doc_id, count):
+        # A file that shrank leaves chunk ids beyond its new length from the previous run
+        stale = chunk_ids(doc_id, self.manifest.previous_chunks(doc_id), start=count)
+        if stale:
+            self.collection.delete(ids=stale)
+            lexical_index.delete(self.collection.name, stale)
+
+    async def batch_chunks(self, batches_q):
+        """Group the chunk stream into embedding batches (crossing file boundaries)."""
+        batch = []
+        while (item := await self.chunks_q.get()) is not _DONE:
+            batch.append(item)
+            if len(batch) >= self.embed_batch:
+                await batches_q.put(batch)
+                batch = []
+        if batch:
+            await batches_q.put(batch)
+        for _ in range(self.concurrency):
+            await batches_q.put(_DONE)
+
+    async def embed(self, batches_q):
+        while (batch := await batches_q.get()) is not _DONE:
+            try:
+                embeddings = await aget_embeddings([c["document"] for c in batch], model=EMBEDDING_MODEL)
+            except Exception as e:
+                self._fail(batch, e)
+                continue
+            self.stats['embeddings'] += len(batch)
+            for item, embedding in zip(batch, embeddings):
+                item["embedding"] = embedding
+            await self.embedded_q.put(batch)
+
+    async def upsert(self, embedders):
+        pending = []
+        finished = 0
+        while finished < embedders:
+            batch = await self.embedded_q.get()
+            if batch is _DONE:
+                finished += 1
+            else:
+                pending.extend(batch)
+            while len(pending) >= self.upsert_batch or (pending and finished == embedders):
+                await self._write(pending[:self.upsert_batch])
+                pending = pending[self.upsert_batch:]
+
+    async def _write(self, items):
+        items = [c for c in items if c["doc_id"] not in self.failed_files]
+        if not items:
+            return
+        ids = [c["id"] for c in items]
+        documents = [c["document"] for c in items]
+        metadatas = [c["metadata"] for c in items]
+        try:
+            await asyncio.to_thread(self._upsert_sync, ids, [c["embedding"] for c in items], documents, metadatas)
+        except Exception as e:
+            self._fail(items, e)
+            return
+        for item in items:
+            self.stats['chunks'] += 1
+            self.stats['tokens'] += item["tokens"]
+            # Another batch of the same file may have failed while the upsert ran
+            entry = self.open_files.get(item["doc_id"])
+            if entry is None:
+                continue
+            entry[2] -= 1
+            if entry[2] == 0:
+                del self.open_files[item["doc_id"]]
+                self._finish_file(item["doc_id"], entry[0], entry[1])
+        # Checkpoint after every batch so an interrupted run resumes from here
+        await asyncio.to_thread(self.manifest.save)
+
+    def _upsert_sync(self, ids, embeddings, documents, metadatas):
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        # Same chunks in the BM25 index used for hybrid retrieval
+        lexical_index.upsert(self.collection.name, ids, documents, metadatas)
+
+    def _finish_file(self, doc_id, digest, chunks):
+        self.manifest.mark(doc_id, digest, chunks)
+        self.stats['files'] += 1
+        self.progress.update(1)
+
+    def _fail(self, items, error):
+        for doc_id in dict.fromkeys(c["doc_id"] for c in items):
+            if doc_id not in self.failed_files:
+                self.failed_files.add(doc_id)
+                self.open_files.pop(doc_id, None)
+                self.stats['errors'].append((doc_id, str(error)))
+                self.progress.update(1)
+
+    async def run(self, files):
+        batches_q = asyncio.Queue(maxsize=self.concurrency * 2)
+        stages = [
+            self.discover(files),
+            self.chunk(),
+            self.batch_chunks(batches_q),
+            *(self._embed_then_done(batches_q) for _ in range(self.concurrency)),
+            self.upsert(self.concurrency),
+        ]
+        await asyncio.gather(*stages)
+        self.manifest.save()
+        return self.stats
+
+    async def _embed_then_done(self, batches_q):
+        try:
+            await self.embed(batches_q)
+        finally:
+            await self.embedded_q.put(_DONE)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Index knowledge documents into ChromaDB.")
     parser.add_argument('--source', default='knowledge/', help='Folder with documents to index')
-    parser.add_argument('--collection', default='conversations_dev', help='ChromaDB collection name')
+    parser.add_argument('--collection', default=None, help='ChromaDB collection name (default: KNOWLEDGE_COLLECTION_NAME)')
+    parser.add_argument('--tenant', default='default', help='Tenant id used when KNOWLEDGE_COLLECTION_NAME contains {tenant}')
     parser.add_argument('--clear', action='store_true', help='Clear collection before indexing')
+    parser.add_argument('--no-resume', action='store_true', help='Ignore the checkpoint manifest and re-index every file')
+    parser.add_argument('--embed-batch', type=int, default=INDEX_EMBED_BATCH_SIZE, help='Chunks per embedding request')
+    parser.add_argument('--concurrency', type=int, default=INDEX_EMBED_CONCURRENCY, help='Concurrent embedding requests')
+    parser.add_argument('--upsert-batch', type=int, default=INDEX_UPSERT_BATCH_SIZE, help='Chunks per ChromaDB upsert')
     args = parser.parse_args()
+    args.collection = args.collection or KNOWLEDGE_COLLECTION_NAME.format(tenant=args.tenant)
 
 
     abs_chroma_path = os.path.abspath(CHROMA_PATH)
@@ -89,28 +321,43 @@ def main():
     client = chromadb.PersistentClient(path=abs_chroma_path)
 
     collection = client.get_or_create_collection(args.collection)
+    manifest_path = os.path.join(abs_chroma_path, f"index_manifest_{args.collection}.json")
 
     if args.clear:
         print(f"Clearing collection '{args.collection}'...")
         client.delete_collection(args.collection)
         collection = client.get_or_create_collection(args.collection)
+        lexical_index.clear(args.collection)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
 
-    files = [os.path.join(args.source, f) for f in os.listdir(args.source) if os.path.isfile(os.path.join(args.source, f))]
+    manifest = Manifest(manifest_path, resume=not args.no_resume)
+    files = discover_files(args.source)
     print(f"Indexing {len(files)} files from {args.source} into collection '{args.collection}'...")
 
-    stats = {'files': 0, 'chunks': 0, 'tokens': 0, 'errors': []}
     start = time.time()
-    for filepath in tqdm(files):
-        index_file(filepath, collection, metadata_base={}, stats=stats)
+    with tqdm(total=len(files)) as progress:
+        pipeline = IndexPipeline(
+            collection, manifest,
+            embed_batch=max(1, args.embed_batch),
+            concurrency=max(1, args.concurrency),
+            upsert_batch=max(1, args.upsert_batch),
+            queue_size=INDEX_QUEUE_SIZE,
+            progress=progress,
+        )
+        stats = asyncio.run(pipeline.run(files))
     elapsed = time.time() - start
 
     # PersistentClient writes to disk automatically; no extra persist step required.
 
     print("\n--- Indexing Statistics ---")
     print(f"Files indexed:   {stats['files']}")
+    print(f"Files unchanged: {stats['skipped']} (skipped, see {manifest_path})")
     print(f"Chunks created:  {stats['chunks']}")
     print(f"Tokens (approx): {stats['tokens']}")
     print(f"Elapsed time:    {elapsed:.2f} seconds")
+    if elapsed > 0:
+        print(f"Throughput:      {stats['chunks'] / elapsed:.1f} chunks/s, {stats['embeddings'] / elapsed:.1f} embeddings/s")
     if stats['errors']:
         print(f"Errors: {len(stats['errors'])}")
         for f, err in stats['errors']:
@@ -8,4 +8,40 @@ import os
 # Add the agent module to the Python path so tests can import from it
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-# You can add pytest fixtures, hooks, and other configuration here
\ No newline at end of file
+# Keep the BM25 index in memory so tests never write ./database/lexical_index.sqlite
+os.environ.setdefault("LEXICAL_INDEX_PATH", ":memory:")
+
+# You can add pytest fixtures, hooks, and other configuration here
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_embedding_cache():
+    """Keep the process-wide embedding cache from leaking results between tests."""
+    from agent.embedding_cache import embedding_cache
+    embedding_cache.clear()
+    yield
+    embedding_cache.clear()
+
+@pytest.fixture(autouse=True)
+def clear_lexical_index():
+    """Start every test with an empty lexical index."""
+    from agent.lexical import lexical_index
+    lexical_index.clear()
+    yield
+
+@pytest.fixture(autouse=True)
+def clear_retrieval_cache():
+    """Keep cached retrieval results from leaking between tests."""
+    from agent.retrieval_cache import retrieval_cache
+    retrieval_cache.clear()
+    yield
+    retrieval_cache.clear()
+
+@pytest.fixture(autouse=True)
+def clear_conversation_cache():
+    """Conversation metadata cached by one test must not satisfy lookups in another."""
+    from agent.database import clear_conversation_cache
+    clear_conversation_cache()
+    yield
+    clear_conversation_cache()
@@ -0,0 +1,75 @@
+"""
+Unit tests for the dedicated Chroma thread pool.
+"""
+
+import asyncio
+import threading
+import time
+from agent.chroma_pool import ChromaPool, ChromaPoolFull
+
+
+def test_calls_run_off_the_event_loop_thread():
+    """Blocking Chroma calls run on pool threads while the loop keeps ticking."""
+    pool = ChromaPool(max_workers=2)
+
+    def blocking_query():
+        time.sleep(0.1)
+        return threading.current_thread().name
+
+    async def run_test():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.create_task(ticker())
+        thread_name = await pool.run(blocking_query)
+        ticking.cancel()
+        return thread_name, ticks
+
+    thread_name, ticks = asyncio.run(run_test())
+    pool.shutdown()
+    assert thread_name.startswith("chroma")
+    assert ticks >= 5
+
+
+def test_concurrency_is_bounded_and_waits_are_measured():
+    """At most max_workers calls run at once; the rest wait and are counted."""
+    pool = ChromaPool(max_workers=1)
+    active, peak = 0, 0
+    lock = threading.Lock()
+
+    def query():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+
+    async def run_test():
+        await asyncio.gather(*(pool.run(query) for _ in range(3)))
+
+    asyncio.run(run_test())
+    pool.shutdown()
+    stats = pool.stats()
+    assert peak == 1
+    assert stats["calls"] == 3
+    assert stats["queue_wait_max_ms"] >= 50
+
+
+def test_full_queue_rejects_calls():
+    """Calls beyond max_queue waiting are rejected instead of piling up."""
+    pool = ChromaPool(max_workers=1, max_queue=1)
+
+    async def run_test():
+        return await asyncio.gather(*(pool.run(time.sleep, 0.05) for _ in range(4)), return_exceptions=True)
+
+    results = asyncio.run(run_test())
+    pool.shutdown()
+    assert any(isinstance(r, ChromaPoolFull) for r in results)
+    assert pool.stats()["rejected"] >= 1
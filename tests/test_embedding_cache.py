@@ -0,0 +1,113 @@
+"""
+Unit tests for the embedding cache.
+"""
+
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+from agent.embedding_cache import EmbeddingCache, cache_key
+
+
+def test_cache_key_normalizes_text_and_includes_model():
+    """Whitespace variants share a key; a different model never does."""
+    assert cache_key("bge-m3", "  Pixel   10 ") == cache_key("bge-m3", "Pixel 10")
+    assert cache_key("bge-m3", "Pixel 10") != cache_key("other-model", "Pixel 10")
+
+
+def test_memory_tier_lru_eviction_and_counters():
+    """The memory tier is bounded and counts hits and misses."""
+    cache = EmbeddingCache(maxsize=2)
+    cache.put("m", "a", [1.0])
+    cache.put("m", "b", [2.0])
+    assert cache.get("m", "a") == [1.0]  # 'a' is now most recently used
+    cache.put("m", "c", [3.0])           # evicts 'b'
+    assert cache.get("m", "b") is None
+    assert cache.get("m", "c") == [3.0]
+    stats = cache.stats()
+    assert stats["memory_hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["memory_size"] == 2
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    """Entries written to the SQLite tier are visible to a fresh cache instance."""
+    path = str(tmp_path / "embeddings.sqlite")
+    EmbeddingCache(maxsize=10, path=path).put("bge-m3", "xin chào", [0.5, 0.25])
+
+    cache = EmbeddingCache(maxsize=10, path=path)
+    assert cache.get("bge-m3", "xin chào") == [0.5, 0.25]
+    assert cache.get("other-model", "xin chào") is None
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_get_embedding_served_from_cache():
+    """A repeated text is embedded by Ollama only once."""
+    from agent.ollama_client import get_embedding
+
+    with patch('agent.ollama_client.requests.Session.post') as mock_post:
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"embedding": [0.1, 0.2]}
+        mock_response.raise_for_status.return_value = None
+        mock_post.return_value = mock_response
+
+        assert get_embedding("Pixel 10 chip là gì?") == [0.1, 0.2]
+        assert get_embedding("Pixel 10 chip là gì?") == [0.1, 0.2]
+        mock_post.assert_called_once()
+
+
+def test_aget_embeddings_only_sends_misses():
+    """Cached texts are skipped and duplicates within a batch are sent once."""
+    from agent import ollama_client
+
+    ollama_client.embedding_cache.put(ollama_client.DEFAULT_EMBEDDING_MODEL, "cached", [9.0])
+    with patch('agent.ollama_client._embed_batch', new_callable=AsyncMock) as mock_batch, \
+         patch('agent.ollama_client._batch_embed_supported', True):
+        mock_batch.return_value = [[1.0], [2.0]]
+        result = asyncio.run(ollama_client.aget_embeddings(["x", "cached", "y", "x"]))
+
+    assert result == [[1.0], [9.0], [2.0], [1.0]]
+    mock_batch.assert_awaited_once()
+    assert mock_batch.await_args.args[0] == ["x", "y"]
+
+
+def test_cached_embeddings_are_returned_as_copies():
+    """Mutating a returned embedding never changes the cached vector."""
+    cache = EmbeddingCache(maxsize=10)
+    cache.put("m", "a", [1.0, 2.0])
+    first = cache.get("m", "a")
+    first[0] = 99.0
+    assert cache.get("m", "a") == [1.0, 2.0]
+    many = asyncio.run(cache.aget_many("m", ["a", "a"]))
+    many[0].append(3.0)
+    assert many[1] == [1.0, 2.0]
+
+
+def test_async_disk_tier_runs_off_the_event_loop_in_batches(tmp_path):
+    """aget_many/aput_many read and write SQLite in a worker thread, one transaction per write batch."""
+    import threading
+
+    cache = EmbeddingCache(maxsize=10, path=str(tmp_path / "embeddings.sqlite"))
+    disk = cache._disk
+    threads = set()
+    real_get_many, real_put_many = disk.get_many, disk.put_many
+
+    def get_many(keys):
+        threads.add(threading.get_ident())
+        return real_get_many(keys)
+
+    def put_many(items):
+        threads.add(threading.get_ident())
+        return real_put_many(items)
+
+    async def run_test():
+        await cache.aput_many("bge-m3", {"a": [0.5], "b": [0.25], "c": [0.125]})
+        cache.clear()  # memory only; the vectors are now on disk
+        return await cache.aget_many("bge-m3", ["a", "x", "c"])
+
+    with patch.object(disk, 'get_many', side_effect=get_many) as mock_get, \
+         patch.object(disk, 'put_many', side_effect=put_many) as mock_put:
+        results = asyncio.run(run_test())
+
+    assert results == [[0.5], None, [0.125]]
+    assert mock_put.call_count == 1 and mock_get.call_count == 1
+    assert threading.get_ident() not in threads
+    assert cache.stats()["disk_hits"] == 2 and cache.stats()["misses"] == 1
@@ -0,0 +1,57 @@
+"""
+Unit tests for the knowledge indexing pipeline (scripts/index_knowledge.py).
+"""
+
+import asyncio
+import threading
+from unittest.mock import patch, MagicMock
+
+from scripts.index_knowledge import IndexPipeline, Manifest
+
+
+class SlowCollection:
+    """Chroma collection stub whose upsert blocks until released."""
+
+    name = "knowledge"
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.upserted = []
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.started.set()
+        self.release.wait(5)
+        self.upserted.extend(ids)
+
+    def delete(self, ids):
+        pass
+
+
+def test_embed_failure_during_upsert_of_same_file(tmp_path):
+    """A batch failing while an earlier batch of the same file is upserting fails the file, not the run."""
+    source = tmp_path / "a.txt"
+    source.write_text("one two three four", encoding="utf-8")
+    collection = SlowCollection()
+
+    async def fake_embeddings(texts, model=None):
+        if texts == ["one two"]:
+            return [[0.1, 0.2]]
+        # Fail the second chunk only once the first one is being upserted
+        await asyncio.to_thread(collection.started.wait, 5)
+        asyncio.get_running_loop().call_later(0.05, collection.release.set)
+        raise RuntimeError("embedding backend down")
+
+    pipeline = IndexPipeline(
+        collection, Manifest(str(tmp_path / "manifest.json")),
+        embed_batch=1, concurrency=2, upsert_batch=1, queue_size=8, progress=MagicMock(),
+    )
+    with patch("scripts.index_knowledge.aget_embeddings", side_effect=fake_embeddings), \
+         patch("scripts.index_knowledge.chunk_text", side_effect=lambda text: iter([("one two", 2), ("three four", 2)])):
+        stats = asyncio.run(pipeline.run([(str(source), "a.txt")]))
+
+    assert collection.upserted == ["a.txt#chunk_0"]
+    assert stats["errors"] == [("a.txt", "embedding backend down")]
+    assert stats["files"] == 0
+    # Not checkpointed, so the next run indexes the file again
+    assert "a.txt" not in pipeline.manifest.files
@@ -0,0 +1,268 @@
+"""
+Unit tests for the SQL-backed job queue and its handlers.
+"""
+
+import asyncio
+import uuid
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import patch, AsyncMock
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from agent.database import Base
+from agent import jobs
+from agent.jobs import Job, DeadLetter, JobWorker, enqueue, queue_stats, register_handler, PENDING, DEAD
+from agent.tasks import embed_and_store_message, chunk_message
+
+
+@pytest.fixture
+def job_db(tmp_path):
+    """Point the job queue at a fresh SQLite database."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+    session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    with patch('agent.jobs.async_session', session_factory):
+        yield session_factory
+    asyncio.run(engine.dispose())
+
+
+def test_enqueue_is_idempotent(job_db):
+    """A second job with the same key is not added."""
+    async def run_test():
+        assert await enqueue("noop", {"n": 1}, idempotency_key="embed:m1") is True
+        assert await enqueue("noop", {"n": 1}, idempotency_key="embed:m1") is False
+        return await queue_stats()
+
+    stats = asyncio.run(run_test())
+    assert stats["pending"] == 1
+
+
+def test_worker_runs_job_once(job_db):
+    """Claimed jobs run their handler and are marked done."""
+    calls = []
+
+    @register_handler("test_ok")
+    async def handle(payload):
+        calls.append(payload["value"])
+
+    async def run_test():
+        await enqueue("test_ok", {"value": 42}, idempotency_key="ok-1")
+        worker = JobWorker(concurrency=2)
+        assert await worker.run_once() == 1
+        await worker.stop()
+        assert await worker.run_once() == 0  # nothing left to claim
+        return await queue_stats(), worker.stats()
+
+    stats, worker_stats = asyncio.run(run_test())
+    assert calls == [42]
+    assert stats["done"] == 1 and stats["pending"] == 0
+    assert worker_stats["processed"] == 1
+
+
+def test_failed_job_retries_with_backoff_then_dead_letters(job_db):
+    """Failures are rescheduled with growing delays and end in the dead-letter table."""
+    @register_handler("test_fail")
+    async def handle(payload):
+        raise RuntimeError("ollama down")
+
+    async def make_due():
+        async with job_db() as session:
+            await session.execute(update(Job).values(available_at=datetime.utcnow() - timedelta(seconds=1)))
+            await session.commit()
+
+    async def run_test():
+        await enqueue("test_fail", {}, idempotency_key="fail-1", max_attempts=2)
+        worker = JobWorker()
+
+        await worker.run_once()
+        await worker.stop()
+        async with job_db() as session:
+            job = await session.scalar(select(Job))
+            assert job.status == PENDING and job.attempts == 1
+            assert job.available_at > datetime.utcnow()
+            assert "ollama down" in job.last_error
+
+        await make_due()
+        await worker.run_once()
+        await worker.stop()
+        async with job_db() as session:
+            job = await session.scalar(select(Job))
+            dead = list((await session.execute(select(DeadLetter))).scalars().all())
+        return job, dead, worker.stats()
+
+    job, dead, worker_stats = asyncio.run(run_test())
+    assert job.status == DEAD and job.attempts == 2
+    assert len(dead) == 1 and dead[0].idempotency_key == "fail-1"
+    assert worker_stats["retried"] == 1 and worker_stats["dead_lettered"] == 1
+
+
+def test_backoff_grows_exponentially():
+    """Each attempt doubles the delay, capped at JOB_BACKOFF_MAX."""
+    with patch('agent.jobs.JOB_BACKOFF_BASE', 2.0), patch('agent.jobs.JOB_BACKOFF_MAX', 10.0):
+        assert [jobs.backoff_delay(n) for n in (1, 2, 3, 4)] == [2.0, 4.0, 8.0, 10.0]
+
+
+def test_embed_job_uses_chunk_ids():
+    """Vectors are upserted with `{message_id}#chunk_i` ids so retries overwrite them."""
+    message_id = str(uuid.uuid4())
+    text = "Pixel 10 " * 300
+    with patch('agent.tasks.upsert_batcher.submit', new_callable=AsyncMock) as mock_upsert:
+        asyncio.run(embed_and_store_message(message_id, "conv-1", "user-1", text))
+
+    kwargs = mock_upsert.await_args.kwargs
+    chunks = chunk_message(text)
+    assert len(chunks) > 1
+    assert kwargs["ids"] == [f"{message_id}#chunk_{i}" for i in range(len(chunks))]
+    assert all(m["message_id"] == message_id for m in kwargs["metadatas"])
+
+
+def test_running_worker_requeues_stale_jobs(job_db):
+    """A job left running by a crashed worker is picked up by a worker that is already polling."""
+    calls = []
+
+    @register_handler("test_stale")
+    async def handle(payload):
+        calls.append(payload["value"])
+
+    async def run_test():
+        worker = JobWorker(poll_interval=0.02, lock_timeout=0.2)
+        runner = asyncio.create_task(worker.run())
+        await asyncio.sleep(0.05)
+        # Claimed by another worker that then died, after this worker's startup check
+        async with job_db() as session:
+            session.add(Job(
+                kind="test_stale", idempotency_key="stale-1", payload='{"value": 7}',
+                status="running", locked_by="dead-worker", locked_at=datetime.utcnow(),
+            ))
+            await session.commit()
+        for _ in range(100):
+            if calls:
+                break
+            await asyncio.sleep(0.02)
+        await worker.stop()
+        await runner
+        return await queue_stats()
+
+    stats = asyncio.run(run_test())
+    assert calls == [7]
+    assert stats["done"] == 1 and stats["running"] == 0
+
+
+def test_enqueue_in_session_wakes_workers_after_commit(job_db):
+    """Local workers are woken when the caller's transaction commits, not when the job is added."""
+    async def run_test():
+        worker = JobWorker()
+        worker._wakeup = asyncio.Event()
+        jobs._local_workers.add(worker)
+        try:
+            async with job_db() as session:
+                await enqueue("noop", {}, idempotency_key="in-session-1", session=session)
+                await enqueue("noop", {}, idempotency_key="in-session-2", session=session)
+                woken_before_commit = worker._wakeup.is_set()
+                await session.commit()
+            return woken_before_commit, worker._wakeup.is_set()
+        finally:
+            jobs._local_workers.discard(worker)
+
+    woken_before_commit, woken_after_commit = asyncio.run(run_test())
+    assert not woken_before_commit
+    assert woken_after_commit
+
+
+def test_message_and_its_jobs_commit_together(job_db):
+    """add_message(session=) and enqueue(session=) share one transaction: all or nothing."""
+    from agent.database import create_conversation, add_message, get_recent_messages
+    from agent.tasks import enqueue_embedding, enqueue_assistant_reply
+
+    async def write(conversation_id, fail):
+        async with job_db() as session:
+            async with session.begin():
+                msg = await add_message(conversation_id, "user", "Pixel 10 dùng chip gì?", session=session)
+                await enqueue_embedding(str(msg.id), str(conversation_id), "user-1", msg.text, session=session)
+                if fail:
+                    raise RuntimeError("worker killed")
+                await enqueue_assistant_reply(str(msg.id), str(conversation_id), "user-1", msg.text, session=session)
+
+    async def run_test():
+        conversation = await create_conversation("user-1")
+        with pytest.raises(RuntimeError):
+            await write(conversation.id, fail=True)
+        after_failure = (len(await get_recent_messages(conversation.id, 10)), (await queue_stats())["pending"])
+        await write(conversation.id, fail=False)
+        return after_failure, len(await get_recent_messages(conversation.id, 10)), (await queue_stats())["pending"]
+
+    with patch('agent.database.async_session', job_db):
+        after_failure, messages, jobs_pending = asyncio.run(run_test())
+    assert after_failure == (0, 0)
+    assert (messages, jobs_pending) == (1, 2)
+
+
+def test_stale_jobs_count_attempts_and_dead_letter(job_db):
+    """A job that keeps dying with its worker is re-queued with its attempt counted, then dead-lettered."""
+    from agent.jobs import requeue_stale_jobs
+
+    async def mark_stale():
+        async with job_db() as session:
+            await session.execute(
+                update(Job).values(status="running", locked_by="dead-worker", locked_at=datetime.utcnow() - timedelta(hours=1))
+            )
+            await session.commit()
+
+    async def run_test():
+        await enqueue("crashes_worker", {}, idempotency_key="crash-1", max_attempts=2)
+        await mark_stale()
+        assert await requeue_stale_jobs(lock_timeout=60) == 1
+        async with job_db() as session:
+            job = await session.scalar(select(Job))
+            assert (job.status, job.attempts) == (PENDING, 1)
+        await mark_stale()
+        assert await requeue_stale_jobs(lock_timeout=60) == 1
+        async with job_db() as session:
+            job = await session.scalar(select(Job))
+            dead = (await session.scalars(select(DeadLetter))).all()
+        return job, dead
+
+    job, dead = asyncio.run(run_test())
+    assert (job.status, job.attempts) == (DEAD, 2)
+    assert [(d.idempotency_key, d.attempts) for d in dead] == [("crash-1", 2)]
+
+
+def test_kind_with_dedicated_concurrency_runs_beside_general_slots(job_db):
+    """Jobs of a kind registered with its own concurrency run together even when the worker has one slot."""
+    release = asyncio.Event()
+    running = []
+
+    @register_handler("test_batched", concurrency=4)
+    async def handle_batched(payload):
+        running.append(payload["n"])
+        await release.wait()
+
+    @register_handler("test_plain")
+    async def handle_plain(payload):
+        running.append("plain")
+        await release.wait()
+
+    async def run_test():
+        for n in range(5):
+            await enqueue("test_batched", {"n": n})
+        await enqueue("test_plain", {})
+        worker = JobWorker(concurrency=1, kinds=["test_batched", "test_plain"])
+        started = await worker.run_once()
+        await asyncio.sleep(0.01)
+        in_flight = worker.stats()["in_flight"]
+        release.set()
+        await worker.stop()
+        return started, in_flight
+
+    try:
+        started, in_flight = asyncio.run(run_test())
+    finally:
+        jobs.HANDLER_CONCURRENCY.pop("test_batched", None)
+    assert started == in_flight == 5
+    assert sorted(r for r in running if r != "plain") == [0, 1, 2, 3] and "plain" in running
@@ -0,0 +1,38 @@
+"""
+Unit tests for the Ollama continuation context cache.
+"""
+
+from array import array
+from agent.kv_context import ContextCache
+
+
+def history(n):
+    return [{"id": f"u{n}", "role": "user", "content": f"Câu hỏi {n}"}]
+
+
+def test_contexts_are_stored_compactly_and_returned_as_lists():
+    """Contexts are kept as int32 arrays; callers still get a JSON-serializable list."""
+    cache = ContextCache(max_total_tokens=100)
+    cache.store("c1", "gpt-oss", history(1), "Chào bạn!", [1, 2, 3])
+    assert isinstance(cache._entries["c1"].tokens, array)
+
+    turn2 = history(1) + [{"id": "a1", "role": "assistant", "content": "Chào bạn!"}] + history(2)
+    assert cache.get_continuation("c1", "gpt-oss", turn2) == [1, 2, 3]
+
+
+def test_cache_is_bounded_by_total_tokens():
+    """Least recently used contexts are evicted once the token total exceeds the cap."""
+    cache = ContextCache(max_total_tokens=10)
+    cache.store("c1", "gpt-oss", history(1), "a", [1] * 4)
+    cache.store("c2", "gpt-oss", history(2), "b", [2] * 4)
+    cache.store("c1", "gpt-oss", history(3), "c", [3] * 5)  # replaces c1's context and makes it most recent
+    assert cache.total_tokens == 9
+    cache.store("c3", "gpt-oss", history(4), "d", [4] * 4)
+
+    assert list(cache._entries) == ["c1", "c3"]
+    assert cache.total_tokens == 9
+    assert cache.stats()["evictions"] == 1
+
+    cache.store("c4", "gpt-oss", history(5), "e", [5] * 11)  # larger than the whole cache
+    assert "c4" not in cache._entries
+    assert cache.stats()["too_long"] == 1
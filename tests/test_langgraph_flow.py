@@ -0,0 +1,175 @@
+"""
+Unit tests for the LangGraph flow module.
+"""
+
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock
+from agent.langgraph_flow import get_flow, init_flows
+
+
+def make_state(content):
+    return {
+        "conversation_id": "conv-1",
+        "user_id": "user-1",
+        "chat_history": [{"role": "user", "content": content}],
+        "metadata": {"conversation_id": "conv-1", "user_id": "user-1"},
+        "retrieved_context": None,
+        "response": None,
+        "stream": False,
+    }
+
+
+def test_flows_are_compiled_once():
+    """The registry hands out the same compiled graph on every call."""
+    init_flows()
+    assert get_flow("chat") is get_flow("chat")
+    assert get_flow("chat_stream") is get_flow("chat_stream")
+
+
+def test_chat_flow_skips_retrieval_when_not_needed():
+    """Short small-talk goes straight to respond without querying Chroma."""
+    with patch('agent.langgraph_flow.agenerate_text', new_callable=AsyncMock) as mock_generate, \
+         patch('agent.langgraph_flow.aquery_vectors', new_callable=AsyncMock) as mock_query:
+        mock_generate.return_value = "Chào bạn!"
+        final_state = asyncio.run(get_flow("chat").ainvoke(make_state("hi")))
+
+    assert final_state["response"] == "Chào bạn!"
+    mock_query.assert_not_awaited()
+
+
+def test_streaming_flow_emits_chunks_on_custom_stream():
+    """The compiled streaming flow forwards LLM chunks and keeps retrieved context."""
+    async def fake_stream(prompt, model="gpt-oss", **kwargs):
+        assert "Tensor G5" in prompt
+        for chunk in ("Pixel 10 ", "dùng ", "Tensor G5."):
+            yield chunk
+
+    async def run_test():
+        chunks, final = [], None
+        async for mode, chunk in get_flow("chat_stream").astream(
+            make_state("Pixel 10 dùng chip gì vậy?"), stream_mode=["custom", "values"]
+        ):
+            if mode == "custom":
+                chunks.append(chunk["response"])
+            else:
+                final = chunk
+        return chunks, final
+
+    with patch('agent.langgraph_flow.generate_text_stream', fake_stream), \
+         patch('agent.langgraph_flow.aquery_vectors', new_callable=AsyncMock) as mock_query:
+        mock_query.return_value = [{'id': 'k1', 'document': 'Tensor G5', 'metadata': {}, 'distance': 0.1}]
+        chunks, final = asyncio.run(run_test())
+
+    assert "".join(chunks) == "Pixel 10 dùng Tensor G5."
+    assert final["response"] == "Pixel 10 dùng Tensor G5."
+    assert final["retrieved_context"][0]['id'] == 'k1'
+
+
+def test_speculative_flow_uses_retrieval_when_needed():
+    """Speculative retrieval started before the flow is reused by the classify node."""
+    from agent.langgraph_flow import create_flow, start_speculative_retrieval, speculation_stats
+
+    async def run_test():
+        task = start_speculative_retrieval("Pixel 10 dùng chip gì vậy?", {"conversation_id": "conv-1"})
+        flow = create_flow(speculative=True)
+        return await flow.ainvoke(
+            make_state("Pixel 10 dùng chip gì vậy?"), config={"configurable": {"speculative_retrieval": task}}
+        )
+
+    used_before = speculation_stats["used"]
+    with patch('agent.langgraph_flow.agenerate_text', new_callable=AsyncMock) as mock_generate, \
+         patch('agent.langgraph_flow.aquery_vectors', new_callable=AsyncMock) as mock_query:
+        mock_generate.return_value = "Tensor G5"
+        mock_query.return_value = [{'id': 'k1', 'document': 'Tensor G5', 'metadata': {}, 'distance': 0.1}]
+        final_state = asyncio.run(run_test())
+
+    # One query per scope: knowledge + this conversation's memory
+    assert [c.kwargs['collection_name'] for c in mock_query.await_args_list] == ['knowledge', 'conversations_dev']
+    assert final_state["retrieved_context"][0]['id'] == 'k1'
+    assert speculation_stats["used"] == used_before + 1
+
+
+def test_speculative_flow_discards_unneeded_retrieval():
+    """When the classifier says no retrieval, the speculative result is dropped and counted as wasted."""
+    from agent.langgraph_flow import create_flow, speculation_stats
+
+    wasted_before = speculation_stats["wasted"]
+    with patch('agent.langgraph_flow.agenerate_text', new_callable=AsyncMock) as mock_generate, \
+         patch('agent.langgraph_flow.aquery_vectors', new_callable=AsyncMock) as mock_query:
+        mock_generate.return_value = "Chào bạn!"
+        mock_query.return_value = [{'id': 'k1', 'document': 'Tensor G5', 'metadata': {}, 'distance': 0.1}]
+        final_state = asyncio.run(create_flow(speculative=True).ainvoke(make_state("hi")))
+
+    assert not final_state.get("retrieved_context")
+    assert speculation_stats["wasted"] == wasted_before + 1
+
+
+def test_respond_reuses_ollama_context_on_next_turn():
+    """The second turn sends the cached context and only the new user message."""
+    from agent.langgraph_flow import respond_node
+    from agent.kv_context import context_cache
+
+    context_cache.clear()
+    turn1 = make_state("hi")
+    turn1["chat_history"] = [{"id": "m1", "role": "user", "content": "hi"}]
+
+    async def generate(prompt, model=None, context=None, on_context=None, **kwargs):
+        on_context([1, 2, 3] if context is None else context + [4, 5])
+        return "Chào bạn!"
+
+    with patch('agent.langgraph_flow.agenerate_text', side_effect=generate) as mock_generate:
+        asyncio.run(respond_node(turn1))
+        turn2 = make_state("Pixel 10 giá bao nhiêu?")
+        turn2["chat_history"] = turn1["chat_history"] + [
+            {"id": "m2", "role": "assistant", "content": "Chào bạn!"},
+            {"id": "m3", "role": "user", "content": "Pixel 10 giá bao nhiêu?"},
+        ]
+        asyncio.run(respond_node(turn2))
+
+    second_call = mock_generate.call_args_list[1]
+    assert second_call.kwargs["context"] == [1, 2, 3]
+    assert second_call.args[0] == "user: Pixel 10 giá bao nhiêu?\nAssistant:"
+
+    # A different reply in history (e.g. edited) makes the cache stale -> full prompt
+    turn3 = make_state("x")
+    turn3["chat_history"] = turn2["chat_history"][:1] + [
+        {"id": "m2", "role": "assistant", "content": "edited"},
+        {"id": "m3", "role": "user", "content": "Pixel 10 giá bao nhiêu?"},
+    ]
+    assert context_cache.get_continuation("conv-1", "gpt-oss", turn3["chat_history"]) is None
+
+
+def test_retrieve_context_queries_knowledge_and_memory_scopes():
+    """Knowledge is queried unfiltered per tenant, memory with the conversation filter; a failing scope is dropped."""
+    from agent.langgraph_flow import retrieve_context
+
+    async def fake_query(query_text, collection_name, top_k, filter_metadata, include_embeddings):
+        if collection_name == 'conversations_dev':
+            raise RuntimeError("chroma down")
+        return [{'id': 'k1', 'document': 'Tensor G5', 'metadata': {}, 'distance': 0.1}]
+
+    with patch('agent.retriever.KNOWLEDGE_COLLECTION_NAME', 'knowledge_{tenant}'), \
+         patch('agent.langgraph_flow.LEXICAL_ENABLED', False), \
+         patch('agent.langgraph_flow.aquery_vectors', side_effect=fake_query) as mock_query:
+        results = asyncio.run(retrieve_context(
+            "Pixel 10 dùng chip gì?", {"conversation_id": "conv-1", "user_id": "user-1", "tenant_id": "t1"}
+        ))
+
+    assert [r['id'] for r in results] == ['k1']
+    calls = {c.kwargs['collection_name']: c.kwargs['filter_metadata'] for c in mock_query.call_args_list}
+    assert calls == {
+        'knowledge_t1': None,
+        'conversations_dev': {'conversation_id': 'conv-1', 'user_id': 'user-1'},
+    }
+
+
+def test_job_path_propagates_generation_errors():
+    """With raise_errors set (assistant_reply jobs), an LLM failure is raised instead of answered with an apology."""
+    from agent.langgraph_flow import respond_node
+
+    with patch('agent.langgraph_flow.agenerate_text', new_callable=AsyncMock) as mock_generate:
+        mock_generate.side_effect = ConnectionError("Ollama unavailable")
+        assert asyncio.run(respond_node(make_state("hi")))["response"] == "Sorry, I encountered an error."
+        with pytest.raises(ConnectionError):
+            asyncio.run(get_flow("chat").ainvoke({**make_state("hi"), "raise_errors": True}))
@@ -0,0 +1,148 @@
+"""
+Unit tests for the BM25 lexical index and hybrid retrieval.
+"""
+
+import json
+import asyncio
+import sqlite3
+from unittest.mock import patch, AsyncMock
+from agent.lexical import LexicalIndex, fold_text, tokenize
+from agent.retriever import simple_rerank
+
+
+def make_index(collection="knowledge"):
+    index = LexicalIndex(":memory:")
+    index.upsert(
+        collection,
+        ["pixel10#chunk_0", "pixel7#chunk_0", "battery#chunk_0"],
+        [
+            "Pixel 10 dùng chip Tensor G5 do TSMC sản xuất.",
+            "Pixel 7 Pro dùng chip Tensor G2, màn hình 6.7 inch.",
+            "Điện thoại có pin 4700 mAh và sạc nhanh 30W.",
+        ],
+        [{"source": "pixel10.md"}, {"source": "pixel7.md"}, {"source": "battery.md"}],
+    )
+    return index
+
+
+def test_vietnamese_folding():
+    """Diacritics and đ are folded so unaccented queries match."""
+    assert fold_text("Điện thoại") == "dien thoai"
+    assert tokenize("Sạc nhanh 30W!") == ["sac", "nhanh", "30w"]
+
+
+def test_bm25_ranks_exact_identifiers_first():
+    """Rare identifier terms dominate the BM25 score."""
+    index = make_index()
+    results = index.search("knowledge", "chip tensor g5", top_k=3)
+    assert results[0]["id"] == "pixel10#chunk_0"
+    assert index.search("knowledge", "dien thoai pin")[0]["id"] == "battery#chunk_0"
+
+
+def test_upsert_replaces_and_filters_apply():
+    """Re-upserting an id replaces its postings; metadata filters restrict results."""
+    index = make_index()
+    index.upsert("knowledge", ["pixel10#chunk_0"], ["Pixel 10 Pro Fold"], [{"source": "fold.md"}])
+    assert index.search("knowledge", "g5") == []
+    assert index.search("knowledge", "pixel", filter_metadata={"source": "pixel7.md"})[0]["id"] == "pixel7#chunk_0"
+
+
+def test_filtered_search_reads_only_that_conversation():
+    """conversation_id filters are applied in SQL: other conversations' postings are never scored."""
+    index = LexicalIndex(":memory:")
+    index.upsert(
+        "memory",
+        [f"b#{i}" for i in range(200)],
+        ["user: pin pixel 10 bao nhiêu mAh"] * 200,
+        [{"conversation_id": "conv-b", "user_id": "u2"}] * 200,
+    )
+    index.upsert(
+        "memory",
+        ["a#0", "a#1"],
+        ["user: pin pixel 10 bao nhiêu mAh", "assistant: pin 4700 mAh"],
+        [{"conversation_id": "conv-a", "user_id": "u1"}] * 2,
+    )
+    results = asyncio.run(asyncio.to_thread(
+        index.search, "memory", "pin pixel", 10, {"conversation_id": "conv-a", "user_id": "u1"}
+    ))
+    assert [r["id"] for r in results] == ["a#0", "a#1"]
+    # pin: a#0, a#1; pixel: a#0 -- none of conv-b's 400 postings
+    assert index.stats()["postings_scored"] == 3
+
+
+def test_common_terms_are_not_scored():
+    """Stopwords and terms found in most chunks of a large scope are skipped."""
+    index = LexicalIndex(":memory:")
+    ids = [f"doc#{i}" for i in range(150)]
+    documents = [f"điện thoại mẫu {i}" for i in range(150)]
+    documents[42] = "điện thoại dùng chip Tensor G5"
+    index.upsert("knowledge", ids, documents)
+    results = index.search("knowledge", "điện thoại nào có G5")
+    assert [r["id"] for r in results] == ["doc#42"]
+    assert index.stats()["terms_dropped"] == 2
+    assert index.stats()["postings_scored"] == 1
+
+
+def test_index_files_without_scope_columns_are_migrated(tmp_path):
+    """Index files written before the scope columns existed are backfilled on open."""
+    path = str(tmp_path / "lexical.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE lexical_docs (collection TEXT NOT NULL, doc_id TEXT NOT NULL, length INTEGER NOT NULL,
+            document TEXT NOT NULL, metadata TEXT, PRIMARY KEY (collection, doc_id)) WITHOUT ROWID;
+        CREATE TABLE lexical_postings (collection TEXT NOT NULL, term TEXT NOT NULL, doc_id TEXT NOT NULL,
+            tf INTEGER NOT NULL, PRIMARY KEY (collection, term, doc_id)) WITHOUT ROWID;
+    """)
+    for doc_id, conversation_id in (("a#0", "conv-a"), ("b#0", "conv-b")):
+        conn.execute(
+            "INSERT INTO lexical_docs VALUES ('memory', ?, 2, 'pin 4700', ?)",
+            (doc_id, json.dumps({"conversation_id": conversation_id})),
+        )
+        conn.executemany(
+            "INSERT INTO lexical_postings VALUES ('memory', ?, ?, 1)", [("pin", doc_id), ("4700", doc_id)]
+        )
+    conn.commit()
+    conn.close()
+
+    results = LexicalIndex(path).search("memory", "pin 4700", filter_metadata={"conversation_id": "conv-b"})
+    assert [r["id"] for r in results] == ["b#0"]
+    assert results[0]["bm25"] > 0
+
+
+def test_exact_match_shortcut():
+    """Short identifier queries fully covered by the top chunk are exact matches."""
+    index = make_index()
+    assert index.is_exact_match("Tensor G5", index.search("knowledge", "Tensor G5"))
+    assert not index.is_exact_match("chip nào mạnh nhất hiện nay", index.search("knowledge", "chip nào mạnh nhất hiện nay"))
+
+
+def test_rrf_fusion_promotes_results_found_by_both():
+    """A chunk ranked by both retrievers beats chunks found by only one."""
+    vector = [
+        {"id": "a", "document": "A", "metadata": {}, "distance": 0.1},
+        {"id": "b", "document": "B", "metadata": {}, "distance": 0.2},
+    ]
+    lexical = [
+        {"id": "b", "document": "B", "metadata": {}, "bm25": 5.0, "matched_terms": 2},
+        {"id": "c", "document": "C", "metadata": {}, "bm25": 3.0, "matched_terms": 1},
+    ]
+    fused = simple_rerank(vector, lexical_results=lexical)
+    assert [r["id"] for r in fused] == ["b", "a", "c"]
+    assert all("score" in r for r in fused)
+
+
+def test_retrieve_context_skips_embedding_on_exact_match():
+    """Identifier queries answered by the lexical index do not call the vector search."""
+    from agent.langgraph_flow import retrieve_context
+
+    index = make_index("knowledge")
+    with patch('agent.langgraph_flow.lexical_index', index), \
+         patch('agent.retriever.lexical_index', index), \
+         patch('agent.langgraph_flow.aquery_vectors', new_callable=AsyncMock) as mock_query:
+        results = asyncio.run(retrieve_context("Tensor G5", {}))
+        assert results[0]["id"] == "pixel10#chunk_0"
+        mock_query.assert_not_awaited()
+
+        mock_query.return_value = []
+        asyncio.run(retrieve_context("máy nào có pin trâu", {}))
+        mock_query.assert_awaited_once()
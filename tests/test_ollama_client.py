@@ -18,7 +18,7 @@ MOCK_EMBEDDING_RESPONSE = {
 
 def test_generate_text_success():
     """Test successful text generation with mocked API response."""
-    with patch('agent.ollama_client.requests.post') as mock_post:
+    with patch('agent.ollama_client.requests.Session.post') as mock_post:
         mock_response = MagicMock()
         mock_response.json.return_value = MOCK_GENERATE_RESPONSE
         mock_response.raise_for_status.return_value = None
@@ -30,7 +30,7 @@ def test_generate_text_success():
         
 def test_generate_text_http_error():
     """Test handling of HTTP errors from the API."""
-    with patch('agent.ollama_client.requests.post') as mock_post:
+    with patch('agent.ollama_client.requests.Session.post') as mock_post:
         mock_post.side_effect = Exception("HTTP Error")
         
         with pytest.raises(Exception):
@@ -38,7 +38,7 @@ def test_generate_text_http_error():
             
 def test_get_embedding_success():
     """Test successful embedding generation with mocked API response."""
-    with patch('agent.ollama_client.requests.post') as mock_post:
+    with patch('agent.ollama_client.requests.Session.post') as mock_post:
         mock_response = MagicMock()
         mock_response.json.return_value = MOCK_EMBEDDING_RESPONSE
         mock_response.raise_for_status.return_value = None
@@ -51,11 +51,99 @@ def test_get_embedding_success():
         
 def test_get_embedding_invalid_response():
     """Test handling of invalid API response."""
-    with patch('agent.ollama_client.requests.post') as mock_post:
+    with patch('agent.ollama_client.requests.Session.post') as mock_post:
         mock_response = MagicMock()
         mock_response.json.return_value = {"invalid": "response"}
         mock_response.raise_for_status.return_value = None
         mock_post.return_value = mock_response
         
         with pytest.raises(ValueError):
-            get_embedding("Test text")
\ No newline at end of file
+            get_embedding("Test text")
+
+def test_http_client_pool_lifecycle():
+    """The async pool is opened once, shared by callers, and released on close."""
+    import asyncio
+    from agent import ollama_client
+
+    async def run_test():
+        client = await ollama_client.init_http_client()
+        assert ollama_client.get_http_client() is client
+        assert await ollama_client.init_http_client() is client
+        await ollama_client.close_http_client()
+        assert client.is_closed
+        assert ollama_client._async_client is None
+
+    asyncio.run(run_test())
+
+
+def test_agenerate_text_uses_shared_pool():
+    """Async generation goes through the shared client instead of a new connection."""
+    import asyncio
+    import httpx
+    from agent.ollama_client import agenerate_text
+
+    def handler(request):
+        return httpx.Response(200, json=MOCK_GENERATE_RESPONSE)
+
+    async def run_test():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch('agent.ollama_client.get_http_client', return_value=client) as mock_get_client:
+            result = await agenerate_text("Test prompt")
+        await client.aclose()
+        assert result == MOCK_GENERATE_RESPONSE["response"]
+        mock_get_client.assert_called_once()
+
+    asyncio.run(run_test())
+
+
+def test_aget_embeddings_batch_request():
+    """All texts go to /api/embed in a single request with an input array."""
+    import asyncio
+    import json
+    import httpx
+    from agent import ollama_client
+
+    calls = []
+
+    def handler(request):
+        body = json.loads(request.content)
+        calls.append((request.url.path, body))
+        return httpx.Response(200, json={"embeddings": [[float(i)] * 3 for i in range(len(body["input"]))]})
+
+    async def run_test():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch('agent.ollama_client.get_http_client', return_value=client), \
+             patch('agent.ollama_client._batch_embed_supported', True):
+            result = await ollama_client.aget_embeddings(["a", "b", "c"])
+        await client.aclose()
+        assert result == [[0.0] * 3, [1.0] * 3, [2.0] * 3]
+        assert len(calls) == 1
+        assert calls[0][0] == "/api/embed"
+        assert calls[0][1]["input"] == ["a", "b", "c"]
+
+    asyncio.run(run_test())
+
+
+def test_aget_embeddings_falls_back_on_old_server():
+    """A 404 on /api/embed falls back to per-text /api/embeddings calls."""
+    import asyncio
+    import json
+    import httpx
+    from agent import ollama_client
+
+    def handler(request):
+        if request.url.path == "/api/embed":
+            return httpx.Response(404, json={"error": "not found"})
+        body = json.loads(request.content)
+        return httpx.Response(200, json={"embedding": [float(len(body["prompt"]))]})
+
+    async def run_test():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch('agent.ollama_client.get_http_client', return_value=client), \
+             patch('agent.ollama_client._batch_embed_supported', True):
+            result = await ollama_client.aget_embeddings(["a", "bbb"])
+            assert ollama_client._batch_embed_supported is False
+        await client.aclose()
+        assert result == [[1.0], [3.0]]
+
+    asyncio.run(run_test())
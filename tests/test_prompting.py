@@ -0,0 +1,95 @@
+"""
+Unit tests for token-budgeted prompt assembly.
+"""
+
+from unittest.mock import patch
+from agent.prompting import assemble_prompt, clear_prompt_cache, serialize_history
+from agent.tokens import estimate_tokens, message_tokens
+
+
+def make_history(turns):
+    history = []
+    for i in range(turns):
+        history.append({"id": f"u{i}", "role": "user", "content": f"Câu hỏi số {i} về điện thoại Pixel"})
+        history.append({"id": f"a{i}", "role": "assistant", "content": f"Trả lời số {i}: Pixel là điện thoại của Google"})
+    return history
+
+
+def test_estimate_tokens_is_monotonic():
+    """Longer text never has fewer estimated tokens."""
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("Pixel 10") <= estimate_tokens("Pixel 10 dùng chip Tensor G5")
+
+
+def test_small_history_is_kept_in_full():
+    """Within budget, the prompt contains every turn and all context."""
+    history = make_history(2) + [{"role": "user", "content": "Pixel 10 dùng chip gì?"}]
+    context = [{"document": "Pixel 10 dùng Tensor G5", "distance": 0.1}]
+    prompt = assemble_prompt(history, context, token_budget=4096)
+    assert prompt.startswith("Retrieved context:\nPixel 10 dùng Tensor G5")
+    assert "user: Câu hỏi số 0" in prompt
+    assert prompt.endswith("user: Pixel 10 dùng chip gì?\nAssistant:")
+
+
+def test_long_history_is_trimmed_to_recent_turns():
+    """Old turns are dropped first; the latest user message always survives."""
+    history = make_history(200) + [{"role": "user", "content": "Pixel 10 dùng chip gì?"}]
+    prompt = assemble_prompt(history, [], token_budget=500)
+    assert estimate_tokens(prompt) <= 500
+    assert "Câu hỏi số 0 " not in prompt
+    assert "Trả lời số 199" in prompt
+    assert "user: Pixel 10 dùng chip gì?" in prompt
+
+
+def test_context_filled_by_score_within_budget():
+    """The best-scored chunk is included; chunks that do not fit are skipped."""
+    history = [{"role": "user", "content": "Tensor G5?"}]
+    context = [
+        {"document": "rất dài " * 400, "score": 0.9},
+        {"document": "Tensor G5 là chip của Pixel 10", "score": 0.5},
+        {"document": "Pixel 7 Pro dùng Tensor G2", "score": 0.1},
+    ]
+    prompt = assemble_prompt(history, context, token_budget=120)
+    assert "Tensor G5 là chip của Pixel 10" in prompt
+    assert "rất dài" not in prompt
+    assert prompt.index("Tensor G5 là chip") < prompt.index("Pixel 7 Pro")
+
+
+def test_history_serialization_is_incremental():
+    """A new turn only estimates the newly appended messages."""
+    clear_prompt_cache()
+    history = make_history(10)
+    assemble_prompt(history, [], conversation_id="conv-inc")
+    with patch('agent.prompting.message_tokens', wraps=message_tokens) as spy:
+        assemble_prompt(history + [{"id": "u-new", "role": "user", "content": "Còn Pixel 9?"}], [], conversation_id="conv-inc")
+    assert spy.call_count == 1
+
+
+
+def test_cached_history_matches_uncached_as_window_slides():
+    """Appending to the cached serialization yields the same prompt as serializing from scratch."""
+    clear_prompt_cache()
+    history = make_history(40)
+    for turn in range(6):
+        history.append({"id": f"q{turn}", "role": "user", "content": "Còn Pixel 9?"})
+        window = history[-60:]
+        cached = assemble_prompt(window, [], conversation_id="conv-slide", token_budget=600)
+        assert cached == assemble_prompt(window, [], token_budget=600)
+        assert serialize_history(window, "conv-slide") == serialize_history(window)
+        history.append({"id": f"r{turn}", "role": "assistant", "content": "Pixel 9 dùng Tensor G4"})
+
+def test_stored_token_counts_are_not_recomputed():
+    """A message's stored count is used for its line instead of tokenizing the text."""
+    with patch('agent.tokens.estimate_tokens', wraps=estimate_tokens) as spy:
+        [(line, tokens)] = serialize_history([{"role": "user", "content": "Pixel 10 dùng chip gì?", "tokens": 7}])
+    assert line == "user: Pixel 10 dùng chip gì?"
+    assert tokens == 7 + estimate_tokens("user:")
+    assert "Pixel 10 dùng chip gì?" not in [c.args[0] for c in spy.call_args_list]
+
+
+def test_summary_precedes_recent_turns():
+    """The rolling summary is placed before the conversation and counted in the budget."""
+    history = make_history(1) + [{"role": "user", "content": "Còn màu nào?"}]
+    prompt = assemble_prompt(history, [], token_budget=4096, summary="Khách muốn mua Pixel 10 màu xanh.")
+    assert "Summary of earlier conversation: Khách muốn mua Pixel 10 màu xanh.\nConversation:" in prompt
+    assert prompt.endswith("user: Còn màu nào?\nAssistant:")
@@ -0,0 +1,125 @@
+"""
+Unit tests for the semantic response cache.
+"""
+
+import asyncio
+from unittest.mock import patch, AsyncMock
+from agent.response_cache import SemanticResponseCache, context_fingerprint
+from agent.langgraph_flow import get_flow
+
+KNOWLEDGE = [{'id': 'k1', 'document': 'Pixel 10 dùng chip Tensor G5', 'metadata': {'source': 'pixel.md'}, 'distance': 0.1}]
+
+
+def test_hit_above_threshold_and_miss_below():
+    """Near-identical questions hit; unrelated ones do not."""
+    cache = SemanticResponseCache(threshold=0.95)
+    fingerprint = context_fingerprint(KNOWLEDGE)
+    cache.store("t1", "Pixel 10 dùng chip gì?", [1.0, 0.0, 0.0], fingerprint, "Tensor G5.")
+
+    hit = cache.lookup("t1", [0.99, 0.05, 0.0], fingerprint)
+    assert hit is not None and hit.answer == "Tensor G5."
+    assert cache.lookup("t1", [0.0, 1.0, 0.0], fingerprint) is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_fingerprint_and_tenant_isolation():
+    """Answers built from other sources or for other tenants are never reused."""
+    cache = SemanticResponseCache(threshold=0.9)
+    fingerprint = context_fingerprint(KNOWLEDGE)
+    cache.store("t1", "question", [1.0, 0.0], fingerprint, "answer")
+
+    other_sources = context_fingerprint([{'id': 'k2', 'metadata': {}}])
+    assert cache.lookup("t1", [1.0, 0.0], other_sources) is None
+    assert cache.lookup("t2", [1.0, 0.0], fingerprint) is None
+
+
+def test_entries_expire_after_ttl():
+    """Expired entries are purged on lookup."""
+    cache = SemanticResponseCache(threshold=0.9, ttl=10)
+    fingerprint = context_fingerprint(KNOWLEDGE)
+    with patch('agent.response_cache.time.time', return_value=1000.0):
+        cache.store("t1", "question", [1.0, 0.0], fingerprint, "answer")
+    with patch('agent.response_cache.time.time', return_value=1011.0):
+        assert cache.lookup("t1", [1.0, 0.0], fingerprint) is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_personal_context_is_not_cacheable():
+    """Chunks from conversation memory make the answer personal."""
+    personal = [{'id': 'm1', 'document': 'tên tôi là An', 'metadata': {'conversation_id': 'conv-1'}}]
+    assert context_fingerprint(personal) is None
+
+    cache = SemanticResponseCache()
+    cache.store("t1", "question", [1.0, 0.0], None, "answer")
+    assert cache.stats()["stores"] == 0
+
+
+def test_flow_answers_from_cache_without_llm():
+    """A repeated question ends the flow at the cache node and skips generation."""
+    cache = SemanticResponseCache(threshold=0.95)
+    state = {
+        "conversation_id": "conv-1",
+        "user_id": "user-1",
+        "chat_history": [{"role": "user", "content": "Pixel 10 dùng chip gì vậy?"}],
+        "metadata": {"conversation_id": "conv-1", "user_id": "user-1", "tenant_id": "t1"},
+        "retrieved_context": None,
+        "response": None,
+        "stream": False,
+    }
+
+    with patch('agent.langgraph_flow.RESPONSE_CACHE_ENABLED', True), \
+         patch('agent.langgraph_flow.response_cache', cache), \
+         patch('agent.langgraph_flow.aget_embeddings', new_callable=AsyncMock) as mock_embed, \
+         patch('agent.langgraph_flow.aquery_vectors', new_callable=AsyncMock) as mock_query, \
+         patch('agent.langgraph_flow.agenerate_text', new_callable=AsyncMock) as mock_generate:
+        mock_embed.return_value = [[0.2, 0.8, 0.1]]
+        mock_query.return_value = list(KNOWLEDGE)
+        mock_generate.return_value = "Pixel 10 dùng Tensor G5."
+
+        first = asyncio.run(get_flow("chat").ainvoke(dict(state)))
+        second = asyncio.run(get_flow("chat").ainvoke(dict(state)))
+
+    assert first["response"] == second["response"] == "Pixel 10 dùng Tensor G5."
+    assert second["cache_hit"] is True
+    assert mock_generate.await_count == 1
+
+
+def test_conversations_with_different_history_never_share_answers():
+    """The same question after different earlier turns (or summaries) is answered separately."""
+    cache = SemanticResponseCache(threshold=0.95)
+    question = {"role": "user", "content": "Tên tôi là gì vậy?"}
+
+    def state_for(conversation_id, history, summary=None):
+        return {
+            "conversation_id": conversation_id,
+            "user_id": conversation_id,
+            "chat_history": history + [question],
+            "summary": summary,
+            "metadata": {"conversation_id": conversation_id, "user_id": conversation_id, "tenant_id": "t1"},
+            "retrieved_context": None,
+            "response": None,
+            "stream": False,
+        }
+
+    with patch('agent.langgraph_flow.RESPONSE_CACHE_ENABLED', True), \
+         patch('agent.langgraph_flow.response_cache', cache), \
+         patch('agent.langgraph_flow.aget_embeddings', new_callable=AsyncMock) as mock_embed, \
+         patch('agent.langgraph_flow.aquery_vectors', new_callable=AsyncMock) as mock_query, \
+         patch('agent.langgraph_flow.agenerate_text', new_callable=AsyncMock) as mock_generate:
+        mock_embed.return_value = [[0.2, 0.8, 0.1]]
+        mock_query.return_value = []
+        mock_generate.side_effect = ["Tên bạn là An.", "Tên bạn là Bình.", "Tên bạn là Chi."]
+
+        first = asyncio.run(get_flow("chat").ainvoke(state_for(
+            "conv-a", [{"role": "user", "content": "Tôi tên là An"}, {"role": "assistant", "content": "Chào An!"}]
+        )))
+        second = asyncio.run(get_flow("chat").ainvoke(state_for(
+            "conv-b", [{"role": "user", "content": "Tôi tên là Bình"}, {"role": "assistant", "content": "Chào Bình!"}]
+        )))
+        third = asyncio.run(get_flow("chat").ainvoke(state_for("conv-c", [], summary="Khách hàng tên là Chi.")))
+
+    assert [first["response"], second["response"], third["response"]] == [
+        "Tên bạn là An.", "Tên bạn là Bình.", "Tên bạn là Chi."
+    ]
+    assert not second.get("cache_hit") and not third.get("cache_hit")
+    assert mock_generate.await_count == 3
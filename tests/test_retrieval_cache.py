@@ -0,0 +1,130 @@
+"""
+Unit tests for the retrieval result cache.
+"""
+
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from agent.retrieval_cache import RetrievalCache, MemoryBackend
+from agent.retriever import aquery_vectors, upsert_embedded
+
+MOCK_QUERY_RESULTS = {
+    'ids': [['doc1']],
+    'documents': [['Pixel 10 dùng chip Tensor G5']],
+    'metadatas': [[{'conversation_id': 'conv-1', 'user_id': 'user-1'}]],
+    'distances': [[0.1]],
+}
+FILTER = {'conversation_id': 'conv-1', 'user_id': 'user-1'}
+
+
+def test_repeated_query_is_served_from_cache():
+    """A retry of the same query (modulo whitespace) skips the embedding and Chroma calls."""
+    with patch('agent.retriever.aget_embeddings', new_callable=AsyncMock) as mock_embed, \
+         patch('agent.retriever.get_or_create_collection') as mock_get_collection:
+        mock_embed.return_value = [[0.1, 0.2, 0.3]]
+        mock_collection = MagicMock()
+        mock_collection.query.return_value = MOCK_QUERY_RESULTS
+        mock_get_collection.return_value = mock_collection
+
+        first = asyncio.run(aquery_vectors("Pixel 10 chip gì?", filter_metadata=FILTER))
+        first[0]['document'] = 'mutated by the caller'
+        second = asyncio.run(aquery_vectors("  Pixel 10   chip gì? ", filter_metadata=FILTER))
+
+    assert second[0]['document'] == 'Pixel 10 dùng chip Tensor G5'
+    assert mock_embed.await_count == 1
+    assert mock_collection.query.call_count == 1
+
+
+def test_upsert_invalidates_only_touched_conversation():
+    """Writing to one conversation drops its cached queries but keeps other conversations'."""
+    with patch('agent.retriever.aget_embeddings', new_callable=AsyncMock) as mock_embed, \
+         patch('agent.retriever.get_or_create_collection') as mock_get_collection:
+        mock_embed.return_value = [[0.1, 0.2, 0.3]]
+        mock_collection = MagicMock()
+        mock_collection.query.return_value = MOCK_QUERY_RESULTS
+        mock_get_collection.return_value = mock_collection
+        other = {'conversation_id': 'conv-2', 'user_id': 'user-1'}
+
+        asyncio.run(aquery_vectors("Pixel 10 chip gì?", filter_metadata=FILTER))
+        asyncio.run(aquery_vectors("Pixel 10 chip gì?", filter_metadata=other))
+        upsert_embedded(
+            ["Pixel 10 có 12GB RAM"], [{'conversation_id': 'conv-1'}], ["msg-9#chunk_0"], [[0.3, 0.2, 0.1]],
+            "conversations_dev",
+        )
+        asyncio.run(aquery_vectors("Pixel 10 chip gì?", filter_metadata=FILTER))
+        asyncio.run(aquery_vectors("Pixel 10 chip gì?", filter_metadata=other))
+
+    assert mock_collection.query.call_count == 3
+
+
+def test_collection_write_invalidates_unfiltered_queries_and_ttl_expires():
+    cache = RetrievalCache(MemoryBackend(maxsize=10, ttl=60), enabled=True)
+    key = cache.make_key("knowledge", "tensor g5", None, 3)
+    cache.set(key, [{'id': 'doc1'}])
+    assert cache.get(cache.make_key("knowledge", "tensor  g5", None, 3)) == [{'id': 'doc1'}]
+
+    cache.invalidate("knowledge", [{'source': 'pixel.md'}])
+    assert cache.get(cache.make_key("knowledge", "tensor g5", None, 3)) is None
+
+    key = cache.make_key("knowledge", "tensor g5", None, 3)
+    cache.set(key, [{'id': 'doc1'}])
+    with patch('agent.cache.time.monotonic', return_value=10**9):
+        assert cache.get(key) is None
+
+
+class FakeRedis:
+    """The subset of redis.Redis used by RedisBackend, backed by a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value.encode("utf-8") if isinstance(value, str) else value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key) or 0) + 1).encode("ascii")
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute(self):
+        return []
+
+    def scan_iter(self, match):
+        return [k for k in self.data if k.startswith(match.rstrip("*"))]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def test_redis_backend_round_trips_mmr_results_with_embeddings():
+    """Results queried with embeddings (numpy from Chroma) are stored in Redis and served back."""
+    import numpy as np
+    from agent.retrieval_cache import RedisBackend
+
+    fake_client = FakeRedis()
+    fake_redis = MagicMock()
+    fake_redis.Redis.from_url.return_value = fake_client
+    with patch('agent.retrieval_cache.redis', fake_redis):
+        cache = RetrievalCache(RedisBackend(url="redis://fake"), enabled=True)
+
+    query_results = dict(MOCK_QUERY_RESULTS, embeddings=[[np.array([0.5, 0.25, 0.125], dtype=np.float32)]])
+    with patch('agent.retriever.aget_embeddings', new_callable=AsyncMock) as mock_embed, \
+         patch('agent.retriever.get_or_create_collection') as mock_get_collection, \
+         patch('agent.retriever.retrieval_cache', cache):
+        mock_embed.return_value = [[0.1, 0.2, 0.3]]
+        mock_collection = MagicMock()
+        mock_collection.query.return_value = query_results
+        mock_get_collection.return_value = mock_collection
+
+        first = asyncio.run(aquery_vectors("Pixel 10 chip gì?", filter_metadata=FILTER, include_embeddings=True))
+        second = asyncio.run(aquery_vectors("Pixel 10 chip gì?", filter_metadata=FILTER, include_embeddings=True))
+
+    assert cache.errors == 0
+    assert mock_collection.query.call_count == 1
+    assert second == first
+    assert second[0]['embedding'] == [0.5, 0.25, 0.125]
@@ -85,4 +85,84 @@ def test_simple_rerank_with_boost():
     # doc2: -0.1 + 0.0 = -0.1 (lowest)
     assert reranked[0]['id'] == 'doc3'
     assert reranked[1]['id'] == 'doc1'
-    assert reranked[2]['id'] == 'doc2'
\ No newline at end of file
+    assert reranked[2]['id'] == 'doc2'
+
+
+def test_aquery_vectors_uses_async_embeddings():
+    """The async query path embeds through aget_embeddings, not the blocking client."""
+    import asyncio
+    from unittest.mock import AsyncMock
+    from agent.retriever import aquery_vectors
+
+    with patch('agent.retriever.aget_embeddings', new_callable=AsyncMock) as mock_aget_embeddings, \
+         patch('agent.retriever.get_embedding') as mock_get_embedding, \
+         patch('agent.retriever.get_or_create_collection') as mock_get_collection:
+        mock_aget_embeddings.return_value = [[0.1, 0.2, 0.3]]
+        mock_collection = MagicMock()
+        mock_collection.query.return_value = MOCK_QUERY_RESULTS
+        mock_get_collection.return_value = mock_collection
+
+        results = asyncio.run(aquery_vectors("Test query", filter_metadata={'conversation_id': 'c', 'user_id': 'u'}))
+
+        assert [r['id'] for r in results] == ['doc1', 'doc2']
+        mock_aget_embeddings.assert_awaited_once_with(["Test query"])
+        mock_get_embedding.assert_not_called()
+        _, kwargs = mock_collection.query.call_args
+        assert kwargs['where'] == {'$and': [{'conversation_id': 'c'}, {'user_id': 'u'}]}
+
+
+def test_rerank_select_respects_token_budget_and_k():
+    """The final context is cut to top_k chunks that fit the token budget."""
+    from agent.retriever import rerank_select
+    results = [
+        {'id': f'doc{i}', 'document': 'word ' * 50, 'metadata': {}, 'distance': 0.1 * i}
+        for i in range(20)
+    ]
+    selected = rerank_select(results, top_k=10, token_budget=120, mmr_lambda=None)
+    assert [r['id'] for r in selected] == ['doc0', 'doc1']
+
+    selected = rerank_select(results, top_k=3, token_budget=10_000, mmr_lambda=None)
+    assert [r['id'] for r in selected] == ['doc0', 'doc1', 'doc2']
+
+
+def test_rerank_prefers_fresh_results():
+    """Among equally distant chunks, the more recent one ranks first."""
+    from datetime import datetime, timedelta
+    now = datetime.utcnow()
+    results = [
+        {'id': 'old', 'document': 'A', 'metadata': {'created_at': (now - timedelta(days=30)).isoformat()}, 'distance': 0.3},
+        {'id': 'new', 'document': 'B', 'metadata': {'created_at': now.isoformat()}, 'distance': 0.3},
+    ]
+    assert [r['id'] for r in simple_rerank(results)] == ['new', 'old']
+
+
+def test_rerank_select_mmr_skips_near_duplicates():
+    """With MMR, a near-duplicate of an already picked chunk loses to a different one."""
+    from agent.retriever import rerank_select
+    results = [
+        {'id': 'a', 'document': 'A', 'metadata': {}, 'distance': 0.10, 'embedding': [1.0, 0.0]},
+        {'id': 'a-copy', 'document': 'A again', 'metadata': {}, 'distance': 0.11, 'embedding': [0.99, 0.01]},
+        {'id': 'b', 'document': 'B', 'metadata': {}, 'distance': 0.30, 'embedding': [0.0, 1.0]},
+    ]
+    plain = rerank_select(results, top_k=2, mmr_lambda=None)
+    diverse = rerank_select(results, top_k=2, mmr_lambda=0.5)
+    assert [r['id'] for r in plain] == ['a', 'a-copy']
+    assert [r['id'] for r in diverse] == ['a', 'b']
+    assert 'embedding' not in diverse[0]
+
+
+def test_prompt_keeps_mmr_order_on_the_vector_path():
+    """Without lexical results, the prompt lists chunks in MMR selection order, not distance order."""
+    from agent.retriever import rerank_select
+    from agent.prompting import assemble_prompt
+    results = [
+        {'id': 'g5', 'document': 'Pixel 10 dùng chip Tensor G5', 'metadata': {}, 'distance': 0.10, 'embedding': [1.0, 0.0]},
+        {'id': 'g5-copy', 'document': 'Chip Tensor G5 có trong Pixel 10', 'metadata': {}, 'distance': 0.11, 'embedding': [0.99, 0.01]},
+        {'id': 'battery', 'document': 'Pin 4700 mAh, sạc nhanh 30W', 'metadata': {}, 'distance': 0.30, 'embedding': [0.0, 1.0]},
+    ]
+    selected = rerank_select(results, top_k=3, mmr_lambda=0.5)
+    assert [r['id'] for r in selected] == ['g5', 'battery', 'g5-copy']
+    assert all('score' in r for r in selected)
+
+    prompt = assemble_prompt([{"role": "user", "content": "Pixel 10 có gì?"}], selected, token_budget=4096)
+    assert prompt.index('Tensor G5') < prompt.index('Pin 4700') < prompt.index('Chip Tensor G5 có trong')
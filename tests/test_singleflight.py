@@ -0,0 +1,72 @@
+"""
+Unit tests for request coalescing.
+"""
+
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+from agent.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    """N concurrent callers with the same key run the work once."""
+    flight = SingleFlight("test-shared")
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run_test():
+        return await asyncio.gather(*(flight.do("k", work) for _ in range(5)))
+
+    assert asyncio.run(run_test()) == ["result"] * 5
+    assert calls == 1
+    stats = flight.stats()
+    assert stats["executions"] == 1
+    assert stats["collapsed"] == 4
+    assert stats["in_flight"] == 0
+
+
+def test_errors_propagate_to_all_callers():
+    """A failure of the shared call is raised in every waiting caller."""
+    flight = SingleFlight("test-errors")
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def run_test():
+        return await asyncio.gather(*(flight.do("k", work) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run_test())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_aquery_vectors_coalesces_identical_queries():
+    """Identical concurrent retrievals issue one embedding and one Chroma query."""
+    from agent.retriever import aquery_vectors
+
+    async def slow_embeddings(texts):
+        await asyncio.sleep(0.01)
+        return [[0.1, 0.2]]
+
+    with patch('agent.retriever.aget_embeddings', new_callable=AsyncMock) as mock_aget_embeddings, \
+         patch('agent.retriever.get_or_create_collection') as mock_get_collection:
+        mock_aget_embeddings.side_effect = slow_embeddings
+        mock_collection = MagicMock()
+        mock_collection.query.return_value = {
+            'ids': [['doc1']], 'documents': [['Doc 1']], 'metadatas': [[{}]], 'distances': [[0.1]],
+        }
+        mock_get_collection.return_value = mock_collection
+
+        async def run_test():
+            return await asyncio.gather(*(aquery_vectors("Pixel 10 chip là gì?") for _ in range(4)))
+
+        results = asyncio.run(run_test())
+
+    assert all(r[0]['id'] == 'doc1' for r in results)
+    assert results[0][0] is not results[1][0]  # callers get independent copies
+    mock_aget_embeddings.assert_awaited_once()
+    mock_collection.query.assert_called_once()
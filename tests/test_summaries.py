@@ -0,0 +1,80 @@
+"""
+Unit tests for rolling conversation summaries.
+"""
+
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """Point the CRUD and summary helpers at a fresh SQLite database."""
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+    from agent.database import Base
+    import agent.summaries  # noqa: F401
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'chat.db'}")
+    session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    with patch('agent.database.async_session', session_factory), \
+            patch('agent.summaries.async_session', session_factory):
+        yield engine
+    asyncio.run(engine.dispose())
+
+
+def test_update_summary_folds_old_turns_and_keeps_recent(sqlite_db):
+    """Old turns go into the summary in batches; the newest turns stay after the watermark."""
+    from agent.database import create_conversation, add_message, get_recent_messages
+    from agent.summaries import get_summary, split_history, needs_summary, update_summary
+
+    async def run():
+        conv = await create_conversation("user-1")
+        for i in range(40):
+            await add_message(conv.id, "user" if i % 2 == 0 else "assistant", f"Tin nhắn số {i} " + "về Pixel " * 10)
+        history = await get_recent_messages(conv.id, 64)
+
+        generate = AsyncMock(side_effect=["Tóm tắt 1", "Tóm tắt 2"])
+        with patch('agent.summaries.agenerate_text', generate), \
+                patch('agent.summaries.SUMMARY_TRIGGER_TOKENS', 200), \
+                patch('agent.summaries.SUMMARY_KEEP_RECENT_TOKENS', 100), \
+                patch('agent.summaries.SUMMARY_BATCH_MESSAGES', 20):
+            assert needs_summary(history)
+            folded = await update_summary(conv.id)
+            summary = await get_summary(conv.id)
+            remaining = split_history(history, summary)
+            assert not needs_summary(remaining)
+            # Caught up: nothing more to fold
+            assert await update_summary(conv.id) == 0
+        return folded, summary, remaining, generate
+
+    folded, summary, remaining, generate = asyncio.run(run())
+    assert generate.await_count == 2
+    assert "Tin nhắn số 0 " in generate.await_args_list[0].args[0]
+    assert "Current summary: Tóm tắt 1" in generate.await_args_list[1].args[0]
+    assert summary.summary == "Tóm tắt 2"
+    assert summary.summarized_messages == folded == 40 - len(remaining)
+    assert remaining[-1].text.startswith("Tin nhắn số 39 ")
+
+
+def test_short_conversation_is_not_summarized(sqlite_db):
+    """Below the trigger no LLM call is made."""
+    from agent.database import create_conversation, add_message
+    from agent.summaries import get_summary, update_summary
+
+    async def run():
+        conv = await create_conversation("user-1")
+        await add_message(conv.id, "user", "Xin chào")
+        generate = AsyncMock()
+        with patch('agent.summaries.agenerate_text', generate):
+            assert await update_summary(conv.id) == 0
+        return generate, await get_summary(conv.id)
+
+    generate, summary = asyncio.run(run())
+    generate.assert_not_awaited()
+    assert summary is None
@@ -0,0 +1,74 @@
+"""
+Unit tests for the upsert micro-batcher.
+"""
+
+import asyncio
+from unittest.mock import patch, AsyncMock, MagicMock
+from agent.upsert_batcher import UpsertBatcher
+
+
+def fake_embeddings(texts):
+    return [[float(len(t)), 1.0] for t in texts]
+
+
+def test_concurrent_submissions_share_one_embed_and_upsert():
+    """Messages submitted within the linger window are embedded and written together."""
+    batcher = UpsertBatcher(max_batch=100, linger_ms=20)
+
+    async def run_test():
+        await asyncio.gather(*(
+            batcher.submit([f"message {i}"], [{"message_id": f"m{i}"}], [f"m{i}#chunk_0"])
+            for i in range(5)
+        ))
+
+    with patch('agent.upsert_batcher.aget_embeddings', new_callable=AsyncMock) as mock_embed, \
+         patch('agent.upsert_batcher.upsert_embedded', new_callable=MagicMock) as mock_upsert:
+        mock_embed.side_effect = fake_embeddings
+        asyncio.run(run_test())
+
+    mock_embed.assert_awaited_once()
+    mock_upsert.assert_called_once()
+    documents, metadatas, ids, embeddings, collection_name = mock_upsert.call_args.args
+    assert ids == [f"m{i}#chunk_0" for i in range(5)]
+    assert len(embeddings) == 5
+    assert batcher.stats()["linger_flushes"] == 1
+
+
+def test_batch_flushes_when_full_and_dedupes_ids():
+    """Reaching max_batch flushes without waiting; repeated ids are written once."""
+    batcher = UpsertBatcher(max_batch=3, linger_ms=10_000)
+
+    async def run_test():
+        await asyncio.gather(
+            batcher.submit(["a", "b"], [{}, {}], ["m1#chunk_0", "m1#chunk_1"]),
+            batcher.submit(["a2"], [{}], ["m1#chunk_0"]),
+        )
+
+    with patch('agent.upsert_batcher.aget_embeddings', new_callable=AsyncMock) as mock_embed, \
+         patch('agent.upsert_batcher.upsert_embedded', new_callable=MagicMock) as mock_upsert:
+        mock_embed.side_effect = fake_embeddings
+        asyncio.run(asyncio.wait_for(run_test(), timeout=2))
+
+    documents, _, ids, _, _ = mock_upsert.call_args.args
+    assert ids == ["m1#chunk_1", "m1#chunk_0"]
+    assert documents == ["b", "a2"]
+    assert batcher.stats()["size_flushes"] == 1
+
+
+def test_batch_error_is_raised_to_every_submitter():
+    """A failed batch fails each caller so their jobs are retried."""
+    batcher = UpsertBatcher(max_batch=100, linger_ms=5)
+
+    async def run_test():
+        return await asyncio.gather(
+            batcher.submit(["a"], [{}], ["a#chunk_0"]),
+            batcher.submit(["b"], [{}], ["b#chunk_0"]),
+            return_exceptions=True,
+        )
+
+    with patch('agent.upsert_batcher.aget_embeddings', new_callable=AsyncMock) as mock_embed:
+        mock_embed.side_effect = ValueError("ollama down")
+        results = asyncio.run(run_test())
+
+    assert all(isinstance(r, ValueError) for r in results)
+    assert batcher.stats()["failed_batches"] == 1
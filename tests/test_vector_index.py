@@ -0,0 +1,71 @@
+"""
+Unit tests for the memory-mapped vector index.
+"""
+
+import uuid
+import numpy as np
+import chromadb
+from unittest.mock import patch, MagicMock
+from agent.vector_index import VectorIndex, export_collection
+
+
+def make_collection(rows=50, dim=8):
+    client = chromadb.EphemeralClient()
+    collection = client.create_collection(f"knowledge_{uuid.uuid4().hex[:8]}")
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(rows, dim)).astype(np.float32)
+    collection.add(
+        ids=[f"doc{i}#chunk_0" for i in range(rows)],
+        embeddings=embeddings.tolist(),
+        documents=[f"document {i}" for i in range(rows)],
+        metadatas=[{"source": "a.md" if i % 2 else "b.md"} for i in range(rows)],
+    )
+    return collection, embeddings
+
+
+def test_exported_index_matches_chroma(tmp_path):
+    """Exact search over the mmap export returns Chroma's top-K with the same distances."""
+    collection, embeddings = make_collection()
+    out_dir = str(tmp_path / "knowledge")
+    assert export_collection(collection, out_dir, build_hnsw=False) == 50
+
+    index = VectorIndex.load(out_dir)
+    assert isinstance(index.vectors, np.memmap)
+
+    query = embeddings[7] + 0.01
+    results = index.search(query.tolist(), top_k=5)
+    expected = collection.query(query_embeddings=[query.tolist()], n_results=5)
+
+    assert [r["id"] for r in results] == expected["ids"][0]
+    assert np.allclose([r["distance"] for r in results], expected["distances"][0], atol=1e-3)
+    assert results[0]["document"] == "document 7"
+
+
+def test_filters_and_float16_storage(tmp_path):
+    """Metadata filters restrict candidates; float16 exports keep the nearest neighbour."""
+    collection, embeddings = make_collection()
+    out_dir = str(tmp_path / "knowledge16")
+    export_collection(collection, out_dir, dtype="float16", build_hnsw=False)
+    index = VectorIndex.load(out_dir)
+
+    assert index.vectors.dtype == np.float16
+    results = index.search(embeddings[3].tolist(), top_k=3, filter_metadata={"source": "a.md"})
+    assert results[0]["id"] == "doc3#chunk_0"
+    assert all(r["metadata"]["source"] == "a.md" for r in results)
+    assert index.search(embeddings[3].tolist(), top_k=3, filter_metadata={"source": "missing"}) == []
+
+
+def test_query_vectors_uses_configured_index():
+    """Collections with an exported index are not sent to Chroma."""
+    from agent.retriever import query_vectors
+
+    index = MagicMock()
+    index.search.return_value = [{"id": "k1", "document": "Tensor G5", "metadata": {}, "distance": 0.1}]
+    with patch('agent.retriever.get_embedding', return_value=[0.1, 0.2]), \
+         patch('agent.retriever.get_vector_index', return_value=index), \
+         patch('agent.retriever.get_or_create_collection') as mock_get_collection:
+        results = query_vectors("Pixel 10 chip", collection_name="knowledge", top_k=2)
+
+    assert results[0]["id"] == "k1"
+    index.search.assert_called_once_with([0.1, 0.2], 2, None)
+    mock_get_collection.assert_not_called()
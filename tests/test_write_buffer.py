@@ -0,0 +1,176 @@
+"""
+Unit tests for the write-behind message buffer.
+"""
+
+import json
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from agent.database import Base, create_conversation, get_recent_messages
+from agent.jobs import Job, DeadLetter
+from agent.write_buffer import MessageWriteBuffer
+
+
+@pytest.fixture
+def buffer_db(tmp_path):
+    """Point messages and jobs at a fresh SQLite database."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'chat.db'}")
+    session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    with patch('agent.database.async_session', session_factory), \
+         patch('agent.write_buffer.async_session', session_factory), \
+         patch('agent.jobs.async_session', session_factory):
+        yield session_factory
+    asyncio.run(engine.dispose())
+
+
+def test_submit_returns_before_write_and_history_merges_pending(buffer_db):
+    """Messages are visible through recent_messages at once and written with their embedding jobs."""
+    buffer = MessageWriteBuffer(linger_ms=10_000)
+
+    async def run_test():
+        conversation = await create_conversation("user-1")
+        user_msg = await buffer.submit(conversation.id, "user", "Pixel 10 dùng chip gì?", user_id="user-1")
+        assert await get_recent_messages(conversation.id, 10) == []
+        merged = await buffer.recent_messages(conversation.id, 10)
+        await buffer.submit(conversation.id, "assistant", "Tensor G5.", user_id="user-1")
+        await buffer.flush()
+        async with buffer_db() as session:
+            job_keys = set((await session.scalars(select(Job.idempotency_key))).all())
+        return user_msg, merged, await get_recent_messages(conversation.id, 10), job_keys
+
+    user_msg, merged, stored, job_keys = asyncio.run(run_test())
+    assert [m.id for m in merged] == [user_msg.id]
+    assert [m.text for m in stored] == ["Pixel 10 dùng chip gì?", "Tensor G5."]
+    assert stored[0].id == user_msg.id
+    assert job_keys == {f"embed:{m.id}" for m in stored}
+    assert buffer.stats()["pending"] == 0
+
+
+def test_batches_keep_per_conversation_order(buffer_db):
+    """Messages split over several batches are committed in submission order."""
+    buffer = MessageWriteBuffer(max_batch=2, linger_ms=1)
+
+    async def run_test():
+        conversation = await create_conversation("user-1")
+        for i in range(5):
+            await buffer.submit(conversation.id, "user", f"message {i}")
+        await buffer.flush()
+        return await get_recent_messages(conversation.id, 10)
+
+    stored = asyncio.run(run_test())
+    assert [m.text for m in stored] == [f"message {i}" for i in range(5)]
+    assert buffer.stats()["batches"] == 3
+
+
+def test_one_failing_conversation_does_not_lose_the_batch(buffer_db):
+    """A failed batch is rewritten per conversation; only the failing messages are dead-lettered."""
+    buffer = MessageWriteBuffer(linger_ms=10_000, max_retries=2)
+    real_write = buffer._write
+
+    async def run_test():
+        good = await create_conversation("user-1")
+        bad = await create_conversation("user-2")
+
+        async def write(batch):
+            if any(m.conversation_id == bad.id for m in batch):
+                raise RuntimeError("FOREIGN KEY constraint failed")
+            await real_write(batch)
+
+        with patch.object(buffer, '_write', side_effect=write), \
+             patch('agent.write_buffer.asyncio.sleep', new_callable=AsyncMock):
+            kept = [await buffer.submit(good.id, "user", f"message {i}") for i in range(2)]
+            lost = await buffer.submit(bad.id, "user", "Giá bao nhiêu?")
+            await buffer.flush()
+            await buffer.confirm(*kept)
+            with pytest.raises(RuntimeError):
+                await buffer.confirm(lost)
+        async with buffer_db() as session:
+            dead = (await session.scalars(select(DeadLetter))).all()
+        return await get_recent_messages(good.id, 10), dead, lost
+
+    stored, dead, lost = asyncio.run(run_test())
+    assert [m.text for m in stored] == ["message 0", "message 1"]
+    assert [(d.kind, d.job_id) for d in dead] == [("message", lost.id)]
+    assert json.loads(dead[0].payload)["text"] == "Giá bao nhiêu?"
+    assert buffer.stats()["dead_lettered"] == 1 and buffer.stats()["pending"] == 0
+
+
+def test_messages_stay_queued_while_nothing_can_be_written():
+    """When neither the batch nor the dead-letter can be written, messages are kept and retried."""
+    buffer = MessageWriteBuffer(linger_ms=1, max_retries=2, retry_interval=3600)
+
+    async def run_test():
+        with patch.object(buffer, '_write', new_callable=AsyncMock) as mock_write, \
+             patch('agent.write_buffer.async_session', side_effect=RuntimeError("database is locked")), \
+             patch('agent.write_buffer.asyncio.sleep', new_callable=AsyncMock):
+            mock_write.side_effect = RuntimeError("database is locked")
+            message = await buffer.submit("conv-1", "user", "hello")
+            await buffer.flush()
+            attempts = mock_write.await_count
+            assert not message.persisted.done()
+            assert buffer.pending("conv-1") == [message]
+            with pytest.raises(asyncio.TimeoutError):
+                await buffer.confirm(message, timeout=0.01)
+
+            # The database is back: flush() retries at once instead of waiting for the timer
+            mock_write.side_effect = None
+            await buffer.flush()
+            await buffer.confirm(message)
+            return attempts
+
+    # 2 batch attempts, then once for the conversation and once for the message
+    assert asyncio.run(run_test()) == 4
+    assert buffer.stats()["requeued"] == 1
+    assert buffer.pending("conv-1") == []
+
+
+def test_messages_queued_on_a_finished_loop_are_written_later(buffer_db):
+    """Messages left queued when their event loop ended are carried over, not discarded."""
+    buffer = MessageWriteBuffer(linger_ms=10_000)
+
+    async def create():
+        return await create_conversation("user-1")
+
+    conversation = asyncio.run(create())
+
+    async def first_loop():
+        await buffer.submit(conversation.id, "user", "first")
+
+    async def second_loop():
+        await buffer.submit(conversation.id, "assistant", "second")
+        await buffer.flush()
+        return await get_recent_messages(conversation.id, 10)
+
+    asyncio.run(first_loop())
+    stored = asyncio.run(second_loop())
+    assert [m.text for m in stored] == ["first", "second"]
+
+
+def test_batch_adds_token_counts_per_conversation(buffer_db):
+    """One batch spanning two conversations adds each one's own message tokens to tokens_total."""
+    from agent.database import get_conversation
+    from agent.tokens import count_tokens
+
+    buffer = MessageWriteBuffer(linger_ms=10_000)
+    texts = {"a": ["Pixel 10 dùng chip gì?", "Tensor G5."], "b": ["Giá bao nhiêu?"]}
+
+    async def run_test():
+        conversations = {key: await create_conversation(f"user-{key}") for key in texts}
+        for key, messages in texts.items():
+            for text in messages:
+                await buffer.submit(conversations[key].id, "user", text)
+        await buffer.flush()
+        return {key: (await get_conversation(conv.id)).tokens_total for key, conv in conversations.items()}
+
+    totals = asyncio.run(run_test())
+    assert totals == {key: sum(count_tokens(t) for t in messages) for key, messages in texts.items()}
+    assert buffer.stats()["batches"] == 1
@@ -211,6 +211,12 @@ def stream_message(api_base: str, api_key: str, conversation_id: str, content: s
                             if isinstance(maybe_json, dict) and "debug" in maybe_json:
                                 ui_log(f"Ignoring debug SSE event: {maybe_json}")
                                 continue
+                            if isinstance(maybe_json, dict) and "done" in maybe_json:
+                                # Final event: the turn was (or could not be) saved
+                                ui_log(f"Stream done: {maybe_json}")
+                                if maybe_json.get("error"):
+                                    yield f"\n\n⚠️ {maybe_json['error']}"
+                                continue
                             chunk = maybe_json.get("chunk") if isinstance(maybe_json, dict) else None
                             if chunk is not None:
                                 ui_log(f"Parsed chunk (json): '{chunk}'")